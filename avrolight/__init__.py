@@ -1,22 +1,33 @@
-import json
-
-from io import BytesIO
-
 from avrolight.io import Reader, Writer
 from avrolight.container import read_container
+from avrolight.container import open_container
 from avrolight.container import ContainerWriter
 from avrolight.container import append_to_container
 from avrolight.schema import Schema
+from avrolight.codecs import register_codec
+from avrolight.parallel import read_container_parallel
+from avrolight.compaction import merge_containers, split_container
+from avrolight.stats import Stats
 
-__all__ = ("Reader", "Writer", "read", "write", "read_container", "ContainerWriter", "Schema", "append_to_container")
+__all__ = ("Reader", "Writer", "read", "write", "read_container", "ContainerWriter", "Schema", "append_to_container",
+           "register_codec", "read_container_parallel", "open_container", "merge_containers", "split_container",
+           "Stats")
 
 
-def read(schema, fp):
-    if isinstance(fp, bytes):
-        fp = BytesIO(fp)
+def read(schema, fp, fields=None):
+    """Reads one value from a file-like object or a bytes-like object.
+    If `fields` is given, only those fields are decoded, see :class:`avrolight.io.Reader`.
 
-    return Reader(schema).read(fp)
+    Pass a :class:`avrolight.schema.Schema` instance when reading many values,
+    so that the schema is compiled only once.
+    """
+    return Reader(schema, fields).read(fp)
 
 
 def write(schema, fp, value):
+    """Writes one value to a file-like object.
+
+    Pass a :class:`avrolight.schema.Schema` instance when writing many values,
+    so that the schema is compiled only once.
+    """
     return Writer(schema).write(fp, value)
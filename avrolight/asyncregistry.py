@@ -0,0 +1,294 @@
+"""
+This file contains asyncio counterparts of the schema registry clients
+in :mod:`avrolight.registry`.
+
+The consul client requires the `aiohttp` library.
+"""
+
+import asyncio
+import logbook
+import avrolight
+
+from abc import ABCMeta, abstractmethod
+from base64 import b64decode
+from first import first
+
+from avrolight.registry import RegistryUnavailableError, SchemaCache, serialize_schema, schema_keys, message_key, _header
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+__all__ = [
+    "AsyncRegistryClient", "AsyncConsulRegistryClient", "AsyncCachingRegistryClient",
+    "serialize", "deserialize", "serialize_many", "deserialize_many"
+]
+
+logger = logbook.Logger(__file__)
+
+
+class AsyncRegistryClient(metaclass=ABCMeta):
+    @abstractmethod
+    async def put(self, schema, force=False):
+        """Puts the given schema into the schema registry and returns the hash of the schema,
+        see :meth:`avrolight.registry.RegistryClient.put`.
+
+        :param avrolight.Schema schema: The schema to put into the registry.
+        :param bool force:    Always put the schema, do not check if it is already present
+                              in the registry.
+        :rtype: bytes
+        """
+
+    @abstractmethod
+    async def get(self, schema_hash):
+        """Gets the schema from the registry.
+        Raises `KeyError` if no schema with this hash could be found and
+        :class:`avrolight.registry.RegistryUnavailableError` if the registry could not be asked.
+
+        :param bytes schema_hash: The schema hash to query
+        :rtype: avrolight.Schema
+        """
+
+    @property
+    def cached(self):
+        return AsyncCachingRegistryClient(self)
+
+
+class AsyncCachingRegistryClient(AsyncRegistryClient):
+    def __init__(self, registry, cache=None, stats=None):
+        """Caches the schemas of the given registry client in a
+        :class:`avrolight.registry.SchemaCache`. Concurrent misses on
+        the same hash wait for a single lookup.
+
+        If a :class:`avrolight.stats.Stats` instance is given, the lookups,
+        the misses and the time spent fetching schemas from the backend are counted.
+        """
+        self.registry = registry
+        self.cache = cache if cache is not None else SchemaCache()
+        self.stats = stats
+        self._loads = {}
+
+    async def put(self, schema, force=False):
+        schema_bytes, schema_hash = serialize_schema(schema)
+        if not force and schema_hash in self.cache:
+            logger.debug("Not putting, schema already cached")
+            return schema_hash
+
+        # store the schema in the backend
+        schema_hash = await self.registry.put(schema, force)
+        self.cache.put(schema_hash, schema)
+        self.cache.put(schema.fingerprint_hash, schema)
+        return schema_hash
+
+    async def get(self, schema_hash):
+        if self.stats is not None:
+            self.stats.count_lookup()
+
+        schema = self.cache.lookup(schema_hash)
+        if schema is not None:
+            return schema
+
+        load = self._loads.get(schema_hash)
+        if load is None:
+            load = self._loads[schema_hash] = asyncio.ensure_future(self._load(schema_hash))
+
+        return await asyncio.shield(load)
+
+    async def _load(self, schema_hash):
+        start = self.stats.clock() if self.stats is not None else None
+        try:
+            schema = await self.registry.get(schema_hash)
+            self.cache.put(schema_hash, schema)
+            return schema
+
+        except KeyError:
+            self.cache.put_missing(schema_hash)
+            raise
+
+        finally:
+            del self._loads[schema_hash]
+
+            if start is not None:
+                self.stats.count_fetch(schema_hash, self.stats.clock() - start)
+
+    @property
+    def cached(self):
+        return self
+
+
+class AsyncConsulRegistryClient(AsyncRegistryClient):
+    def __init__(self, endpoints, prefix="avro-schemas", session=None, timeout=10, limit=10):
+        """Creates a client for a schema registry stored in the key value store of consul.
+
+        The requests are sent using an :class:`aiohttp.ClientSession` that keeps its connections
+        alive. At most `limit` requests are sent concurrently, further requests wait for
+        a free connection. Each request fails after `timeout` seconds.
+
+        The session is created on first use, as it must be created within the event loop.
+        Call :meth:`close` to close it.
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncConsulRegistryClient requires the aiohttp library")
+
+        if isinstance(endpoints, str):
+            endpoints = [endpoints]
+
+        self.endpoints = tuple(endpoints)
+        self.prefix = prefix
+        self.timeout = timeout
+        self.limit = limit
+
+        if not first(self.endpoints):
+            raise ValueError("Endpoints must not be empty")
+
+        self._session = session
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def get(self, schema_hash):
+        missing, last_error = False, None
+        for uri in self._consul_uris(schema_hash):
+            try:
+                logger.debug("Retrieving schema from {}", uri)
+
+                async with self.session.get(uri) as response:
+                    if response.status == 404:
+                        missing = True
+                        continue
+
+                    response.raise_for_status()
+                    response = await response.json()
+
+                if not response:
+                    missing = True
+                    continue
+
+                encoded_schema = first(response)["Value"]
+                return avrolight.Schema(b64decode(encoded_schema.encode()).decode())
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+                last_error = error
+
+        # only an endpoint answering without the key proves that the schema is unknown
+        if missing:
+            raise KeyError(schema_hash)
+
+        raise RegistryUnavailableError("Could not retrieve schema {}".format(schema_hash)) from last_error
+
+    async def put(self, schema, force=False):
+        # serialize schema
+        schema_bytes, schema_hash = serialize_schema(schema)
+
+        if not force:
+            try:
+                await self.get(schema.fingerprint_hash)
+                return schema_hash
+            except KeyError:
+                pass
+
+        for key in schema_keys(schema):
+            await self._put_key(key, schema_bytes)
+
+        return schema_hash
+
+    async def _put_key(self, key, schema_bytes):
+        last_error = None
+        for uri in self._consul_uris(key):
+            try:
+                logger.debug("Putting schema to {}", uri)
+
+                async with self.session.put(uri, data=schema_bytes) as response:
+                    response.raise_for_status()
+
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                last_error = error
+
+        # re-raise the last error
+        raise last_error
+
+    def _consul_uris(self, schema_hash):
+        return ("/".join((endpoint, "v1/kv", self.prefix, schema_hash.decode())) for endpoint in self.endpoints)
+
+
+async def serialize(client, schema, message, single_object=False):
+    """Serializes a message like :func:`avrolight.registry.serialize`."""
+    buf = bytearray(_header(await client.put(schema), schema, single_object))
+    avrolight.Writer(schema).encode(message, buf)
+    return bytes(buf)
+
+
+async def deserialize(client, message, reader=None, lazy=False):
+    """Deserializes a message like :func:`avrolight.registry.deserialize`. Only
+    the lookup of the schema waits for the registry, the message is decoded directly."""
+    if lazy and reader is not None:
+        raise ValueError("Lazy decoding can not be combined with a reader schema")
+
+    schema_hash, offset = message_key(message)
+    if lazy:
+        return (await client.get(schema_hash)).viewer(message, offset)
+
+    if reader is None:
+        value, _ = avrolight.Reader(await client.get(schema_hash)).decode(message, offset)
+        return value
+
+    plan = reader.plans.get(schema_hash) or reader.plan(await client.get(schema_hash), key=schema_hash)
+    value, _ = plan(message, offset)
+    return value
+
+
+async def serialize_many(client, schema, messages, single_object=False):
+    """Serializes many messages like :func:`avrolight.registry.serialize_many`."""
+    header = _header(await client.put(schema), schema, single_object)
+    writer = avrolight.Writer(schema)
+
+    result = []
+    for message in messages:
+        buf = bytearray(header)
+        writer.encode(message, buf)
+        result.append(bytes(buf))
+
+    return result
+
+
+async def deserialize_many(client, messages, reader=None, lazy=False):
+    """Deserializes many messages like :func:`avrolight.registry.deserialize_many`.
+    The schemas of all hashes in the batch are requested concurrently."""
+    if lazy and reader is not None:
+        raise ValueError("Lazy decoding can not be combined with a reader schema")
+
+    messages = list(messages)
+    keys = [message_key(message) for message in messages]
+    hashes = list({schema_hash for schema_hash, _ in keys})
+    schemas = await asyncio.gather(*[client.get(schema_hash) for schema_hash in hashes])
+
+    if lazy:
+        viewers = {schema_hash: schema.viewer for schema_hash, schema in zip(hashes, schemas)}
+        return [viewers[schema_hash](message, offset) for message, (schema_hash, offset) in zip(messages, keys)]
+
+    decoders = {}
+    for schema_hash, schema in zip(hashes, schemas):
+        if reader is None:
+            decoders[schema_hash] = avrolight.Reader(schema).decode
+        else:
+            decoders[schema_hash] = reader.plans.get(schema_hash) or reader.plan(schema, key=schema_hash)
+
+    return [decoders[schema_hash](message, offset)[0] for message, (schema_hash, offset) in zip(messages, keys)]
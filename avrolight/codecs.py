@@ -0,0 +1,110 @@
+"""
+This file contains the codecs to compress the data blocks of avro container files.
+
+The codecs from the python standard library are always available. Other codecs are
+registered if the library implementing them is installed, or can be registered
+using :func:`register_codec`.
+"""
+
+import binascii
+import bz2
+import lzma
+import struct
+import zlib
+
+__all__ = ("Codec", "register_codec", "get_codec", "CODECS")
+
+CRC32 = struct.Struct(">I")
+
+
+class Codec(object):
+    def __init__(self, name, compress, decompress):
+        """Creates a new codec.
+
+        `compress` and `decompress` are functions that take the data of a block as bytes-like
+        object and return the compressed or decompressed data as bytes.
+        """
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+    def __repr__(self):
+        return "Codec({!r})".format(self.name)
+
+
+CODECS = {}
+
+
+def register_codec(name, compress, decompress):
+    """Registers a codec under the given name. The name is written to the
+    'avro.codec' metadata of container files. Returns the new :class:`Codec`."""
+    codec = CODECS[name] = Codec(name, compress, decompress)
+    return codec
+
+
+def get_codec(codec):
+    """Gets a codec by name. The name can be given as str or as bytes, as found in
+    the metadata of a container file. Codec instances are returned as they are."""
+    if isinstance(codec, Codec):
+        return codec
+
+    if isinstance(codec, bytes):
+        codec = codec.decode("utf8")
+
+    try:
+        return CODECS[codec]
+    except KeyError:
+        raise ValueError("Unsupported codec: {}".format(codec))
+
+
+def _identity(data):
+    return data
+
+
+def _deflate_compress(data):
+    # the avro specification requires raw deflate data without zlib header and checksum
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _deflate_decompress(data):
+    return zlib.decompress(data, -15)
+
+
+register_codec("null", _identity, _identity)
+register_codec("deflate", _deflate_compress, _deflate_decompress)
+register_codec("bzip2", bz2.compress, bz2.decompress)
+register_codec("xz", lzma.compress, lzma.decompress)
+
+try:
+    import snappy
+except ImportError:
+    pass
+else:
+    def _snappy_compress(data):
+        # snappy blocks are followed by the big endian crc32 checksum of the uncompressed data
+        return snappy.compress(data) + CRC32.pack(binascii.crc32(data) & 0xffffffff)
+
+    def _snappy_decompress(data):
+        view = memoryview(data)
+        result = snappy.decompress(view[:-4])
+        if CRC32.unpack(view[-4:])[0] != binascii.crc32(result) & 0xffffffff:
+            raise IOError("Checksum mismatch in snappy block")
+
+        return result
+
+    register_codec("snappy", _snappy_compress, _snappy_decompress)
+
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+    def _zstandard_compress(data):
+        return zstandard.ZstdCompressor().compress(data)
+
+    def _zstandard_decompress(data):
+        # frames written by streaming compressors do not contain the content size
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+    register_codec("zstandard", _zstandard_compress, _zstandard_decompress)
@@ -0,0 +1,513 @@
+"""
+This file decodes blocks of flat records into columns instead of one dict per record,
+and encodes columns into blocks of records.
+
+Records of a block are decoded into one NumPy array per field. Numeric and boolean fields
+become arrays of the matching dtype, strings and enums become object arrays and nullable
+fields, unions of null and one other type, become masked arrays. Blocks of records that
+contain only float, double and boolean fields are mapped to the arrays without decoding
+each value.
+
+Columns are encoded into blocks with vectorized numpy operations: fixed size values are
+packed in bulk, varints are computed for whole columns at once and the encoded columns
+are interleaved into records with a single scatter per column.
+
+This requires numpy, converting blocks to data frames also requires pandas.
+"""
+
+from avrolight.compiler import SkipCompiler
+from avrolight.io import PRIMITIVE_DECODERS, decode_long
+from avrolight.schema import Schema
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+__all__ = ("ColumnDecoder", "ColumnEncoder")
+
+# numpy dtypes of the supported column types. Strings and enums are stored as objects.
+DTYPES = {
+    "boolean": "?",
+    "int": "<i4",
+    "long": "<i8",
+    "float": "<f4",
+    "double": "<f8",
+    "string": "O",
+    "enum": "O",
+}
+
+# types with a fixed size in the avro encoding, blocks containing only those can be mapped directly
+FIXED_SIZE_TYPES = ("boolean", "float", "double")
+
+# bytes of records interleaved at once when encoding columns
+CHUNK_SIZE = 64 * 1024
+
+# values of null entries in nullable columns
+FILL_VALUES = {
+    "boolean": False,
+    "int": 0,
+    "long": 0,
+    "float": 0.0,
+    "double": 0.0,
+    "string": None,
+    "enum": -1,
+}
+
+
+class Column(object):
+    """A column of one field, collecting the decoded values of a block."""
+
+    def __init__(self, name, type_name, nullable, symbols=None):
+        self.name = name
+        self.type_name = type_name
+        self.nullable = nullable
+        self.symbols = symbols
+
+        self.values = []
+        self.mask = [] if nullable else None
+
+    def to_array(self):
+        if self.type_name == "enum":
+            # enums are collected as indices, null entries have the index -1
+            symbols = numpy.empty(len(self.symbols) + 1, dtype=object)
+            symbols[:-1] = self.symbols
+            array = symbols[numpy.array(self.values, dtype=numpy.int64)]
+
+        elif self.type_name == "string":
+            array = numpy.empty(len(self.values), dtype=object)
+            array[:] = self.values
+        else:
+            array = numpy.array(self.values, dtype=DTYPES[self.type_name])
+
+        if self.nullable:
+            return numpy.ma.masked_array(array, mask=numpy.array(self.mask, dtype=bool))
+
+        return array
+
+    def to_series_data(self):
+        if self.type_name == "enum":
+            return pandas.Categorical.from_codes(self.values, categories=self.symbols)
+
+        if self.nullable and self.type_name != "string":
+            values = [None if masked else value for value, masked in zip(self.values, self.mask)]
+            return pandas.array(values, dtype={
+                "boolean": "boolean", "int": "Int32", "long": "Int64", "float": "Float32", "double": "Float64",
+            }[self.type_name])
+
+        return self.to_array()
+
+
+class ColumnDecoder(object):
+    def __init__(self, schema, fields=None):
+        """Creates a decoder for blocks of records of the given record schema.
+
+        Only flat records are supported: all fields must have a primitive type except
+        bytes, or be an enum, or be a union of null and one of those. If a list of field
+        names is given, only those fields are decoded and all other fields are skipped.
+        Other fields may have any type.
+        """
+        if numpy is None:
+            raise ImportError("Decoding columns requires numpy")
+
+        self.schema = schema if isinstance(schema, Schema) else Schema(schema)
+
+        record = self.schema.toplevel_type
+        if isinstance(record, str) or record.get("type") not in ("record", "error"):
+            raise ValueError("Columns can only be decoded for record schemas")
+
+        self.skipper = SkipCompiler(self.schema)
+
+        # (name, column type) pairs, where the column type is a tuple of type name, index of the
+        # null branch and enum symbols, or the function to skip the field if it is not decoded.
+        self.fields = []
+        for field in record["fields"]:
+            if fields is not None and field["name"] not in fields:
+                self.fields.append((field["name"], self.skipper.compile(field["type"])))
+            else:
+                self.fields.append((field["name"], self._column_type(field)))
+
+        self.dtype = self._fixed_size_dtype()
+
+    def _resolve(self, schema):
+        while True:
+            # something like {"type": "long"} or {"type": ["null", "long"]}
+            if isinstance(schema, dict) and (isinstance(schema["type"], (list, tuple)) or (
+                    isinstance(schema["type"], str) and schema["type"] in PRIMITIVE_DECODERS)):
+                schema = schema["type"]
+            elif isinstance(schema, str) and schema.lstrip(".") in self.schema.types:
+                schema = self.schema.get_type_schema(schema)
+            else:
+                return schema
+
+    def _column_type(self, field):
+        """Returns the type name, the index of the null branch or None and the enum symbols of a field."""
+        schema = self._resolve(field["type"])
+
+        null_index = None
+        if isinstance(schema, (list, tuple)):
+            branches = [self._resolve(branch) for branch in schema]
+            if len(branches) != 2 or "null" not in branches:
+                raise ValueError("Field {} is not a nullable column".format(field["name"]))
+
+            null_index = branches.index("null")
+            schema = branches[1 - null_index]
+
+        if isinstance(schema, dict) and schema.get("type") == "enum":
+            return "enum", null_index, tuple(schema["symbols"])
+
+        if not isinstance(schema, str) or schema not in DTYPES:
+            raise ValueError("Field {} can not be decoded into a column".format(field["name"]))
+
+        return schema, null_index, None
+
+    def _fixed_size_dtype(self):
+        """Returns a structured numpy dtype for records with only fixed size fields, or None."""
+        dtype = []
+        for name, column_type in self.fields:
+            if callable(column_type):
+                return None
+
+            type_name, null_index, _ = column_type
+            if type_name not in FIXED_SIZE_TYPES or null_index is not None:
+                return None
+
+            dtype.append((name, DTYPES[type_name]))
+
+        return numpy.dtype(dtype)
+
+    def _columns(self):
+        return [
+            Column(name, column_type[0], column_type[1] is not None, column_type[2])
+            for name, column_type in self.fields
+            if not callable(column_type)
+        ]
+
+    def _steps(self, columns):
+        """Builds one function for each field that decodes a value into its column."""
+        columns = iter(columns)
+
+        steps = []
+        for name, column_type in self.fields:
+            if callable(column_type):
+                steps.append(column_type)
+                continue
+
+            column = next(columns)
+            type_name, null_index, _ = column_type
+
+            # enums are collected as indices of their symbols
+            decode = decode_long if type_name == "enum" else PRIMITIVE_DECODERS[type_name]
+            steps.append(_value_step(column.values.append, decode, null_index, column.mask, FILL_VALUES[type_name]))
+
+        return tuple(steps)
+
+    def decode_columns(self, data, count):
+        """Decodes `count` records from the (decompressed) data of a block into
+        a list of :class:`Column` instances."""
+        columns = self._columns()
+        steps = self._steps(columns)
+
+        pos = 0
+        for _ in range(count):
+            for step in steps:
+                pos = step(data, pos)
+
+        return columns
+
+    def decode(self, data, count):
+        """Decodes `count` records from the (decompressed) data of a block into a dict
+        that maps the field names to numpy arrays."""
+        if self.dtype is not None:
+            records = numpy.frombuffer(data, dtype=self.dtype, count=count)
+            return {name: records[name] for name in self.dtype.names}
+
+        return {column.name: column.to_array() for column in self.decode_columns(data, count)}
+
+    def decode_dataframe(self, data, count):
+        """Decodes `count` records from the (decompressed) data of a block into a
+        :class:`pandas.DataFrame`. Enums become categorical columns and nullable
+        numbers become nullable pandas arrays."""
+        if pandas is None:
+            raise ImportError("Decoding data frames requires pandas")
+
+        if self.dtype is not None:
+            return pandas.DataFrame(self.decode(data, count))
+
+        columns = self.decode_columns(data, count)
+        return pandas.DataFrame({column.name: column.to_series_data() for column in columns})
+
+
+def _value_step(append, decode, null_index, mask, fill_value):
+    if null_index is None:
+        def step(buf, pos):
+            value, pos = decode(buf, pos)
+            append(value)
+            return pos
+
+        return step
+
+    append_mask = mask.append
+
+    def nullable_step(buf, pos):
+        index, pos = decode_long(buf, pos)
+        if index == null_index:
+            append_mask(True)
+            append(fill_value)
+            return pos
+
+        append_mask(False)
+        value, pos = decode(buf, pos)
+        append(value)
+        return pos
+
+    return nullable_step
+
+
+
+class ColumnEncoder(object):
+    def __init__(self, schema):
+        """Creates an encoder for columns of records of the given record schema.
+
+        All fields must have a primitive type, or be an enum or fixed, or be a union
+        of null and one of those.
+        """
+        if numpy is None:
+            raise ImportError("Encoding columns requires numpy")
+
+        self.schema = schema if isinstance(schema, Schema) else Schema(schema)
+
+        record = self.schema.toplevel_type
+        if isinstance(record, str) or record.get("type") not in ("record", "error"):
+            raise ValueError("Columns can only be encoded for record schemas")
+
+        # (name, type name, index of the null branch, type schema) for each field
+        self.fields = [(field["name"],) + self._column_type(field) for field in record["fields"]]
+
+    def _column_type(self, field):
+        schema = field["type"]
+        if isinstance(schema, dict) and isinstance(schema["type"], (list, tuple)):
+            schema = schema["type"]
+
+        null_index = None
+        if isinstance(schema, (list, tuple)):
+            if len(schema) != 2 or "null" not in schema:
+                raise ValueError("Field {} is not a nullable column".format(field["name"]))
+
+            null_index = list(schema).index("null")
+            schema = schema[1 - null_index]
+
+        if isinstance(schema, str) and schema.lstrip(".") in self.schema.types:
+            schema = self.schema.get_type_schema(schema)
+
+        type_name = schema["type"] if isinstance(schema, dict) else schema
+        if type_name not in ENCODERS:
+            raise ValueError("Field {} can not be encoded from a column".format(field["name"]))
+
+        return type_name, null_index, schema
+
+    def encode(self, columns, masks=None):
+        """Encodes columns of records. `columns` maps field names to numpy arrays or sequences
+        of values. Null values of nullable fields are given by a boolean array in `masks`, by
+        masked arrays or by `None` values in sequences.
+
+        Returns the number of records and the encoded records as a memoryview.
+        """
+        masks = masks or {}
+
+        count = None
+        parts = []
+        for name, type_name, null_index, schema in self.fields:
+            values, mask = _column_values(columns[name], masks.get(name))
+            if count is None:
+                count = len(values)
+            elif len(values) != count:
+                raise ValueError("Column {} has {} values instead of {}".format(name, len(values), count))
+
+            if mask is not None and null_index is None:
+                if mask.any():
+                    raise ValueError("Column {} is not nullable".format(name))
+
+                mask = None
+
+            if null_index is not None:
+                if mask is None:
+                    mask = numpy.zeros(count, dtype=bool)
+
+                # the branch index is a single byte, 0 or 2 for the branches 0 and 1
+                branches = numpy.where(mask, null_index, 1 - null_index).astype(numpy.uint8) << 1
+                parts.append((branches, numpy.ones(count, dtype=numpy.int64)))
+
+                values = values[~mask]
+
+            for data, lengths in ENCODERS[type_name](values, schema):
+                if mask is not None:
+                    # null values have no data
+                    full_lengths = numpy.zeros(count, dtype=numpy.int64)
+                    full_lengths[~mask] = lengths
+                    lengths = full_lengths
+
+                parts.append((data, lengths))
+
+        return count or 0, memoryview(_interleave(parts, count or 0))
+
+
+def _column_values(values, mask):
+    """Converts a column to a numpy array and a mask of null values or None."""
+    if mask is not None:
+        mask = numpy.asarray(mask, dtype=bool)
+
+    if numpy.ma.isMaskedArray(values):
+        if mask is None:
+            mask = numpy.ma.getmaskarray(values)
+
+        values = values.data
+
+    elif not isinstance(values, numpy.ndarray):
+        values = list(values)
+        if mask is None and any(value is None for value in values):
+            mask = numpy.array([value is None for value in values], dtype=bool)
+
+        array = numpy.empty(len(values), dtype=object)
+        array[:] = values
+        values = array
+
+    return values, mask
+
+
+def _interleave(parts, count):
+    """Interleaves the encoded parts of all columns into records. Each part is a tuple of the
+    encoded data of all records and the length of the data of each record."""
+    if count and all(lengths[0] == lengths.min() == lengths.max() for _, lengths in parts):
+        return _interleave_fixed_size(parts, count)
+
+    sizes = numpy.zeros(count, dtype=numpy.int64)
+    for _, lengths in parts:
+        sizes += lengths
+
+    # offset directly behind each record in the output
+    record_ends = numpy.cumsum(sizes)
+    out = numpy.empty(int(record_ends[-1]) if count else 0, dtype=numpy.uint8)
+
+    # the records are interleaved in chunks of about CHUNK_SIZE bytes, as the
+    # scatter needs several int64 positions for each byte of the chunk.
+    cursors = [0] * len(parts)
+    start = 0
+    while start < count:
+        chunk_start = int(record_ends[start] - sizes[start])
+        end = max(int(numpy.searchsorted(record_ends, chunk_start + CHUNK_SIZE, side="right")), start + 1)
+
+        # offset of the current part in each record of the chunk
+        part_offsets = record_ends[start:end] - sizes[start:end]
+        for idx, (data, lengths) in enumerate(parts):
+            lengths = lengths[start:end]
+            size = int(lengths.sum())
+            if size:
+                source_offsets = numpy.cumsum(lengths) - lengths
+                positions = numpy.arange(size, dtype=numpy.int64) - numpy.repeat(source_offsets, lengths)
+                out[numpy.repeat(part_offsets, lengths) + positions] = data[cursors[idx]:cursors[idx] + size]
+                cursors[idx] += size
+
+            part_offsets = part_offsets + lengths
+
+        start = end
+
+    return out
+
+
+def _interleave_fixed_size(parts, count):
+    """Interleaves parts with the same length in all records by copying
+    each part into its columns of a two dimensional array of records."""
+    widths = [int(lengths[0]) for _, lengths in parts]
+    out = numpy.empty((count, sum(widths)), dtype=numpy.uint8)
+
+    offset = 0
+    for (data, _), width in zip(parts, widths):
+        out[:, offset:offset + width] = numpy.asarray(data, dtype=numpy.uint8).reshape(count, width)
+        offset += width
+
+    return out.reshape(-1)
+
+
+def encode_varints(values):
+    """Encodes an array of integers as zigzag varints. Returns the encoded data and the length of each value."""
+    values = numpy.asarray(values, dtype=numpy.int64)
+    zigzag = ((values << 1) ^ (values >> 63)).view(numpy.uint64)
+
+    lengths = numpy.ones(len(values), dtype=numpy.int64)
+    for idx in range(1, 10):
+        lengths += zigzag >= numpy.uint64(1 << (7 * idx))
+
+    width = int(lengths.max()) if len(values) else 1
+    shifts = numpy.arange(width, dtype=numpy.uint64) * numpy.uint64(7)
+    groups = (zigzag[:, None] >> shifts[None, :]) & numpy.uint64(0x7F)
+
+    # all groups but the last of each value have the continuation bit set
+    group_indices = numpy.arange(width)[None, :]
+    groups |= (group_indices < (lengths[:, None] - 1)).astype(numpy.uint64) << numpy.uint64(7)
+
+    return groups.astype(numpy.uint8)[group_indices < lengths[:, None]], lengths
+
+
+def _encode_fixed_size(dtype):
+    def encode(values, schema):
+        data = numpy.ascontiguousarray(values, dtype=dtype).view(numpy.uint8)
+        yield data, numpy.full(len(values), numpy.dtype(dtype).itemsize, dtype=numpy.int64)
+
+    return encode
+
+
+def _encode_long(values, schema):
+    yield encode_varints(values)
+
+
+def _encode_bytes(values, schema):
+    if len(values) and isinstance(values[0], str):
+        values = [value.encode("utf8") for value in values]
+
+    lengths = numpy.fromiter((len(value) for value in values), dtype=numpy.int64, count=len(values))
+    yield encode_varints(lengths)
+    yield numpy.frombuffer(b"".join(values), dtype=numpy.uint8), lengths
+
+
+def _encode_enum(values, schema):
+    if values.dtype.kind not in "iu":
+        indices = {symbol: idx for idx, symbol in enumerate(schema["symbols"])}
+        try:
+            values = [indices[value] for value in values]
+        except KeyError as error:
+            raise ValueError("Invalid enum symbol: {}".format(error.args[0]))
+
+    yield encode_varints(values)
+
+
+def _encode_fixed(values, schema):
+    size = schema["size"]
+    if isinstance(values, numpy.ndarray) and values.dtype == numpy.uint8 and values.ndim == 2:
+        data = values.reshape(-1)
+    else:
+        data = numpy.frombuffer(b"".join(values), dtype=numpy.uint8)
+
+    if len(data) != size * len(values):
+        raise ValueError("Invalid length for 'write fixed'")
+
+    yield data, numpy.full(len(values), size, dtype=numpy.int64)
+
+
+# functions to encode columns of a type, each yields one or more parts of encoded data
+ENCODERS = {
+    "boolean": _encode_fixed_size("?"),
+    "int": _encode_long,
+    "long": _encode_long,
+    "float": _encode_fixed_size("<f4"),
+    "double": _encode_fixed_size("<f8"),
+    "string": _encode_bytes,
+    "bytes": _encode_bytes,
+    "enum": _encode_enum,
+    "fixed": _encode_fixed,
+}
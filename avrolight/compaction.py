@@ -0,0 +1,175 @@
+"""
+This file contains functions to merge and split avro container files.
+
+The blocks of the files are copied as they are, if possible. Blocks are only decompressed
+if the codec of the target file differs or small blocks are combined into larger ones,
+and records are only decoded if the schema of a file differs from the target schema.
+"""
+
+import os
+from contextlib import contextmanager
+from itertools import chain
+
+from avrolight.codecs import get_codec
+from avrolight.compiler import compile_skipper
+from avrolight.container import Block, ContainerReader, ContainerWriter
+from avrolight.io import Reader
+from avrolight.schema import Schema
+
+__all__ = ("merge_containers", "split_container")
+
+NULL_CODEC = get_codec("null")
+
+
+def merge_containers(sources, fp, schema=None, codec=None, block_size=None):
+    """Merges the container files given as paths or file-like objects into one
+    container file written to `fp`. Returns the number of records written.
+
+    The schema and the codec of the first source are used, unless a `schema` or a `codec`
+    is given. Records of sources with another schema are resolved to the schema of the
+    merged file, see :mod:`avrolight.resolution`.
+
+    If `block_size` is given, consecutive blocks smaller than `block_size` bytes are
+    combined into blocks of at least `block_size` uncompressed bytes. This is useful when
+    compacting many small files, but requires decompressing those blocks.
+    """
+    readers = _open_readers(sources)
+    first = next(readers, None)
+    if first is None and schema is None:
+        raise ValueError("A schema is required to merge zero containers")
+
+    records = 0
+    with ContainerWriter(fp, schema if schema is not None else first.schema,
+                         codec=codec or (first.codec if first is not None else "null")) as writer:
+        blocks = _merged_blocks(chain([first] if first is not None else [], readers), writer)
+        if block_size:
+            blocks = _combined_blocks(blocks, block_size)
+
+        for block in blocks:
+            writer.write_block(block)
+            records += block.count
+
+    return records
+
+
+def split_container(source, open_target, max_bytes=None, max_records=None, codec=None):
+    """Splits a container file given as path or file-like object into several container
+    files. Returns the number of files written.
+
+    `open_target` is called with the number of each file, starting at zero, and returns a
+    writable file-like object, which is closed after the file is written. Each file
+    contains at most `max_records` records and at most `max_bytes` bytes of block data,
+    unless a single block is larger. Blocks are split to meet `max_records` exactly.
+
+    The files use the codec of the source, unless a `codec` is given.
+    """
+    if not max_bytes and not max_records:
+        raise ValueError("Either max_bytes or max_records is required")
+
+    with _open_reader(source) as reader:
+        skip = compile_skipper(Schema(reader.schema)) if max_records else None
+
+        parts = 0
+        target = writer = None
+        for block in reader.iter_blocks():
+            while block is not None:
+                if writer is not None and max_bytes and size and size + block.size > max_bytes:
+                    _close(writer, target)
+                    writer = None
+
+                if writer is None:
+                    target = open_target(parts)
+                    writer = ContainerWriter(target, reader.schema, codec=codec or reader.codec)
+                    parts += 1
+                    size = records = 0
+
+                if max_records and records + block.count > max_records:
+                    head, block = _split_block(block, max_records - records, skip)
+                else:
+                    head, block = block, None
+
+                writer.write_block(head)
+                size += head.size
+                records += head.count
+
+                if max_records and records >= max_records:
+                    _close(writer, target)
+                    writer = None
+
+        if writer is not None:
+            _close(writer, target)
+
+    return parts
+
+
+@contextmanager
+def _open_reader(source):
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, "rb") as fp:
+            yield ContainerReader(fp)
+    else:
+        yield ContainerReader(source)
+
+
+def _open_readers(sources):
+    for source in sources:
+        with _open_reader(source) as reader:
+            yield reader
+
+
+def _merged_blocks(readers, writer):
+    for reader in readers:
+        if reader.schema == writer.schema.json:
+            yield from reader.iter_blocks()
+        else:
+            yield from _resolved_blocks(reader, writer)
+
+
+def _resolved_blocks(reader, writer):
+    """Re-encodes the blocks of the reader using the schema of the writer."""
+    resolver = Reader(writer.schema, writer_schema=reader.schema)
+    for block in reader.iter_blocks():
+        data = block.decompress()
+
+        buf, pos = bytearray(), 0
+        for _ in range(block.count):
+            value, pos = resolver.decode(data, pos)
+            writer.writer.encode(value, buf)
+
+        yield Block(block.count, buf, NULL_CODEC)
+
+
+def _combined_blocks(blocks, block_size):
+    count, buf = 0, bytearray()
+    for block in blocks:
+        # large blocks are copied as they are
+        if not count and block.size >= block_size:
+            yield block
+            continue
+
+        # records are self-delimiting, so the data of blocks can be concatenated
+        buf += block.decompress()
+        count += block.count
+        if len(buf) >= block_size:
+            yield Block(count, buf, NULL_CODEC)
+            count, buf = 0, bytearray()
+
+    if count:
+        yield Block(count, buf, NULL_CODEC)
+
+
+def _split_block(block, count, skip):
+    """Splits a block into a block with the first `count` records and a block
+    with the remaining records. The records are skipped without decoding them."""
+    data = block.decompress()
+
+    pos = 0
+    for _ in range(count):
+        pos = skip(data, pos)
+
+    return Block(count, data[:pos], NULL_CODEC), Block(block.count - count, data[pos:], NULL_CODEC)
+
+
+def _close(writer, target):
+    writer.close()
+    target.close()
@@ -0,0 +1,601 @@
+"""
+This file compiles schemas into trees of specialized functions to read, write
+and skip avro packed data. The schema is walked only once, named and recursive
+types are resolved at compile time, so reading or writing a value does not need
+to inspect the schema anymore.
+"""
+
+from avrolight.io import PRIMITIVE_DECODERS, PRIMITIVE_ENCODERS, PRIMITIVE_SKIPPERS, TYPES
+from avrolight.io import decode_long, decode_string, decode_bytes_view, encode_long, encode_string
+from avrolight.records import Record
+
+
+def compile_decoder(schema, fields=None, zero_copy=False, record_classes=None):
+    """Compiles a :class:`avrolight.schema.Schema` into a function that
+    decodes one value of the toplevel type from a bytes-like object. The function
+    is called with the buffer and an offset and returns the value and the offset
+    directly behind the value.
+
+    If `fields` is given, only the fields with the given paths are decoded, see
+    :func:`projection`. All other fields are skipped without decoding them.
+
+    If `zero_copy` is `True`, bytes and fixed values are returned as slices of the buffer.
+
+    If `record_classes` is given, records are decoded into instances of the classes
+    mapped to their type names instead of dicts, see :attr:`avrolight.schema.Schema.record_classes`.
+    It can not be combined with `fields`.
+
+    You normally do not need to call this directly, use :attr:`avrolight.schema.Schema.decoder`,
+    which caches the compiled function on the schema.
+    """
+    if fields is not None and record_classes is not None:
+        raise ValueError("Projections can not be combined with record classes")
+
+    compiler = DecoderCompiler(schema, projection(fields) if fields is not None else None, zero_copy, record_classes)
+    return compiler.compile(schema.toplevel_type)
+
+
+def compile_skipper(schema):
+    """Compiles a :class:`avrolight.schema.Schema` into a function that skips
+    over one value of the toplevel type in a bytes-like object. The function is
+    called with the buffer and an offset and returns the offset directly behind the value.
+    """
+    return SkipCompiler(schema).compile(schema.toplevel_type)
+
+
+def projection(fields):
+    """Builds a projection from a list of field paths like `["id", "user.name"]`.
+    Path components are field names of records, unions, arrays and maps are passed
+    through to the records they contain. Fields not found in the schema are ignored.
+
+    The projection is a sorted tuple of (field name, projection) pairs, where
+    the projection of a field is `None` if the field is decoded completely.
+    """
+    tree = {}
+    for path in fields:
+        node = tree
+        *parents, name = path.split(".")
+        for parent in parents:
+            if parent in node and node[parent] is None:
+                break
+
+            node = node.setdefault(parent, {})
+        else:
+            node[name] = None
+
+    def freeze(node):
+        return tuple(sorted((name, freeze(child) if child is not None else None) for name, child in node.items()))
+
+    return freeze(tree)
+
+
+def compile_encoder(schema):
+    """Compiles a :class:`avrolight.schema.Schema` into a function that
+    encodes one value of the toplevel type. The function is called with
+    a bytearray and the value and appends the encoded value to the bytearray.
+
+    You normally do not need to call this directly, use :attr:`avrolight.schema.Schema.encoder`,
+    which caches the compiled function on the schema.
+    """
+    return EncoderCompiler(schema).compile(schema.toplevel_type)
+
+
+def packed_long(value):
+    """Returns the encoded bytes of a long value."""
+    buf = bytearray()
+    encode_long(buf, value)
+    return bytes(buf)
+
+
+def compile_recursive(named, key, compile):
+    """Calls `compile` to compile a named type and stores the result in `named` under `key`.
+
+    A trampoline is registered first, so that recursive references to
+    the type can be compiled before the type itself is finished."""
+    cell = []
+    named[key] = lambda *args: cell[0](*args)
+
+    compiled = compile()
+    cell.append(compiled)
+    named[key] = compiled
+    return compiled
+
+
+def array_decoder(decode_item):
+    """Returns a function that decodes the blocks of an array using the given item decoder."""
+    def decode_array(buf, pos):
+        result = []
+        append = result.append
+        while True:
+            count, pos = decode_long(buf, pos)
+            if not count:
+                return result, pos
+
+            # a negative count is followed by the size of the block in bytes
+            if count < 0:
+                count = -count
+                _, pos = decode_long(buf, pos)
+
+            for _ in range(count):
+                item, pos = decode_item(buf, pos)
+                append(item)
+
+    return decode_array
+
+
+def map_decoder(decode_value):
+    """Returns a function that decodes the blocks of a map using the given value decoder."""
+    def decode_map(buf, pos):
+        result = {}
+        while True:
+            count, pos = decode_long(buf, pos)
+            if not count:
+                return result, pos
+
+            if count < 0:
+                count = -count
+                _, pos = decode_long(buf, pos)
+
+            for _ in range(count):
+                key, pos = decode_string(buf, pos)
+                result[key], pos = decode_value(buf, pos)
+
+    return decode_map
+
+
+class Compiler(object):
+    """Base class for the decoder and encoder compilers. Subclasses provide the
+    functions for the primitive types and a `compile_*` method for each complex type."""
+
+    primitives = {}
+
+    def __init__(self, schema):
+        self.schema = schema
+
+        # maps type names to the compiled functions of named types.
+        self.named = {}
+
+        # maps type names to the schema of named types.
+        self.types = {}
+
+        self.compilers = {
+            "record": self.compile_record,
+            "error": self.compile_record,
+            "enum": self.compile_enum,
+            "array": self.compile_array,
+            "map": self.compile_map,
+            "fixed": self.compile_fixed,
+        }
+
+    def compile(self, schema):
+        """Compiles the given (sub-)schema into a function."""
+        if isinstance(schema, (list, tuple)):
+            return self.compile_union(schema)
+
+        if isinstance(schema, dict):
+            field_type = schema["type"]
+            if isinstance(field_type, str) and field_type in self.compilers:
+                return self.compile_named(schema, self.compilers[field_type])
+
+            # something like {"type": "long"} or {"type": ["null", "long"]}
+            return self.compile(field_type)
+
+        if schema in self.primitives:
+            return self.primitives[schema]
+
+        return self.compile_reference(schema)
+
+    def compile_named(self, schema, compiler):
+        name = schema.get("name")
+        if name is None:
+            return compiler(schema)
+
+        name = name.lstrip(".")
+        self.types[name] = schema
+        return compile_recursive(self.named, self.named_key(name), lambda: compiler(schema))
+
+    def compile_reference(self, name):
+        name = name.lstrip(".")
+        try:
+            return self.named[self.named_key(name)]
+        except KeyError:
+            return self.compile(self.types.get(name) or self.schema.get_type_schema(name))
+
+    # noinspection PyMethodMayBeStatic
+    def named_key(self, name):
+        """The key of a named type in :attr:`named`."""
+        return name
+
+    def type_name(self, schema):
+        """Returns the avro type name of the given (sub-)schema with
+        references to named types resolved, e.g. 'record' or 'long'."""
+        if isinstance(schema, (list, tuple)):
+            return "union"
+
+        if isinstance(schema, dict):
+            return self.type_name(schema["type"])
+
+        if schema in self.primitives or schema in self.compilers:
+            return schema
+
+        name = schema.lstrip(".")
+        return self.type_name(self.types.get(name) or self.schema.get_type_schema(name))
+
+
+class DecoderCompiler(Compiler):
+    primitives = PRIMITIVE_DECODERS
+
+    def __init__(self, schema, projection=None, zero_copy=False, record_classes=None):
+        super().__init__(schema)
+
+        # maps type names of records to the classes they are decoded into
+        self.record_classes = record_classes or {}
+
+        # the projection of the value that is currently compiled, see projection()
+        self.projection = projection
+
+        self.zero_copy = zero_copy
+        if zero_copy:
+            self.primitives = dict(PRIMITIVE_DECODERS, bytes=decode_bytes_view)
+
+        self.skipper = SkipCompiler(schema)
+        self.skipper.types = self.types
+
+    def named_key(self, name):
+        return name, self.projection
+
+    def compile_union(self, schema):
+        branches = tuple(self.compile(branch) for branch in schema)
+
+        def decode_union(buf, pos):
+            index, pos = decode_long(buf, pos)
+            return branches[index](buf, pos)
+
+        return decode_union
+
+    def compile_record(self, schema):
+        if self.projection is not None:
+            return self.compile_projected_record(schema)
+
+        record_class = self.record_classes.get(schema.get("name", "").lstrip("."))
+        if record_class is not None:
+            return self.compile_class_record(schema, record_class)
+
+        fields = tuple((field["name"], self.compile(field["type"])) for field in schema["fields"])
+
+        def decode_record(buf, pos):
+            result = {}
+            for name, decode in fields:
+                result[name], pos = decode(buf, pos)
+
+            return result, pos
+
+        return decode_record
+
+    def compile_class_record(self, schema, record_class):
+        # the values are stored directly into the slots of a new instance,
+        # without calling __init__ of the class
+        new = object.__new__
+        steps = tuple((getattr(record_class, field["name"]).__set__, self.compile(field["type"]))
+                      for field in schema["fields"])
+
+        def decode_record(buf, pos):
+            result = new(record_class)
+            for set_value, decode in steps:
+                value, pos = decode(buf, pos)
+                set_value(result, value)
+
+            return result, pos
+
+        return decode_record
+
+    def compile_projected_record(self, schema):
+        projection = self.projection
+        projected = dict(projection)
+
+        # decode steps as (name, decoder) pairs, skipped fields have no name
+        steps = []
+        for field in schema["fields"]:
+            name = field["name"]
+            if name not in projected:
+                steps.append((None, self.skipper.compile(field["type"])))
+                continue
+
+            self.projection = projected[name]
+            try:
+                steps.append((name, self.compile(field["type"])))
+            finally:
+                self.projection = projection
+
+        steps = tuple(steps)
+
+        def decode_record(buf, pos):
+            result = {}
+            for name, decode in steps:
+                if name is None:
+                    pos = decode(buf, pos)
+                else:
+                    result[name], pos = decode(buf, pos)
+
+            return result, pos
+
+        return decode_record
+
+    # noinspection PyMethodMayBeStatic
+    def compile_enum(self, schema):
+        symbols = tuple(schema["symbols"])
+
+        def decode_enum(buf, pos):
+            index, pos = decode_long(buf, pos)
+            return symbols[index], pos
+
+        return decode_enum
+
+    def compile_fixed(self, schema):
+        size = schema["size"]
+
+        if self.zero_copy:
+            def decode_fixed_view(buf, pos):
+                end = pos + size
+                if end > len(buf):
+                    raise EOFError()
+
+                return buf[pos:end], end
+
+            return decode_fixed_view
+
+        def decode_fixed(buf, pos):
+            end = pos + size
+            if end > len(buf):
+                raise EOFError()
+
+            return bytes(buf[pos:end]), end
+
+        return decode_fixed
+
+    def compile_array(self, schema):
+        return array_decoder(self.compile(schema["items"]))
+
+    def compile_map(self, schema):
+        return map_decoder(self.compile(schema["values"]))
+
+
+class SkipCompiler(Compiler):
+    primitives = PRIMITIVE_SKIPPERS
+
+    def compile_union(self, schema):
+        branches = tuple(self.compile(branch) for branch in schema)
+
+        def skip_union(buf, pos):
+            index, pos = decode_long(buf, pos)
+            return branches[index](buf, pos)
+
+        return skip_union
+
+    def compile_record(self, schema):
+        fields = tuple(self.compile(field["type"]) for field in schema["fields"])
+
+        def skip_record(buf, pos):
+            for skip in fields:
+                pos = skip(buf, pos)
+
+            return pos
+
+        return skip_record
+
+    # noinspection PyMethodMayBeStatic
+    def compile_enum(self, schema):
+        return PRIMITIVE_SKIPPERS["long"]
+
+    # noinspection PyMethodMayBeStatic
+    def compile_fixed(self, schema):
+        size = schema["size"]
+
+        def skip_fixed(buf, pos):
+            end = pos + size
+            if end > len(buf):
+                raise EOFError()
+
+            return end
+
+        return skip_fixed
+
+    def compile_array(self, schema):
+        return self.compile_blocks(self.compile(schema["items"]))
+
+    def compile_map(self, schema):
+        skip_key = PRIMITIVE_SKIPPERS["string"]
+        skip_value = self.compile(schema["values"])
+
+        def skip_entry(buf, pos):
+            return skip_value(buf, skip_key(buf, pos))
+
+        return self.compile_blocks(skip_entry)
+
+    # noinspection PyMethodMayBeStatic
+    def compile_blocks(self, skip_item):
+        def skip_blocks(buf, pos):
+            while True:
+                count, pos = decode_long(buf, pos)
+                if not count:
+                    return pos
+
+                if count < 0:
+                    # the block size is given, jump over the whole block
+                    size, pos = decode_long(buf, pos)
+                    pos += size
+                    continue
+
+                for _ in range(count):
+                    pos = skip_item(buf, pos)
+
+        return skip_blocks
+
+
+class EncoderCompiler(Compiler):
+    primitives = PRIMITIVE_ENCODERS
+
+    def compile_union(self, schema):
+        type_names = [self.type_name(branch) for branch in schema]
+        encoders = [self.compile(branch) for branch in schema]
+
+        # the encoded branch index followed by the encoder of the branch,
+        # indexed by the avro type name. The first branch of a type wins.
+        branches = {}
+        for index, type_name in reversed(list(enumerate(type_names))):
+            branches[type_name] = (packed_long(index), encoders[index])
+
+        # python types in the order in which they are tried for a value
+        candidates = tuple(
+            (python_type, branches[type_name])
+            for python_type, type_name in TYPES
+            if type_name in branches)
+
+        def choose_value_branch(value):
+            if value is None and "null" in branches:
+                return branches["null"]
+
+            for python_type, branch in candidates:
+                if isinstance(value, python_type):
+                    return branch
+
+            raise ValueError("Could not guess union value type")
+
+        # lookup table for the exact type of a value. Subclasses of the known types
+        # are resolved once using isinstance checks and added to the table afterwards.
+        table = {}
+        if "null" in branches:
+            table[type(None)] = branches["null"]
+
+        for python_type, branch in reversed(candidates):
+            table[python_type] = branch
+
+        # instances of generated record classes are matched by the name of their type
+        records = {}
+        record_fields = []
+        for index, branch in enumerate(schema):
+            record = self.record_schema(branch)
+            if record is not None:
+                records.setdefault(record["name"].lstrip("."), (packed_long(index), encoders[index]))
+                record_fields.append((frozenset(field["name"] for field in record["fields"]),
+                                      (packed_long(index), encoders[index])))
+
+        def choose_record_branch(value):
+            keys = value.keys()
+
+            # the record with exactly the keys of the dict, else the last one with all of its fields
+            # present in the dict. The last record branch is used if none matches, like write_any does.
+            for fields, branch in record_fields:
+                if fields == keys:
+                    return branch
+
+            for fields, branch in reversed(record_fields):
+                if fields <= keys:
+                    return branch
+
+            return record_fields[-1][1]
+
+        # dicts can not be dispatched by their type if there are several record branches
+        ambiguous_dicts = len(record_fields) > 1 and "record" in branches
+        if ambiguous_dicts:
+            table.pop(dict, None)
+
+        def choose_branch(value):
+            if isinstance(value, Record) and value.__avro_name__ in records:
+                return records[value.__avro_name__]
+
+            if ambiguous_dicts and isinstance(value, dict):
+                return choose_record_branch(value)
+
+            return choose_value_branch(value)
+
+        def encode_union(buf, value):
+            try:
+                prefix, encode = table[type(value)]
+            except KeyError:
+                prefix, encode = choose_branch(value)
+                if not (ambiguous_dicts and isinstance(value, dict)):
+                    table[type(value)] = prefix, encode
+
+            buf += prefix
+            encode(buf, value)
+
+        return encode_union
+
+    def compile_record(self, schema):
+        fields = tuple((field["name"], self.compile(field["type"])) for field in schema["fields"])
+
+        def encode_record(buf, value):
+            if isinstance(value, Record):
+                for name, encode in fields:
+                    encode(buf, getattr(value, name))
+            else:
+                for name, encode in fields:
+                    encode(buf, value[name])
+
+        return encode_record
+
+    def record_schema(self, schema):
+        """Returns the schema of the record type if the given (sub-)schema is one."""
+        if isinstance(schema, dict):
+            if schema["type"] in ("record", "error"):
+                return schema
+
+            return self.record_schema(schema["type"])
+
+        if isinstance(schema, str) and schema not in self.primitives and schema not in self.compilers:
+            name = schema.lstrip(".")
+            return self.record_schema(self.types.get(name) or self.schema.get_type_schema(name))
+
+        return None
+
+    # noinspection PyMethodMayBeStatic
+    def compile_enum(self, schema):
+        indices = {symbol: packed_long(idx) for idx, symbol in enumerate(schema["symbols"])}
+
+        def encode_enum(buf, value):
+            try:
+                buf += indices[value]
+            except KeyError:
+                raise ValueError("Invalid enum symbol: {}".format(value))
+
+        return encode_enum
+
+    # noinspection PyMethodMayBeStatic
+    def compile_fixed(self, schema):
+        size = schema["size"]
+
+        def encode_fixed(buf, value):
+            if len(value) != size:
+                raise ValueError("Invalid length for 'write fixed'")
+
+            buf += value
+
+        return encode_fixed
+
+    def compile_array(self, schema):
+        encode_item = self.compile(schema["items"])
+
+        def encode_array(buf, array):
+            if array:
+                encode_long(buf, len(array))
+                for value in array:
+                    encode_item(buf, value)
+
+            buf.append(0)
+
+        return encode_array
+
+    def compile_map(self, schema):
+        encode_value = self.compile(schema["values"])
+
+        def encode_map(buf, mapping):
+            if mapping:
+                encode_long(buf, len(mapping))
+                for key, value in mapping.items():
+                    encode_string(buf, key)
+                    encode_value(buf, value)
+
+            buf.append(0)
+
+        return encode_map
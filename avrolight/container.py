@@ -1,9 +1,18 @@
-import json
+import mmap
 import os
-from io import BytesIO
+import queue
+import threading
+from bisect import bisect_right
+from functools import partial
+from itertools import islice
 
+from cached_property import cached_property
+
+from avrolight.codecs import get_codec
+from avrolight.compiler import compile_skipper
 from avrolight.io import Reader, read_long
-from avrolight.io import Writer, write_long
+from avrolight.io import Writer, encode_long
+from avrolight.schema import Schema
 import avrolight.json as json
 
 HEADER_SCHEMA = {
@@ -16,24 +25,203 @@ HEADER_SCHEMA = {
     ]
 }
 
+INDEX_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "record",
+        "name": "avrolight.BlockIndexEntry",
+        "fields": [
+            {"name": "count", "type": "long"},
+            {"name": "offset", "type": "long"},
+        ]
+    }
+}
+
 
-def _iter_records(fp, schema, sync_marker):
-    reader = Reader(schema)
+def _iter_blocks(fp, sync_marker, view=None):
+    """Iterates over the blocks of a container file and yields the
+    number of records and the data of each block.
+
+    If a memoryview of the whole file is given, the data of the blocks
+    is sliced from the view instead of being read from the file."""
     while True:
         try:
             count = read_long(fp)
         except EOFError:
             break
 
-        # skip the block size, we dont need that
-        read_long(fp)
+        size = read_long(fp)
+        if view is None:
+            data = fp.read(size)
+        else:
+            start = fp.tell()
+            data = view[start:start + size]
+            fp.seek(start + size)
 
-        for _ in range(count):
-            yield reader.read(fp)
+        if len(data) != size:
+            raise EOFError()
 
         if fp.read(16) != sync_marker:
             raise IOError("sync marker expected")
 
+        yield count, data
+
+
+def _tell(fp):
+    """Returns the position of the file-like object, or `None` if
+    the file-like object does not support it."""
+    try:
+        return fp.tell()
+    except (AttributeError, IOError):
+        return None
+
+
+def _iter_records(fp, reader, sync_marker, codec, view=None, stats=None, skip=None, skipped=0):
+    """Yields the records of the remaining blocks of the file. The first `skipped`
+    records of the first block are skipped using the `skip` function without decoding them."""
+    for count, data in _iter_blocks(fp, sync_marker, view):
+        start = stats.clock() if stats is not None else None
+
+        data = codec.decompress(data)
+        if reader.zero_copy:
+            data = memoryview(data)
+
+        pos = 0
+        for _ in range(skipped):
+            pos = skip(data, pos)
+
+        count, skipped = count - skipped, 0
+
+        if stats is not None:
+            yield from _iter_counted_records(reader, data, pos, count, stats, stats.clock() - start)
+            continue
+
+        for _ in range(count):
+            value, pos = reader.decode(data, pos)
+            yield value
+
+
+def _iter_counted_records(reader, data, pos, count, stats, duration):
+    """Yields the records of a decompressed block and counts the block once the iteration
+    over it ends. Only the records yielded and the time spent decoding them are counted."""
+    clock, begin, yielded = stats.clock, pos, 0
+    try:
+        for _ in range(count):
+            start = clock()
+            value, pos = reader.decode(data, pos)
+            duration += clock() - start
+
+            yielded += 1
+            yield value
+
+    finally:
+        stats.count_block(yielded, pos - begin, duration)
+
+
+class Block(object):
+    def __init__(self, count, data, codec, offset=None):
+        """A block of a container file as it is stored in the file.
+
+        `data` contains the `count` records of the block, compressed using the
+        given :class:`avrolight.codecs.Codec`. `offset` is the position of the
+        block in the file it was read from, if known.
+        """
+        self.count = count
+        self.data = data
+        self.codec = codec
+        self.offset = offset
+
+    @property
+    def size(self):
+        """The size of the compressed data in bytes."""
+        return len(self.data)
+
+    def decompress(self):
+        return self.codec.decompress(self.data)
+
+    def __repr__(self):
+        return "Block(count={}, size={}, codec={!r}, offset={})".format(
+            self.count, self.size, self.codec.name, self.offset)
+
+
+class BlockIndex(object):
+    """Maps record numbers to the byte offsets of the blocks in a container file.
+
+    An index is built by scanning the block headers of a file, see :meth:`scan`, or by
+    a :class:`ContainerWriter` while writing the file. It can be stored in a sidecar
+    file next to the container file using :meth:`save` and :meth:`load`.
+    """
+    def __init__(self):
+        # number of the first record, number of records and offset of each block
+        self.starts = []
+        self.counts = []
+        self.offsets = []
+
+        self.record_count = 0
+
+    def append(self, count, offset):
+        """Adds a block with `count` records at the given offset to the index."""
+        self.starts.append(self.record_count)
+        self.counts.append(count)
+        self.offsets.append(offset)
+        self.record_count += count
+
+    def find(self, record):
+        """Returns the number of the first record and the offset of the
+        block that contains the record with the given number."""
+        if not 0 <= record < self.record_count:
+            raise IndexError("Record number out of range")
+
+        idx = bisect_right(self.starts, record) - 1
+        return self.starts[idx], self.offsets[idx]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def save(self, fp):
+        """Writes the index to the given file-like object."""
+        Writer(INDEX_SCHEMA).write(fp, [
+            {"count": count, "offset": offset}
+            for count, offset in zip(self.counts, self.offsets)
+        ])
+
+    @classmethod
+    def load(cls, fp):
+        """Reads an index from the given file-like object."""
+        index = cls()
+        for entry in Reader(INDEX_SCHEMA).read(fp):
+            index.append(entry["count"], entry["offset"])
+
+        return index
+
+    @classmethod
+    def scan(cls, fp, sync_marker, offset):
+        """Builds an index by scanning the block headers of a container file, starting with
+        the block at `offset`. The blocks are skipped without reading their data, so the
+        file-like object must be seekable. The position of the file is restored afterwards."""
+        index = cls()
+
+        position = fp.tell()
+        fp.seek(offset)
+        try:
+            while True:
+                offset = fp.tell()
+                try:
+                    count = read_long(fp)
+                except EOFError:
+                    break
+
+                size = read_long(fp)
+                fp.seek(size, os.SEEK_CUR)
+                if fp.read(16) != sync_marker:
+                    raise IOError("sync marker expected")
+
+                index.append(count, offset)
+        finally:
+            fp.seek(position)
+
+        return index
+
 
 class ContainerReader(object):
     """Class to read a avro container file.
@@ -48,9 +236,32 @@ class ContainerReader(object):
             for record in reader:
                 print(record)
 
+    Records of seekable files can also be accessed by number, e.g. `reader[1000]`,
+    `reader[-10:]` or using :meth:`seek_to_record`. This uses a :class:`BlockIndex`
+    of the file, which is built by scanning the block headers on first use if no
+    index is given.
+
+    If a list of field paths is given as `fields`, only those fields of the records
+    are decoded. If a `reader_schema` is given, the records are resolved from the schema
+    of the file to the reader schema. If `zero_copy` is `True`, bytes and fixed values
+    are returned as memoryviews of the block data. If `record_classes` is `True`, records
+    are decoded into instances of generated classes with `__slots__` instead of dicts.
+    See :class:`avrolight.io.Reader` for all of those.
+
+    If the file-like object is a :class:`mmap.mmap`, the data of the blocks is sliced from
+    the mapping instead of being copied, see :func:`open_container`.
+
+    If a :class:`avrolight.stats.Stats` instance is given as `stats`, the blocks, records and
+    uncompressed bytes of the records returned are counted, as well as the time spent on
+    decompressing and decoding each block. A block is counted once the iteration leaves it.
     """
-    def __init__(self, fp):
+    def __init__(self, fp, index=None, fields=None, reader_schema=None, zero_copy=False, record_classes=False,
+                 stats=None):
         self.fp = fp
+        self.stats = stats
+        self._owns_fp = False
+        self._index = index
+        self._view = memoryview(fp) if isinstance(fp, mmap.mmap) else None
 
         header = Reader(HEADER_SCHEMA).read(fp)
         if header["magic"] != b"Obj\x01":
@@ -62,41 +273,228 @@ class ContainerReader(object):
         self.schema_bytes = header["meta"]["avro.schema"]
         self.schema = json.loads(self.schema_bytes.decode("utf8"))
 
+        # the codec used to compress the blocks, see avrolight.codecs
+        self.codec = get_codec(header["meta"].get("avro.codec", b"null"))
+
+        # offset of the first block, if the file supports it
+        self.data_offset = _tell(fp)
+
         # create generator for the file
-        self._records = _iter_records(fp, self.schema, self.sync_marker)
+        if reader_schema is None:
+            self._reader = Reader(self.schema, fields, zero_copy=zero_copy, record_classes=record_classes)
+        else:
+            self._reader = Reader(reader_schema, fields, writer_schema=self.schema, zero_copy=zero_copy,
+                                  record_classes=record_classes)
+
+        self._records = _iter_records(fp, self._reader, self.sync_marker, self.codec, self._view, stats)
 
     def __iter__(self):
         return self._records
 
+    def __next__(self):
+        return next(self._records)
 
-def read_container(fp):
+    def close(self):
+        """Releases the resources of this reader. The file-like object is not closed,
+        unless it is the memory mapping opened by :func:`open_container`."""
+        if self._view is not None:
+            self._view.release()
+
+        if self._owns_fp:
+            try:
+                self.fp.close()
+            except BufferError:
+                # zero copy values still use the mapping. It is unmapped
+                # as soon as the last of them is garbage collected.
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def index(self):
+        """The :class:`BlockIndex` of this file."""
+        if self._index is None:
+            self._index = BlockIndex.scan(self.fp, self.sync_marker, self.data_offset)
+
+        return self._index
+
+    def __len__(self):
+        return self.index.record_count
+
+    def seek_to_record(self, record):
+        """Moves the iteration to the record with the given number. Negative
+        numbers count from the end of the file."""
+        if record < 0:
+            record += len(self)
+
+        self._records = self._iter_from(record)
+
+    def tail(self, count):
+        """Returns a list of the last `count` records of the file."""
+        return self[max(len(self) - count, 0):]
+
+    def __getitem__(self, key):
+        """Gets a record or a list of records by number or by slice.
+        The iteration position of this reader is not changed."""
+        position = self.fp.tell()
+        try:
+            if isinstance(key, slice):
+                indices = range(*key.indices(len(self)))
+                if not indices:
+                    return []
+
+                first, last = min(indices), max(indices)
+                records = list(islice(self._iter_from(first), last - first + 1))
+                return [records[idx - first] for idx in indices]
+
+            if key < 0:
+                key += len(self)
+
+            return next(self._iter_from(key))
+
+        finally:
+            self.fp.seek(position)
+
+    def iter_blocks(self):
+        """Iterates over the remaining blocks of the file and yields each block as
+        :class:`Block` without decompressing or decoding it. The blocks can be
+        written to another file using :meth:`ContainerWriter.write_block`."""
+        blocks = _iter_blocks(self.fp, self.sync_marker, self._view)
+        while True:
+            offset = _tell(self.fp)
+            try:
+                count, data = next(blocks)
+            except StopIteration:
+                return
+
+            yield Block(count, data, self.codec, offset)
+
+    def iter_columns(self, fields=None):
+        """Iterates over the remaining blocks of the file and decodes each block into a dict
+        of numpy arrays, one for each field. See :class:`avrolight.columnar.ColumnDecoder`
+        for the supported schemas. If a list of field names is given, only those fields
+        are decoded."""
+        from avrolight.columnar import ColumnDecoder
+        decoder = ColumnDecoder(self.schema, fields)
+
+        for count, data in _iter_blocks(self.fp, self.sync_marker, self._view):
+            yield decoder.decode(self.codec.decompress(data), count)
+
+    def iter_dataframes(self, fields=None):
+        """Like :meth:`iter_columns`, but decodes each block into a :class:`pandas.DataFrame`."""
+        from avrolight.columnar import ColumnDecoder
+        decoder = ColumnDecoder(self.schema, fields)
+
+        for count, data in _iter_blocks(self.fp, self.sync_marker, self._view):
+            yield decoder.decode_dataframe(self.codec.decompress(data), count)
+
+    def _iter_from(self, record):
+        start, offset = self.index.find(record)
+        self.fp.seek(offset)
+
+        # the records in front of the requested one are skipped without decoding them
+        return _iter_records(self.fp, self._reader, self.sync_marker, self.codec, self._view, self.stats,
+                             self._skipper, record - start)
+
+    @cached_property
+    def _skipper(self):
+        return compile_skipper(Schema(self.schema))
+
+
+def read_container(fp, index=None, fields=None, reader_schema=None, zero_copy=False, record_classes=False,
+                   stats=None):
     """Returns a new :class:`avrolight.container.ContainerReader` instance."""
-    return ContainerReader(fp)
+    return ContainerReader(fp, index=index, fields=fields, reader_schema=reader_schema, zero_copy=zero_copy,
+                           record_classes=record_classes, stats=stats)
+
+
+def open_container(path, zero_copy=False, **kwargs):
+    """Opens the container file at the given path using a memory mapping and
+    returns a :class:`avrolight.container.ContainerReader` for it.
+
+    The data of the blocks is not copied out of the mapping, so several processes reading
+    the same file share the page cache. If `zero_copy` is `True`, bytes and fixed values
+    are returned as memoryviews of the mapping for uncompressed files. Those memoryviews
+    keep the mapping open after the reader is closed. Further keyword arguments are passed
+    to the :class:`avrolight.container.ContainerReader`.
+    """
+    with open(path, "rb") as fp:
+        mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    reader = ContainerReader(mapping, zero_copy=zero_copy, **kwargs)
+    reader._owns_fp = True
+    return reader
 
-def append_to_container(fp):
+def append_to_container(fp, index=None, **kwargs):
     """Appends records to an already existing container.
 
     This will first read the schema from the container and then
     return a :class:`avro.container.ContainerWriter` that writes data to the end
-    of the file-like object.
+    of the file-like object. If `index` is `True`, the :class:`BlockIndex` of the
+    existing file is built and extended by the writer. An existing index can also be
+    passed directly. Further keyword arguments are passed to the writer.
     """
     # read data from existing container
-    reader = ContainerReader(fp)
+    reader = ContainerReader(fp, index=index if isinstance(index, BlockIndex) else None)
+    if index is True:
+        index = reader.index
 
     # create writer at the end of the file
     fp.seek(0, os.SEEK_END)
-    return ContainerWriter(fp, reader.schema, sync_marker=reader.sync_marker)
+    return ContainerWriter(fp, reader.schema, sync_marker=reader.sync_marker, codec=reader.codec, index=index,
+                           **kwargs)
 
 
 class ContainerWriter(object):
-    def __init__(self, fp, schema, sync_marker=None):
+    def __init__(self, fp, schema, sync_marker=None, codec="null", index=None,
+                 block_size=1024 ** 2, block_records=None, background=False, queue_size=2, stats=None):
+        """Creates a new writer for an avro container file.
+
+        The blocks of the container are compressed using the given codec. Pass
+        the name of a codec or a :class:`avrolight.codecs.Codec` instance. The
+        avro specification defines 'null', 'deflate', 'bzip2', 'xz', 'snappy'
+        and 'zstandard', see :mod:`avrolight.codecs` for the available ones.
+
+        A block is completed as soon as it contains `block_size` bytes of encoded records,
+        or `block_records` records, if given. If `background` is `True`, completed blocks are
+        compressed and written to the file-like object by a background thread while new
+        records are encoded. At most `queue_size` completed blocks wait for the background
+        thread, :meth:`write` blocks until there is room for another one. Errors of the
+        background thread are raised by the next call to :meth:`write` or :meth:`flush`.
+        Use the writer as a context manager or call :meth:`close` to stop the thread.
+
+        If `index` is `True` or a :class:`BlockIndex`, each block written is added to
+        :attr:`index`, which can be saved as a sidecar file afterwards. This requires
+        a file-like object that supports `tell()`.
+
+        If a :class:`avrolight.stats.Stats` instance is given as `stats`, the blocks, records
+        and compressed bytes written are counted, also for blocks copied by :meth:`write_block`,
+        as well as the time spent on compressing and writing each block and the number and
+        duration of flushes.
+        """
         self.writer = Writer(schema)
+        self.stats = stats
+        self.codec = get_codec(codec)
+        self.index = BlockIndex() if index is True else index
         self.fp = fp
         self.sync_marker = sync_marker or os.urandom(16)
         self.header_written = sync_marker is not None
 
+        self.block_size = block_size
+        self.block_records = block_records or float("inf")
+
         self.records = 0
-        self.buffer = BytesIO()
+        self.buffer = bytearray()
+        self._column_encoder = None
+
+        self.background = background
+        self._queue = queue.Queue(queue_size) if background else None
+        self._thread = None
+        self._error = None
 
     def write_header(self):
         assert not self.header_written, "Header is already written once"
@@ -105,7 +503,7 @@ class ContainerWriter(object):
             "magic": b"Obj\x01",
             "meta": {
                 "avro.schema": json.dumps(self.schema.json).encode("utf8"),
-                "avro.codec": b"null"
+                "avro.codec": self.codec.name.encode("utf8")
             },
             "sync": self.sync_marker
         })
@@ -113,28 +511,143 @@ class ContainerWriter(object):
         self.header_written = True
 
     def write(self, message):
-        self.writer.write(self.buffer, message)
+        self.writer.encode(message, self.buffer)
         self.records += 1
 
-        if self.buffer.tell() > 1024 ** 2:
-            self.flush()
+        if len(self.buffer) >= self.block_size or self.records >= self.block_records:
+            self._complete_block()
+
+    def write_columns(self, columns, masks=None):
+        """Writes a batch of records given as columns as one block.
+
+        `columns` maps field names to numpy arrays or sequences of values, `masks` maps
+        the names of nullable fields to boolean arrays that are `True` for null values.
+        See :class:`avrolight.columnar.ColumnEncoder` for details. Records written
+        using :meth:`write` before are flushed as a block of their own first.
+        """
+        if self._column_encoder is None:
+            from avrolight.columnar import ColumnEncoder
+            self._column_encoder = ColumnEncoder(self.schema)
+
+        count, data = self._column_encoder.encode(columns, masks)
+
+        self._complete_block()
+        if count:
+            self._submit(self._write_block, count, data)
+
+    def write_block(self, block):
+        """Writes a :class:`Block` read from another container file as it is. The records of
+        the block must match the schema of this writer. The data of the block is only
+        decompressed and compressed again if the codec of the block differs from the codec
+        of this writer. Records written using :meth:`write` before are flushed first.
+        """
+        self._complete_block()
+        if not block.count:
+            return
+
+        if block.codec.name == self.codec.name:
+            self._submit(self._write_compressed_block, block.count, block.data)
+        else:
+            self._submit(self._write_block, block.count, block.decompress())
 
     def flush(self):
+        """Writes the records written so far as a block, waits for the background
+        thread to write all completed blocks and flushes the file-like object."""
+        start = self.stats.clock() if self.stats is not None else None
+
+        self._complete_block()
+
+        if self._thread is not None:
+            self._queue.join()
+            self._raise_error()
+
+        self.fp.flush()
+
+        if start is not None:
+            self.stats.count_flush(self.stats.clock() - start)
+
+    def close(self):
+        """Flushes the writer and stops the background thread. The
+        file-like object is not closed."""
+        try:
+            self.flush()
+        finally:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+
+    def _complete_block(self):
         if not self.header_written:
             self.write_header()
-            self.header_written = True
 
         if not self.records:
             return
 
-        write_long(self.fp, self.records)
-        write_long(self.fp, self.buffer.tell())
-        self.fp.write(self.buffer.getbuffer())
-        self.fp.write(self.sync_marker)
-        self.fp.flush()
+        # the background thread owns the buffer from now on
+        self._submit(self._write_block, self.records, self.buffer)
 
         self.records = 0
-        self.buffer = BytesIO()
+        self.buffer = bytearray()
+
+    def _submit(self, write, count, data):
+        if self.stats is not None:
+            write = partial(self._count_block, write)
+
+        if not self.background:
+            write(count, data)
+            return
+
+        self._raise_error()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run_background, name="ContainerWriter", daemon=True)
+            self._thread.start()
+
+        self._queue.put((write, count, data))
+
+    def _run_background(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+
+                # after an error, the remaining blocks are dropped
+                if self._error is None:
+                    write, count, data = task
+                    write(count, data)
+
+            except BaseException as error:
+                self._error = error
+
+            finally:
+                self._queue.task_done()
+
+    def _count_block(self, write, count, data):
+        start = self.stats.clock()
+        size = write(count, data)
+        self.stats.count_block(count, size, self.stats.clock() - start)
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise IOError("Writing a block in the background failed") from self._error
+
+    def _write_block(self, count, data):
+        return self._write_compressed_block(count, self.codec.compress(data))
+
+    def _write_compressed_block(self, count, data):
+        """Writes a block of compressed data and returns the size of the data."""
+        block_header = bytearray()
+        encode_long(block_header, count)
+        encode_long(block_header, len(data))
+
+        if self.index is not None:
+            self.index.append(count, self.fp.tell())
+
+        self.fp.write(block_header)
+        self.fp.write(data)
+        self.fp.write(self.sync_marker)
+        return len(data)
 
     @property
     def schema(self):
@@ -145,6 +658,4 @@ class ContainerWriter(object):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.flush()
-
-    close = flush
+        self.close()
@@ -6,10 +6,16 @@ import binascii
 from functools import partial
 import struct
 
+from cached_property import cached_property
+
+from avrolight.records import Record
 from avrolight.schema import Schema
 
 BYTES = [bytearray((idx,)) for idx in range(256)]
 
+FLOAT = struct.Struct("<f")
+DOUBLE = struct.Struct("<d")
+
 
 def write_null(out, value):
     pass
@@ -29,11 +35,11 @@ def write_long(out, value):
 
 
 def write_float(out, value):
-    out.write(struct.pack(b"<f", value))
+    out.write(FLOAT.pack(value))
 
 
 def write_double(out, value):
-    out.write(struct.pack(b"<d", value))
+    out.write(DOUBLE.pack(value))
 
 
 def write_bytes(out, value):
@@ -45,6 +51,46 @@ def write_string(out, value):
     write_bytes(out, value.encode("utf8"))
 
 
+# The encode_* functions append a value to a bytearray.
+
+def encode_null(buf, value):
+    pass
+
+
+def encode_boolean(buf, value):
+    buf.append(1 if value else 0)
+
+
+def encode_long(buf, value):
+    if 0 <= value < 64:
+        buf.append(value << 1)
+        return
+
+    value = (value << 1) ^ (value >> 63)
+    while value & ~0x7F:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+
+    buf.append(value)
+
+
+def encode_float(buf, value):
+    buf += FLOAT.pack(value)
+
+
+def encode_double(buf, value):
+    buf += DOUBLE.pack(value)
+
+
+def encode_bytes(buf, value):
+    encode_long(buf, len(value))
+    buf += value
+
+
+def encode_string(buf, value):
+    encode_bytes(buf, value.encode("utf8"))
+
+
 def write_crc32(out, value):
     struct.pack(">I", binascii.crc32(value) & 0xffffffff)
 
@@ -78,11 +124,11 @@ def read_long(fp):
 
 
 def read_float(fp):
-    return struct.unpack("<f", fp.read(4))[0]
+    return FLOAT.unpack(fp.read(4))[0]
 
 
 def read_double(fp):
-    return struct.unpack("<d", fp.read(8))[0]
+    return DOUBLE.unpack(fp.read(8))[0]
 
 
 def read_bytes(fp):
@@ -119,6 +165,130 @@ def read_blocks(read_item, fp):
             yield item
 
 
+# The decode_* functions read a value from a bytes-like object (bytes, bytearray,
+# memoryview or mmap) starting at offset `pos`. They return the value and the
+# offset directly behind the value.
+
+def decode_null(buf, pos):
+    return None, pos
+
+
+def decode_boolean(buf, pos):
+    return buf[pos] != 0, pos + 1
+
+
+def decode_long(buf, pos):
+    b = buf[pos]
+    pos += 1
+    if b < 0x80:
+        return (b >> 1) ^ -(b & 1), pos
+
+    n = b & 0x7F
+    shift = 7
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return (n >> 1) ^ -(n & 1), pos
+
+        shift += 7
+
+
+def decode_float(buf, pos):
+    return FLOAT.unpack_from(buf, pos)[0], pos + 4
+
+
+def decode_double(buf, pos):
+    return DOUBLE.unpack_from(buf, pos)[0], pos + 8
+
+
+def decode_bytes(buf, pos):
+    size, pos = decode_long(buf, pos)
+    end = pos + size
+    if end > len(buf):
+        raise EOFError()
+
+    return bytes(buf[pos:end]), end
+
+
+def decode_bytes_view(buf, pos):
+    """Like :func:`decode_bytes`, but returns a slice of the buffer instead of a copy.
+    For a memoryview, this is a memoryview that shares the memory of the buffer."""
+    size, pos = decode_long(buf, pos)
+    end = pos + size
+    if end > len(buf):
+        raise EOFError()
+
+    return buf[pos:end], end
+
+
+def decode_string(buf, pos):
+    size, pos = decode_long(buf, pos)
+    end = pos + size
+    if end > len(buf):
+        raise EOFError()
+
+    return str(buf[pos:end], "utf8"), end
+
+
+# The skip_* functions skip over a value in a bytes-like object starting at
+# offset `pos` without decoding it. They return the offset directly behind the value.
+
+def skip_null(buf, pos):
+    return pos
+
+
+def skip_boolean(buf, pos):
+    return pos + 1
+
+
+def skip_long(buf, pos):
+    while buf[pos] & 0x80:
+        pos += 1
+
+    return pos + 1
+
+
+def skip_float(buf, pos):
+    return pos + 4
+
+
+def skip_double(buf, pos):
+    return pos + 8
+
+
+def skip_bytes(buf, pos):
+    size, pos = decode_long(buf, pos)
+    end = pos + size
+    if end > len(buf):
+        raise EOFError()
+
+    return end
+
+
+PRIMITIVE_SKIPPERS = {
+    "null": skip_null,
+    "bytes": skip_bytes,
+    "boolean": skip_boolean,
+    "int": skip_long,
+    "long": skip_long,
+    "float": skip_float,
+    "double": skip_double,
+    "string": skip_bytes
+}
+
+PRIMITIVE_DECODERS = {
+    "null": decode_null,
+    "bytes": decode_bytes,
+    "boolean": decode_boolean,
+    "int": decode_long,
+    "long": decode_long,
+    "float": decode_float,
+    "double": decode_double,
+    "string": decode_string
+}
+
 PRIMITIVE_READERS = {
     "null": read_null,
     "bytes": read_bytes,
@@ -130,6 +300,17 @@ PRIMITIVE_READERS = {
     "string": read_string
 }
 
+PRIMITIVE_ENCODERS = {
+    "null": encode_null,
+    "bytes": encode_bytes,
+    "boolean": encode_boolean,
+    "int": encode_long,
+    "long": encode_long,
+    "float": encode_float,
+    "double": encode_double,
+    "string": encode_string
+}
+
 PRIMITIVE_WRITERS = {
     "null": write_null,
     "bytes": write_bytes,
@@ -148,16 +329,26 @@ def remove_schema_parameter(func):
 
 
 class Writer(object):
-    def __init__(self, schema):
+    def __init__(self, schema, stats=None):
         """Creates a new writer for avro packed messages.
 
         To create a new writer you need to provide a schema for the file to write.
         The schema could be a :class:`avrolight.schema.Schema` instance. If not, it will be
         given to the constructor of :class:`avrolight.schema.Schema`.
+
+        If a :class:`avrolight.stats.Stats` instance is given, the values
+        and bytes encoded by :meth:`encode` are counted.
         """
         self.schema = schema if isinstance(schema, Schema) else Schema(schema)
 
-        self.writers = dict({key: remove_schema_parameter(func) for key, func in PRIMITIVE_WRITERS.items()}, **{
+        self.stats = stats
+        if stats is not None:
+            self.encode = self._counting_encode
+
+    @cached_property
+    def writers(self):
+        """Maps type names to the write methods used by :meth:`write_any`."""
+        return dict({key: remove_schema_parameter(func) for key, func in PRIMITIVE_WRITERS.items()}, **{
             "record": self.write_record,
             "array": self.write_array,
             "fixed": self.write_fixed,
@@ -170,8 +361,32 @@ class Writer(object):
 
         The object is serialized and written to the given file-like object. The value
         must match the schema of this writer.
+
+        This uses the compiled encoder of the schema, see :attr:`avrolight.schema.Schema.encoder`.
+        """
+        fp.write(self.encode(value))
+
+    def encode(self, value, buf=None):
+        """Encodes an object using this writer.
+
+        The encoded value is appended to the given bytearray. If no buffer
+        is given, a new bytearray is created. Returns the buffer.
         """
-        self.write_any(self.schema.toplevel_type, fp, value)
+        if buf is None:
+            buf = bytearray()
+
+        self.schema.encoder(buf, value)
+        return buf
+
+    def _counting_encode(self, value, buf=None):
+        if buf is None:
+            buf = bytearray()
+
+        size = len(buf)
+        self.schema.encoder(buf, value)
+
+        self.stats.count_records(1, len(buf) - size)
+        return buf
 
     def write_any(self, schema, out, value):
         if not isinstance(schema, dict):
@@ -197,7 +412,7 @@ class Writer(object):
     def write_record(self, schema, out, value):
         for field in schema["fields"]:
             field_type = field["type"]
-            field_value = value[field["name"]]
+            field_value = getattr(value, field["name"]) if isinstance(value, Record) else value[field["name"]]
             self.write_any(field_type, out, field_value)
 
     def write_array(self, schema, out, array):
@@ -230,6 +445,7 @@ class Writer(object):
 
 
 TYPES = (
+    (bool, "boolean"),
     (dict, "record"),
     (int, "int"),
     (int, "long"),
@@ -249,6 +465,12 @@ def choose_union_type(union, value):
     if value is None and "null" in union:
         return union.index("null"), "null"
 
+    if isinstance(value, Record):
+        for idx, type in enumerate(union):
+            name = type.get("name") if isinstance(type, dict) else type
+            if isinstance(name, str) and name.lstrip(".") == value.__avro_name__:
+                return idx, type
+
     union_types = {
         type["type"] if isinstance(type, dict) else type: idx
         for idx, type in enumerate(union)
@@ -263,14 +485,97 @@ def choose_union_type(union, value):
 
 
 class Reader(object):
-    def __init__(self, schema):
+    def __init__(self, schema, fields=None, writer_schema=None, zero_copy=False, record_classes=False, lazy=False,
+                 stats=None):
         """Initializes a new reader from a schema.
 
         See :class:`avrolight.io.Writer` for more information about schema handling
+
+        If a list of field paths like `["id", "user.name"]` is given as `fields`, only
+        those fields of records are decoded. All other fields are skipped without decoding
+        them, see :func:`avrolight.compiler.projection`.
+
+        If the data was written using a different schema, pass that schema as `writer_schema`.
+        The data is then resolved to :attr:`schema`, see :mod:`avrolight.resolution`.
+
+        If `zero_copy` is `True`, values of bytes and fixed types are returned as slices of
+        the buffer that is decoded instead of copies. Decoding a memoryview then returns
+        memoryviews that share the memory of the buffer, see :func:`avrolight.container.open_container`.
+
+        Projections and writer schemas are only supported when reading from bytes-like objects
+        or in-memory files, zero copy decoding only when reading from bytes-like objects, as the
+        returned slices would keep the buffer of an in-memory file locked. Writer schemas can not
+        be combined with the others.
+
+        If `record_classes` is `True`, records are decoded into instances of generated classes
+        with `__slots__` instead of dicts, see :attr:`avrolight.schema.Schema.record_classes`.
+        This can not be combined with projections and writer schemas.
+
+        If `lazy` is `True`, records are returned as read-only views of the buffer, which
+        decode fields only when they are accessed, see :class:`avrolight.views.RecordView`.
+        Lazy decoding is only supported for records read from bytes-like objects and can not
+        be combined with the options above except `zero_copy`.
+
+        If a :class:`avrolight.stats.Stats` instance is given, the values
+        and bytes decoded by :meth:`decode` are counted. Views returned by :meth:`view`
+        are counted as values only, as their size is not known without skipping them.
         """
-        self.schema = schema if isinstance(schema, Schema) else Schema(schema)
+        if writer_schema is not None and (fields is not None or zero_copy):
+            raise ValueError("Projections and zero copy decoding can not be combined with a writer schema")
+
+        if record_classes and (fields is not None or writer_schema is not None):
+            raise ValueError("Record classes can not be combined with projections and writer schemas")
 
-        self.reader = dict({key: remove_schema_parameter(func) for key, func in PRIMITIVE_READERS.items()}, **{
+        if lazy and (fields is not None or writer_schema is not None or record_classes):
+            raise ValueError("Lazy decoding can not be combined with projections, writer schemas and record classes")
+
+        self.schema = schema if isinstance(schema, Schema) else Schema(schema)
+        self.fields = fields
+        self.writer_schema = writer_schema
+        self.zero_copy = zero_copy
+        self.record_classes = self.schema.record_classes if record_classes else None
+        self.lazy = lazy
+
+        self.stats = stats
+        if stats is not None:
+            self.decode = self._counting_decode
+            self.view = self._counting_view
+
+    @cached_property
+    def decoder(self):
+        """The compiled decoder used by this reader."""
+        if self.writer_schema is not None:
+            from avrolight.resolution import compile_resolver
+            return compile_resolver(self.writer_schema, self.schema)
+
+        if self.lazy:
+            view = self.viewer
+
+            def decode_view(buf, pos):
+                result = view(buf, pos)
+                return result, result.end
+
+            return decode_view
+
+        if self.fields is not None or self.zero_copy or self.record_classes is not None:
+            from avrolight.compiler import compile_decoder
+            return compile_decoder(self.schema, self.fields, self.zero_copy, self.record_classes)
+
+        return self.schema.decoder
+
+    @cached_property
+    def viewer(self):
+        """The function returning lazy views of records used by this reader."""
+        if self.zero_copy:
+            from avrolight.views import compile_view
+            return compile_view(self.schema, zero_copy=True)
+
+        return self.schema.viewer
+
+    @cached_property
+    def reader(self):
+        """Maps type names to the read methods used by :meth:`read_any`."""
+        return dict({key: remove_schema_parameter(func) for key, func in PRIMITIVE_READERS.items()}, **{
             "record": self.read_record,
             "enum": self.read_enum,
             "array": self.read_array,
@@ -279,8 +584,60 @@ class Reader(object):
         })
 
     def read(self, fp):
-        """Reads one value using :attr:`schema` from the given file-like object."""
-        return self.read_any(self.schema.toplevel_type, fp)
+        """Reads one value using :attr:`schema` from the given bytes-like or file-like object.
+
+        Bytes-like objects and in-memory files like :class:`io.BytesIO` are decoded directly from
+        their buffer using the compiled decoder, see :attr:`avrolight.schema.Schema.decoder`.
+        Other file-like objects are read value by value, prefer :meth:`decode` if the
+        data is already in memory.
+        """
+        if isinstance(fp, (bytes, bytearray, memoryview)):
+            return self.view(fp) if self.lazy else self.decode(fp)[0]
+
+        if self.lazy:
+            raise ValueError("Lazy decoding is only supported for bytes-like objects")
+
+        if self.zero_copy:
+            # slices of the buffer of an in-memory file prevent it from being resized
+            raise ValueError("Zero copy decoding is only supported for bytes-like objects")
+
+        getbuffer = getattr(fp, "getbuffer", None)
+        if getbuffer is None:
+            if self.fields is not None or self.writer_schema is not None:
+                raise ValueError("Projections and writer schemas are only supported "
+                                 "for bytes-like objects or in-memory files")
+
+            return self.read_any(self.schema.toplevel_type, fp)
+
+        with getbuffer() as buf:
+            value, pos = self.decode(buf, fp.tell())
+
+        fp.seek(pos)
+        return value
+
+    def decode(self, buf, pos=0):
+        """Decodes one value from a bytes-like object, starting at offset `pos`.
+        Returns the value and the offset directly behind the value."""
+        try:
+            return self.decoder(buf, pos)
+        except (IndexError, struct.error):
+            raise EOFError()
+
+    def view(self, buf, pos=0):
+        """Returns a lazy view of the record at offset `pos` of a bytes-like object,
+        see :class:`avrolight.views.RecordView`. Unlike :meth:`decode`, this does not
+        skip over the record to find its end, so only the accessed fields are read."""
+        return self.viewer(buf, pos)
+
+    def _counting_decode(self, buf, pos=0):
+        value, end = Reader.decode(self, buf, pos)
+
+        self.stats.count_records(1, end - pos)
+        return value, end
+
+    def _counting_view(self, buf, pos=0):
+        self.stats.count_records(1, 0)
+        return self.viewer(buf, pos)
 
     def read_record(self, schema, fp):
         result = {}
@@ -290,6 +647,11 @@ class Reader(object):
 
             result[field_name] = self.read_any(field_type, fp)
 
+        if self.record_classes is not None:
+            record_class = self.record_classes.get(schema.get("name", "").lstrip("."))
+            if record_class is not None:
+                return record_class(**result)
+
         return result
 
     def read_array(self, schema, fp):
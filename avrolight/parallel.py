@@ -0,0 +1,297 @@
+"""
+This file contains functions to decode and encode avro container files using multiple processes.
+
+The blocks of a container file are self-delimiting, so they can be decoded independently
+of each other. Files given by path are split into byte ranges at sync markers and each
+worker reads its range itself. For other file-like objects, the blocks are read in the
+calling process and handed to the workers. When writing, each worker encodes and compresses
+a batch of records into one block, which is written to the file by the calling process.
+
+Codecs registered using :func:`avrolight.codecs.register_codec` must also be registered in
+the worker processes, e.g. by registering them at import time of a module.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from avrolight.codecs import get_codec
+from avrolight.container import Block, ContainerReader, ContainerWriter, _iter_blocks
+from avrolight.io import Reader, Writer
+import avrolight.json as json
+
+__all__ = ("read_container_parallel", "split_offsets", "ParallelContainerWriter")
+
+
+def read_container_parallel(source, processes=None, ordered=True, chunk_size=16 * 1024 ** 2, executor=None,
+                            fields=None):
+    """Decodes the records of a container file using a pool of worker processes and
+    returns an iterator over the records.
+
+    `source` is the path of a container file or a file-like object. The file is split
+    into chunks of about `chunk_size` bytes, each chunk is decoded by one worker. If `ordered`
+    is `False`, the records of a chunk are returned as soon as the chunk is decoded, which
+    might not be the order of the records in the file.
+
+    The work is submitted to a new :class:`concurrent.futures.ProcessPoolExecutor` with the
+    given number of processes, or to the given executor. At most two chunks per process
+    are in flight at any time.
+
+    If a list of field paths is given as `fields`, only those fields of the records
+    are decoded, see :class:`avrolight.io.Reader`.
+    """
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(processes)
+
+    depth = 2 * (processes or os.cpu_count() or 1)
+
+    try:
+        if isinstance(source, (str, bytes, os.PathLike)):
+            tasks = _range_tasks(source, chunk_size, fields)
+        else:
+            tasks = _block_tasks(source, chunk_size, fields)
+
+        for records in _run_tasks(executor, tasks, ordered, depth):
+            yield from records
+
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+
+class ParallelContainerWriter(object):
+    def __init__(self, fp, schema, codec="null", batch_size=10000, processes=None, executor=None,
+                 max_pending=None, **kwargs):
+        """Creates a writer for an avro container file that encodes the records using a pool
+        of worker processes.
+
+        The records are collected into batches of `batch_size` records. Each batch is encoded
+        and compressed into one block by a worker, the blocks are written to the file in the
+        order of the records. The work is submitted to a new
+        :class:`concurrent.futures.ProcessPoolExecutor` with the given number of processes, or
+        to the given executor. At most `max_pending` batches are in flight, by default two per
+        process, :meth:`write` blocks until a batch is done.
+
+        Further keyword arguments are passed to the :class:`avrolight.container.ContainerWriter`
+        that writes the blocks to the file.
+        """
+        self.writer = ContainerWriter(fp, schema, codec=codec, **kwargs)
+        self.batch_size = batch_size
+        self.max_pending = max_pending or 2 * (processes or os.cpu_count() or 1)
+
+        self._own_executor = executor is None
+        self._executor = ProcessPoolExecutor(processes) if executor is None else executor
+
+        self._schema_str = str(self.writer.schema)
+        self._batch = []
+        self._pending = deque()
+
+    @property
+    def schema(self):
+        return self.writer.schema
+
+    def write(self, message):
+        self._batch.append(message)
+        if len(self._batch) >= self.batch_size:
+            self._submit_batch()
+
+    def flush(self):
+        """Encodes the records written so far, waits for all
+        batches and writes them to the file."""
+        self._submit_batch()
+        while self._pending:
+            self._write_result()
+
+        self.writer.flush()
+
+    def close(self):
+        """Flushes the writer and shuts down the executor, if it was created
+        by this writer. The file-like object is not closed."""
+        try:
+            self.flush()
+        finally:
+            try:
+                for future in self._pending:
+                    future.cancel()
+
+                if self._own_executor:
+                    self._executor.shutdown()
+            finally:
+                self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _submit_batch(self):
+        if not self._batch:
+            return
+
+        while len(self._pending) >= self.max_pending:
+            self._write_result()
+
+        future = self._executor.submit(_encode_batch, self._schema_str, self.writer.codec.name, self._batch)
+        self._pending.append(future)
+        self._batch = []
+
+    def _write_result(self):
+        count, data = self._pending.popleft().result()
+        self.writer.write_block(Block(count, data, self.writer.codec))
+
+
+def split_offsets(fp, chunk_size, sync_marker=None, start=None):
+    """Splits a container file into byte ranges of about `chunk_size` bytes
+    that start and end at block boundaries. Returns a list of (start, end) tuples.
+
+    The block boundaries are found by scanning for the sync marker of the file.
+    If the sync marker and the offset of the first block are not given, they are
+    taken from the header of the file.
+    """
+    if sync_marker is None or start is None:
+        fp.seek(0)
+        sync_marker = ContainerReader(fp).sync_marker
+        start = fp.tell()
+
+    file_size = fp.seek(0, os.SEEK_END)
+
+    offsets = [start]
+    while offsets[-1] + chunk_size < file_size:
+        offset = _find_block_end(fp, sync_marker, offsets[-1] + chunk_size)
+        if offset >= file_size:
+            break
+
+        offsets.append(offset)
+
+    return [(start, end) for start, end in zip(offsets, offsets[1:] + [file_size]) if start < end]
+
+
+def _find_block_end(fp, sync_marker, offset, read_size=64 * 1024):
+    """Returns the offset directly behind the next sync marker at or behind the
+    given offset, or the end of the file, if no sync marker could be found."""
+    fp.seek(offset)
+    tail = b""
+    while True:
+        data = fp.read(read_size)
+        if not data:
+            return fp.tell()
+
+        data = tail + data
+        idx = data.find(sync_marker)
+        if idx >= 0:
+            return fp.tell() - len(data) + idx + len(sync_marker)
+
+        # keep the end of the data, the marker could span two reads
+        tail = data[-len(sync_marker) + 1:]
+
+
+def _range_tasks(path, chunk_size, fields):
+    with open(path, "rb") as fp:
+        reader = ContainerReader(fp)
+        ranges = split_offsets(fp, chunk_size, reader.sync_marker, fp.tell())
+
+    for start, end in ranges:
+        yield _decode_range, (path, reader.schema_bytes, fields, reader.codec.name, reader.sync_marker, start, end)
+
+
+def _block_tasks(fp, chunk_size, fields):
+    reader = ContainerReader(fp)
+
+    blocks, size = [], 0
+    for count, data in _iter_blocks(fp, reader.sync_marker):
+        blocks.append((count, data))
+        size += len(data)
+
+        if size >= chunk_size:
+            yield _decode_blocks, (reader.schema_bytes, fields, reader.codec.name, blocks)
+            blocks, size = [], 0
+
+    if blocks:
+        yield _decode_blocks, (reader.schema_bytes, fields, reader.codec.name, blocks)
+
+
+def _run_tasks(executor, tasks, ordered, depth):
+    """Submits the tasks to the executor, with at most `depth` tasks
+    in flight, and yields the results of the tasks."""
+    pending = deque()
+    try:
+        for func, args in tasks:
+            pending.append(executor.submit(func, *args))
+            if len(pending) >= depth:
+                yield from _take_results(pending, ordered)
+
+        while pending:
+            yield from _take_results(pending, ordered)
+
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _take_results(pending, ordered):
+    if ordered:
+        yield pending.popleft().result()
+        return
+
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        pending.remove(future)
+        yield future.result()
+
+
+# readers by schema, cached in each worker process
+_readers = {}
+
+
+def _reader(schema_bytes, fields):
+    key = schema_bytes, tuple(fields) if fields is not None else None
+    reader = _readers.get(key)
+    if reader is None:
+        reader = _readers[key] = Reader(json.loads(schema_bytes.decode("utf8")), fields)
+
+    return reader
+
+
+# writers by schema, cached in each worker process
+_writers = {}
+
+
+def _encode_batch(schema_str, codec_name, records):
+    writer = _writers.get(schema_str)
+    if writer is None:
+        writer = _writers[schema_str] = Writer(json.loads(schema_str))
+
+    buf = bytearray()
+    for record in records:
+        writer.encode(record, buf)
+
+    return len(records), get_codec(codec_name).compress(buf)
+
+
+def _decode_blocks(schema_bytes, fields, codec_name, blocks):
+    reader = _reader(schema_bytes, fields)
+    codec = get_codec(codec_name)
+
+    records = []
+    for count, data in blocks:
+        data = codec.decompress(data)
+        pos = 0
+        for _ in range(count):
+            value, pos = reader.decode(data, pos)
+            records.append(value)
+
+    return records
+
+
+def _decode_range(path, schema_bytes, fields, codec_name, sync_marker, start, end):
+    blocks = []
+    with open(path, "rb") as fp:
+        fp.seek(start)
+        for block in _iter_blocks(fp, sync_marker):
+            blocks.append(block)
+            if fp.tell() >= end:
+                break
+
+    return _decode_blocks(schema_bytes, fields, codec_name, blocks)
@@ -0,0 +1,78 @@
+"""
+This file generates classes for record types, used to decode records into objects with
+`__slots__` instead of dicts, see :attr:`avrolight.schema.Schema.record_classes`.
+
+Instances of the generated classes do not have a `__dict__` and only store the values of
+their fields, which uses a lot less memory than a dict per record. Fields are accessed
+as attributes. The writers accept instances of the generated classes as records.
+"""
+
+__all__ = ("Record", "record_class")
+
+
+class Record(object):
+    """Base class of the generated record classes."""
+
+    __slots__ = ()
+
+    # the full name of the record type and the names of its fields. Dunder names
+    # are used, as fields with those names are not supported, see record_class().
+    __avro_name__ = None
+    __avro_fields__ = ()
+
+    def __init__(self, *args, **kwargs):
+        if len(args) > len(self.__avro_fields__):
+            raise TypeError("{} takes {} arguments, got {}".format(
+                type(self).__name__, len(self.__avro_fields__), len(args)))
+
+        for name, value in zip(self.__avro_fields__, args):
+            setattr(self, name, value)
+
+        for name, value in kwargs.items():
+            if name not in self.__avro_fields__:
+                raise TypeError("{} has no field {!r}".format(type(self).__name__, name))
+
+            setattr(self, name, value)
+
+        missing = [name for name in self.__avro_fields__ if not hasattr(self, name)]
+        if missing:
+            raise TypeError("{} is missing values for {}".format(type(self).__name__, ", ".join(missing)))
+
+    def _astuple(self):
+        return tuple(getattr(self, name) for name in self.__avro_fields__)
+
+    def _asdict(self):
+        """Returns the fields of this record as a dict. Nested records are not converted."""
+        return {name: getattr(self, name) for name in self.__avro_fields__}
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+
+        return self._astuple() == other._astuple()
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(
+            "{}={!r}".format(name, getattr(self, name)) for name in self.__avro_fields__))
+
+
+def record_class(schema):
+    """Generates a subclass of :class:`Record` with one slot per field for the given
+    record schema. The class is named after the record type without its namespace.
+
+    Raises `ValueError` if a field name can not be used as attribute, i.e. if it starts
+    with two underscores or shadows an attribute of :class:`Record` like `_asdict`.
+    """
+    name = schema["name"].lstrip(".")
+    fields = tuple(field["name"] for field in schema["fields"])
+    for field in fields:
+        if field.startswith("__") or hasattr(Record, field):
+            raise ValueError("Field {!r} of record {} can not be used as attribute".format(field, name))
+
+    return type(name.rpartition(".")[2], (Record,), {
+        "__slots__": fields,
+        "__avro_name__": name,
+        "__avro_fields__": fields,
+    })
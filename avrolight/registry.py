@@ -1,20 +1,36 @@
-import io
-import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
 import logbook
 import requests
 import avrolight
 
 from abc import ABCMeta, abstractmethod
 from base64 import b64decode
+from collections import OrderedDict
 from first import first
+from requests.adapters import HTTPAdapter
+
+from avrolight.schema import FINGERPRINT
 
 __all__ = [
-    "RegistryClient", "ConsulRegistryClient", "CachingRegistryClient", "NoopRegistryClient",
-    "serialize", "deserialize"
+    "RegistryClient", "RegistryUnavailableError", "ConsulRegistryClient", "CachingRegistryClient", "NoopRegistryClient",
+    "FileCachingRegistryClient", "SchemaCache", "serialize", "deserialize",
+    "serialize_many", "deserialize_many", "schema_keys", "message_key"
 ]
 
 logger = logbook.Logger(__file__)
 
+# marker of the avro single object encoding, followed by the fingerprint of the schema
+SINGLE_OBJECT_MARKER = b"\xc3\x01"
+
+
+class RegistryUnavailableError(IOError):
+    """Raised if the schema registry could not be reached or returned an error. Unlike
+    the `KeyError` raised for unknown hashes, this is not remembered by caches."""
+
 
 class RegistryClient(metaclass=ABCMeta):
     @abstractmethod
@@ -22,7 +38,9 @@ class RegistryClient(metaclass=ABCMeta):
         """Puts the given schema into the schema registry. If force is set
         to `False`, a check will be performed to see, if the schema is already
         present it the registry, before putting it there.
-        This method returns the hash of the schema.
+        This method returns the hash of the schema. Afterwards the schema can be
+        found by its hash and by its hex encoded fingerprint, see
+        :attr:`avrolight.Schema.fingerprint_hash`.
 
         :param avrolight.Schema schema: The schema to put into the registry.
         :param bool force:    Always put the schema, do not check if it is already present
@@ -33,7 +51,8 @@ class RegistryClient(metaclass=ABCMeta):
     @abstractmethod
     def get(self, schema_hash):
         """Gets the schema from the registry.
-        Raises `KeyError` if no schema with this hash could be found.
+        Raises `KeyError` if no schema with this hash could be found and
+        :class:`RegistryUnavailableError` if the registry could not be asked.
 
         :param bytes schema_hash: The schema hash to query
         :rtype: avrolight.Schema
@@ -52,10 +71,158 @@ class NoopRegistryClient(RegistryClient):
         pass
 
 
+class _Flight(object):
+    """A load of a schema that other threads can wait for."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.schema = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+        return self.schema
+
+
+class SchemaCache(object):
+    def __init__(self, max_size=1024, ttl=None, negative_ttl=5.0, clock=time.monotonic):
+        """Creates a thread-safe cache of schemas by hash.
+
+        The cache holds at most `max_size` schemas and evicts the least recently used
+        schema first. If `ttl` is given, schemas expire after `ttl` seconds. Hashes unknown
+        to the registry are remembered for `negative_ttl` seconds, pass `None` to not
+        remember them at all. Only a `KeyError` raised by the load marks a hash as unknown,
+        other errors like :class:`RegistryUnavailableError` are not cached.
+
+        The counters `hits`, `misses` and `evictions` can be used to monitor the cache.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self)}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, schema_hash):
+        with self._lock:
+            entry = self._entries.get(schema_hash)
+            return entry is not None and entry[0] is not None and not self._expired(entry)
+
+    def lookup(self, schema_hash):
+        """Returns the cached schema, or `None` if the schema is not cached.
+        Raises `KeyError` if the hash is cached as unknown."""
+        with self._lock:
+            return self._lookup(schema_hash)
+
+    def get(self, schema_hash, load):
+        """Returns the cached schema or loads it by calling `load(schema_hash)`.
+        Threads missing on the same hash at the same time wait for a single load."""
+        with self._lock:
+            schema = self._lookup(schema_hash)
+            if schema is not None:
+                return schema
+
+            flight = self._flights.get(schema_hash)
+            if flight is not None:
+                leader = False
+            else:
+                leader = True
+                flight = self._flights[schema_hash] = _Flight()
+
+        if not leader:
+            return flight.wait()
+
+        try:
+            flight.schema = schema = load(schema_hash)
+            self.put(schema_hash, schema)
+            return schema
+
+        except KeyError as error:
+            flight.error = error
+            self.put_missing(schema_hash)
+            raise
+
+        except Exception as error:
+            flight.error = error
+            raise
+
+        finally:
+            with self._lock:
+                del self._flights[schema_hash]
+
+            flight.done.set()
+
+    def put(self, schema_hash, schema):
+        self._store(schema_hash, schema, self.ttl)
+
+    def put_missing(self, schema_hash):
+        """Remembers that the registry does not know the given hash."""
+        if self.negative_ttl is not None:
+            self._store(schema_hash, None, self.negative_ttl)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _store(self, schema_hash, schema, ttl):
+        expires = self.clock() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[schema_hash] = schema, expires
+            self._entries.move_to_end(schema_hash)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _lookup(self, schema_hash):
+        entry = self._entries.get(schema_hash)
+        if entry is None or self._expired(entry):
+            self._entries.pop(schema_hash, None)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(schema_hash)
+
+        schema = entry[0]
+        if schema is None:
+            raise KeyError(schema_hash)
+
+        return schema
+
+    def _expired(self, entry):
+        return entry[1] is not None and entry[1] <= self.clock()
+
+
 class CachingRegistryClient(RegistryClient):
-    def __init__(self, registry):
+    def __init__(self, registry, cache=None, stats=None):
+        """Caches the schemas of the given registry client in a
+        :class:`SchemaCache`, or in a new cache with default settings.
+
+        If a :class:`avrolight.stats.Stats` instance is given, the lookups,
+        the misses and the time spent fetching schemas from the backend are counted.
+        """
         self.registry = registry
-        self.cache = {}
+        self.cache = cache if cache is not None else SchemaCache()
+
+        self.stats = stats
+        if stats is not None:
+            self.get = self._counting_get
 
     def put(self, schema, force=False):
         schema_bytes, schema_hash = serialize_schema(schema)
@@ -65,72 +232,200 @@ class CachingRegistryClient(RegistryClient):
 
         # store the schema in the backend
         schema_hash = self.registry.put(schema, force)
-        self.cache[schema_hash] = schema
+        self.cache.put(schema_hash, schema)
+        self.cache.put(schema.fingerprint_hash, schema)
         return schema_hash
 
     def get(self, schema_hash):
+        return self.cache.get(schema_hash, self.registry.get)
+
+    def _counting_get(self, schema_hash):
+        self.stats.count_lookup()
+        return self.cache.get(schema_hash, self._fetch)
+
+    def _fetch(self, schema_hash):
+        start = self.stats.clock()
         try:
-            return self.cache[schema_hash]
-        except KeyError:
-            schema = self.registry.get(schema_hash)
-            self.cache[schema_hash] = schema
-            return schema
+            return self.registry.get(schema_hash)
+        finally:
+            self.stats.count_fetch(schema_hash, self.stats.clock() - start)
 
     @property
     def cached(self):
         return self
 
 
+class FileCachingRegistryClient(RegistryClient):
+    # only well formed hashes are used as file names
+    HASH_PATTERN = re.compile(rb"^(?:[0-9a-f]{16}|[0-9a-f]{32})$")
+
+    def __init__(self, registry, directory):
+        """Caches the schemas of the given registry client as files in a directory,
+        which is created if it does not exist. Schemas are written to a temporary file
+        first and then renamed, so many processes can share the same directory.
+
+        Wrap this client into a :class:`CachingRegistryClient` to keep the
+        schemas in memory too.
+        """
+        self.registry = registry
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, schema, force=False):
+        schema_hash = self.registry.put(schema, force)
+        self._store(schema_hash, schema)
+        self._store(schema.fingerprint_hash, schema)
+        return schema_hash
+
+    def get(self, schema_hash):
+        schema = self._load(schema_hash)
+        if schema is None:
+            schema = self.registry.get(schema_hash)
+            self._store(schema_hash, schema)
+
+        return schema
+
+    def _path(self, schema_hash):
+        if not self.HASH_PATTERN.match(schema_hash):
+            return None
+
+        return os.path.join(self.directory, schema_hash.decode() + ".avsc")
+
+    def _load(self, schema_hash):
+        path = self._path(schema_hash)
+        if path is None:
+            return None
+
+        try:
+            with open(path, "rb") as fp:
+                schema_bytes = fp.read()
+        except FileNotFoundError:
+            return None
+
+        # ignore and remove files that can not be parsed or do not match their name
+        try:
+            schema = avrolight.Schema(schema_bytes.decode())
+            if schema_hash in schema_keys(schema):
+                return schema
+
+        except (ValueError, IndexError, KeyError):
+            pass
+
+        logger.warning("Ignoring corrupt schema file {}", path)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+        return None
+
+    def _store(self, schema_hash, schema):
+        path = self._path(schema_hash)
+        if path is None:
+            return
+
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as fp:
+                    fp.write(schema.as_bytes)
+
+                    # the data must be on disk before the rename is
+                    fp.flush()
+                    os.fsync(fp.fileno())
+
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+        except OSError as error:
+            logger.warning("Could not write schema file {}: {}", path, error)
+
+
 class ConsulRegistryClient(RegistryClient):
-    def __init__(self, endpoints, prefix="avro-schemas"):
+    def __init__(self, endpoints, prefix="avro-schemas", session=None, timeout=10, pool_size=10):
+        """Creates a client for a schema registry stored in the key value store of consul.
+
+        The requests are sent using a :class:`requests.Session` that keeps up to `pool_size`
+        connections per endpoint alive. Each request fails after `timeout` seconds.
+        """
         if isinstance(endpoints, str):
             endpoints = [endpoints]
 
         self.endpoints = tuple(endpoints)
         self.prefix = prefix
+        self.timeout = timeout
 
         if not first(self.endpoints):
             raise ValueError("Endpoints must not be empty")
 
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=len(self.endpoints), pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+
+        self.session = session
+
+    def close(self):
+        self.session.close()
+
     def get(self, schema_hash):
-        last_error = None
+        missing, last_error = False, None
         for uri in self._consul_uris(schema_hash):
             try:
                 logger.debug("Retrieving schema from {}", uri)
 
-                response = requests.get(uri)
+                response = self.session.get(uri, timeout=self.timeout)
+                if response.status_code == 404:
+                    missing = True
+                    continue
+
                 response.raise_for_status()
                 response = response.json()
                 if not response:
+                    missing = True
                     continue
 
                 encoded_schema = first(response)["Value"]
                 return avrolight.Schema(b64decode(encoded_schema.encode()).decode())
-            except Exception as error:
+            except (requests.RequestException, ValueError) as error:
                 last_error = error
 
-        raise KeyError(schema_hash) from last_error
+        # only an endpoint answering without the key proves that the schema is unknown
+        if missing:
+            raise KeyError(schema_hash)
+
+        raise RegistryUnavailableError("Could not retrieve schema {}".format(schema_hash)) from last_error
 
     def put(self, schema, force=False):
         # serialize schema
         schema_bytes, schema_hash = serialize_schema(schema)
 
+        # schemas put by older versions are only stored by hash
         if not force:
             try:
-                self.get(schema_hash)
+                self.get(schema.fingerprint_hash)
                 return schema_hash
             except KeyError:
                 pass
 
+        for key in schema_keys(schema):
+            self._put_key(key, schema_bytes)
+
+        return schema_hash
+
+    def _put_key(self, key, schema_bytes):
         last_error = None
-        for uri in self._consul_uris(schema_hash):
+        for uri in self._consul_uris(key):
             try:
                 logger.debug("Putting schema to {}", uri)
 
                 #: :type: requests.Response
-                response = requests.put(uri, data=schema_bytes)
+                response = self.session.put(uri, data=schema_bytes, timeout=self.timeout)
                 response.raise_for_status()
-                return schema_hash
+                return
             except requests.RequestException as error:
                 last_error = error
 
@@ -152,23 +447,117 @@ def serialize_schema(schema):
     :rtype: (bytes, bytes)
     """
     assert isinstance(schema, avrolight.Schema)
-    schema_bytes = schema.as_bytes
-    schema_hash = hashlib.md5(schema_bytes).hexdigest().encode()
-    return schema_bytes, schema_hash
+    return schema.as_bytes, schema.md5_hash
+
+
+def schema_keys(schema):
+    """Returns the keys of a schema in the registry, its md5
+    hash and its hex encoded fingerprint."""
+    return schema.md5_hash, schema.fingerprint_hash
+
+
+def serialize(client, schema, message, single_object=False):
+    """Serializes a message prefixed by the hex encoded md5 hash of the schema, or using the
+    avro single object encoding if `single_object` is `True`. The single object encoding
+    prefixes the message by two marker bytes and the 8 byte fingerprint of the schema.
+    """
+    buf = bytearray(_header(client.put(schema), schema, single_object))
+    avrolight.Writer(schema).encode(message, buf)
+    return bytes(buf)
+
+
+def deserialize(client, message, reader=None, lazy=False):
+    """Deserializes a message serialized using :func:`serialize`
+    with either framing.
+
+    To read messages written with different versions of a schema as values of
+    one reader schema, pass a :class:`avrolight.resolution.ResolvingReader`. The decoder
+    for each writer schema is compiled once and cached by the hash of the writer schema.
+
+    If `lazy` is `True`, a record is returned as a view of the message that decodes
+    fields only when they are accessed, see :class:`avrolight.views.RecordView`.
+    """
+    schema_hash, offset = message_key(message)
+    if lazy:
+        return _viewer(client, schema_hash, reader)(message, offset)
+
+    value, _ = _decoder(client, schema_hash, reader)(message, offset)
+    return value
+
+
+def serialize_many(client, schema, messages, single_object=False):
+    """Serializes many messages using the same schema. The schema is put
+    into the registry once and the messages are encoded using one writer.
+    Returns a list of the serialized messages."""
+    header = _header(client.put(schema), schema, single_object)
+    writer = avrolight.Writer(schema)
+
+    result = []
+    for message in messages:
+        buf = bytearray(header)
+        writer.encode(message, buf)
+        result.append(bytes(buf))
+
+    return result
+
+
+def deserialize_many(client, messages, reader=None, lazy=False):
+    """Deserializes many messages serialized using :func:`serialize`, e.g. a batch
+    consumed from a queue. The schema of each hash is requested from the registry only once
+    per call. Returns a list of the values in the order of the messages.
+
+    See :func:`deserialize` for the `reader` and `lazy` parameters.
+    """
+    decoders = {}
+
+    result = []
+    for message in messages:
+        schema_hash, offset = message_key(message)
+        decode = decoders.get(schema_hash)
+        if decode is None:
+            if lazy:
+                decode = decoders[schema_hash] = _viewer(client, schema_hash, reader)
+            else:
+                decode = decoders[schema_hash] = _decoder(client, schema_hash, reader)
+
+        if lazy:
+            result.append(decode(message, offset))
+        else:
+            value, _ = decode(message, offset)
+            result.append(value)
+
+    return result
+
+
+def message_key(message):
+    """Returns the key of the schema of a serialized message in the
+    registry and the offset of the encoded value in the message."""
+    if message[:2] == SINGLE_OBJECT_MARKER:
+        fingerprint, = FINGERPRINT.unpack_from(message, 2)
+        return "{:016x}".format(fingerprint).encode(), 10
+
+    return bytes(message[:32]), 32
+
+
+def _header(schema_hash, schema, single_object):
+    if single_object:
+        return SINGLE_OBJECT_MARKER + FINGERPRINT.pack(schema.fingerprint)
+
+    return schema_hash
+
+
+def _decoder(client, schema_hash, reader):
+    if reader is None:
+        return avrolight.Reader(client.get(schema_hash)).decode
 
+    return reader.plans.get(schema_hash) or reader.plan(client.get(schema_hash), key=schema_hash)
 
-def serialize(client, schema, message):
-    schema_hash = client.put(schema)
-    out = io.BytesIO()
-    out.write(schema_hash)
-    avrolight.write(schema, out, message)
-    return out.getvalue()
 
+def _viewer(client, schema_hash, reader):
+    if reader is not None:
+        raise ValueError("Lazy decoding can not be combined with a reader schema")
 
-def deserialize(client, message):
-    fp = io.BytesIO(message)
-    schema = client.get(fp.read(32))
-    return avrolight.read(schema, fp)
+    return client.get(schema_hash).viewer
 
 
 def main():
@@ -0,0 +1,383 @@
+"""
+This file contains the avro schema resolution. Data written with one schema (the writer
+schema) is read using another schema (the reader schema), as described in the avro
+specification: fields are matched by name, removed fields are skipped, added fields
+are filled with their defaults, numeric types are promoted and union branches are
+matched by type.
+
+A pair of writer and reader schema is compiled once into a decoder function, the
+decoder does not need to look up fields or defaults for each record.
+"""
+
+import copy
+import struct
+
+from avrolight.compiler import SkipCompiler, array_decoder, compile_recursive, map_decoder
+from avrolight.io import PRIMITIVE_DECODERS, decode_long
+from avrolight.schema import Schema
+
+__all__ = ("ResolvingReader", "compile_resolver")
+
+PRIMITIVES = frozenset(PRIMITIVE_DECODERS)
+
+# functions to convert a value of the writer type to the reader type
+PROMOTIONS = {
+    ("int", "long"): None,
+    ("int", "float"): float,
+    ("int", "double"): float,
+    ("long", "float"): float,
+    ("long", "double"): float,
+    ("float", "double"): None,
+    ("string", "bytes"): None,
+    ("bytes", "string"): None,
+}
+
+IMMUTABLE_DEFAULTS = (type(None), bool, int, float, str, bytes)
+
+
+def compile_resolver(writer_schema, reader_schema):
+    """Compiles a decoder function that decodes values written with `writer_schema`
+    into values of `reader_schema`. The decoder is called like the decoders from
+    :mod:`avrolight.compiler` with a buffer and an offset.
+
+    Raises `ValueError`, if the schemas can not be resolved.
+    """
+    writer_schema = writer_schema if isinstance(writer_schema, Schema) else Schema(writer_schema)
+    reader_schema = reader_schema if isinstance(reader_schema, Schema) else Schema(reader_schema)
+
+    compiler = ResolverCompiler(writer_schema, reader_schema)
+    return compiler.compile(writer_schema.toplevel_type, reader_schema.toplevel_type)
+
+
+class ResolvingReader(object):
+    def __init__(self, schema):
+        """Creates a reader that reads values written with any compatible writer schema
+        as values of the given reader schema.
+
+        The decoder for a writer schema is compiled on first use and cached in :attr:`plans`,
+        using the bytes of the writer schema or a key given by the caller, like the hash of
+        the schema in a schema registry.
+        """
+        self.schema = schema if isinstance(schema, Schema) else Schema(schema)
+        self.plans = {}
+
+    def plan(self, writer_schema, key=None):
+        """Returns the decoder for values written with the given writer schema."""
+        writer_schema = writer_schema if isinstance(writer_schema, Schema) else Schema(writer_schema)
+        if key is None:
+            key = writer_schema.as_bytes
+
+        try:
+            return self.plans[key]
+        except KeyError:
+            plan = self.plans[key] = compile_resolver(writer_schema, self.schema)
+            return plan
+
+    def decode(self, writer_schema, buf, pos=0, key=None):
+        """Decodes one value written with the given writer schema from a bytes-like object,
+        starting at offset `pos`. Returns the value and the offset directly behind the value."""
+        try:
+            return self.plan(writer_schema, key)(buf, pos)
+        except (IndexError, struct.error):
+            raise EOFError()
+
+
+def _kind(schema):
+    """Returns the type of a resolved schema, e.g. 'union', 'record' or 'long'."""
+    if isinstance(schema, (list, tuple)):
+        return "union"
+
+    if isinstance(schema, dict):
+        return schema["type"]
+
+    return schema
+
+
+def _short_name(name):
+    return name.lstrip(".").rsplit(".", 1)[-1]
+
+
+def _names_match(writer, reader):
+    """Checks if the names of two named types match. Namespaces are ignored,
+    aliases of the reader type are taken into account."""
+    if "name" not in reader:
+        return True
+
+    names = {_short_name(reader["name"])}
+    names.update(_short_name(alias) for alias in reader.get("aliases", ()))
+    return _short_name(writer.get("name", "")) in names
+
+
+def _fail(message):
+    def decode_error(buf, pos):
+        raise ValueError(message)
+
+    return decode_error
+
+
+class ResolverCompiler(object):
+    def __init__(self, writer_schema, reader_schema):
+        self.writer_schema = writer_schema
+        self.reader_schema = reader_schema
+
+        # maps type names to the schema of named types.
+        self.writer_types = {}
+        self.reader_types = {}
+
+        # maps pairs of writer and reader names to the compiled decoders of named types.
+        self.named = {}
+
+        self.skipper = SkipCompiler(writer_schema)
+        self.skipper.types = self.writer_types
+
+        self.compilers = {
+            "record": self.compile_record,
+            "error": self.compile_record,
+            "enum": self.compile_enum,
+            "array": self.compile_array,
+            "map": self.compile_map,
+            "fixed": self.compile_fixed,
+        }
+
+    def resolve(self, schema, schema_types, fallback):
+        """Resolves references and nested type definitions, until a primitive type name,
+        a union or a complex type is reached. Named types are registered on the way."""
+        while True:
+            if isinstance(schema, (list, tuple)):
+                return schema
+
+            if isinstance(schema, dict):
+                if isinstance(schema["type"], str) and schema["type"] in self.compilers:
+                    if "name" in schema:
+                        schema_types[schema["name"].lstrip(".")] = schema
+
+                    return schema
+
+                schema = schema["type"]
+                continue
+
+            if schema in PRIMITIVES:
+                return schema
+
+            name = schema.lstrip(".")
+            schema = schema_types.get(name) or fallback.get_type_schema(name)
+
+    def compile(self, writer, reader):
+        """Compiles a decoder for the given writer and reader (sub-)schemas."""
+        writer = self.resolve(writer, self.writer_types, self.writer_schema)
+        reader = self.resolve(reader, self.reader_types, self.reader_schema)
+
+        writer_kind, reader_kind = _kind(writer), _kind(reader)
+
+        if writer_kind == "union":
+            return self.compile_writer_union(writer, reader)
+
+        if reader_kind == "union":
+            return self.compile_reader_union(writer, reader)
+
+        if writer_kind == reader_kind:
+            if writer_kind in PRIMITIVES:
+                return PRIMITIVE_DECODERS[writer_kind]
+
+            if not _names_match(writer, reader):
+                raise ValueError("Names of {} types do not match: {} and {}".format(
+                    writer_kind, writer.get("name"), reader.get("name")))
+
+            if "name" in writer:
+                return self.compile_named(writer, reader, self.compilers[writer_kind])
+
+            return self.compilers[writer_kind](writer, reader)
+
+        if (writer_kind, reader_kind) in PROMOTIONS:
+            return self.compile_promotion(writer_kind, reader_kind)
+
+        raise ValueError("Can not resolve writer type {} to reader type {}".format(writer_kind, reader_kind))
+
+    def compile_named(self, writer, reader, compiler):
+        key = writer["name"].lstrip("."), reader.get("name", "").lstrip(".")
+        if key in self.named:
+            return self.named[key]
+
+        return compile_recursive(self.named, key, lambda: compiler(writer, reader))
+
+    # noinspection PyMethodMayBeStatic
+    def compile_promotion(self, writer_kind, reader_kind):
+        # strings and bytes share their encoding, so decode them as the reader type
+        decode = PRIMITIVE_DECODERS[reader_kind if reader_kind in ("string", "bytes") else writer_kind]
+
+        convert = PROMOTIONS[writer_kind, reader_kind]
+        if convert is None:
+            return decode
+
+        def decode_promoted(buf, pos):
+            value, pos = decode(buf, pos)
+            return convert(value), pos
+
+        return decode_promoted
+
+    def compile_writer_union(self, writer, reader):
+        branches = []
+        for branch in writer:
+            try:
+                branches.append(self.compile(branch, reader))
+            except ValueError as error:
+                # this is only an error if the branch is actually found in the data
+                branches.append(_fail(str(error)))
+
+        branches = tuple(branches)
+
+        def decode_union(buf, pos):
+            index, pos = decode_long(buf, pos)
+            return branches[index](buf, pos)
+
+        return decode_union
+
+    def compile_reader_union(self, writer, reader):
+        writer_kind = _kind(writer)
+
+        resolved = [self.resolve(branch, self.reader_types, self.reader_schema) for branch in reader]
+
+        # first look for a branch of the same type, then for a promotion
+        for branch in resolved:
+            if _kind(branch) == writer_kind and (writer_kind in PRIMITIVES or _names_match(writer, branch)):
+                return self.compile(writer, branch)
+
+        for branch in resolved:
+            if (writer_kind, _kind(branch)) in PROMOTIONS:
+                return self.compile(writer, branch)
+
+        raise ValueError("No branch of the reader union matches writer type {}".format(writer_kind))
+
+    def compile_record(self, writer, reader):
+        reader_fields = {}
+        for field in reader["fields"]:
+            reader_fields[field["name"]] = field
+            for alias in field.get("aliases", ()):
+                reader_fields.setdefault(alias, field)
+
+        # decode steps as (name, decoder) pairs, skipped fields have no name
+        steps = []
+        matched = set()
+        for field in writer["fields"]:
+            reader_field = reader_fields.get(field["name"])
+            if reader_field is None:
+                steps.append((None, self.skipper.compile(field["type"])))
+            else:
+                matched.add(reader_field["name"])
+                steps.append((reader_field["name"], self.compile(field["type"], reader_field["type"])))
+
+        steps = tuple(steps)
+
+        static_defaults = {}
+        mutable_defaults = []
+        for field in reader["fields"]:
+            if field["name"] in matched:
+                continue
+
+            if "default" not in field:
+                raise ValueError("Field {} is missing in the writer schema and has no default".format(field["name"]))
+
+            value = self.default_value(field["type"], field["default"])
+            if isinstance(value, IMMUTABLE_DEFAULTS):
+                static_defaults[field["name"]] = value
+            else:
+                mutable_defaults.append((field["name"], value))
+
+        mutable_defaults = tuple(mutable_defaults)
+        deepcopy = copy.deepcopy
+
+        def decode_record(buf, pos):
+            result = {}
+            for name, decode in steps:
+                if name is None:
+                    pos = decode(buf, pos)
+                else:
+                    result[name], pos = decode(buf, pos)
+
+            if static_defaults:
+                result.update(static_defaults)
+
+            for name, value in mutable_defaults:
+                result[name] = deepcopy(value)
+
+            return result, pos
+
+        return decode_record
+
+    # noinspection PyMethodMayBeStatic
+    def compile_enum(self, writer, reader):
+        reader_symbols = set(reader["symbols"])
+        default = reader.get("default")
+
+        symbols = []
+        for symbol in writer["symbols"]:
+            if symbol in reader_symbols:
+                symbols.append(symbol)
+            elif default is not None:
+                symbols.append(default)
+            else:
+                symbols.append(ValueError("Symbol {} is unknown to the reader".format(symbol)))
+
+        symbols = tuple(symbols)
+
+        def decode_enum(buf, pos):
+            index, pos = decode_long(buf, pos)
+            symbol = symbols[index]
+            if isinstance(symbol, ValueError):
+                raise symbol
+
+            return symbol, pos
+
+        return decode_enum
+
+    # noinspection PyMethodMayBeStatic
+    def compile_fixed(self, writer, reader):
+        if writer["size"] != reader["size"]:
+            raise ValueError("Size of fixed type {} does not match".format(writer.get("name")))
+
+        size = writer["size"]
+
+        def decode_fixed(buf, pos):
+            end = pos + size
+            if end > len(buf):
+                raise EOFError()
+
+            return bytes(buf[pos:end]), end
+
+        return decode_fixed
+
+    def compile_array(self, writer, reader):
+        return array_decoder(self.compile(writer["items"], reader["items"]))
+
+    def compile_map(self, writer, reader):
+        return map_decoder(self.compile(writer["values"], reader["values"]))
+
+    def default_value(self, schema, value):
+        """Converts the json encoded default value of a field to a python value."""
+        schema = self.resolve(schema, self.reader_types, self.reader_schema)
+        kind = _kind(schema)
+
+        if kind == "union":
+            # the default value of a union is a value of its first branch
+            return self.default_value(schema[0], value)
+
+        if kind in ("bytes", "fixed"):
+            # bytes are encoded as strings with unicode code points 0-255
+            return value.encode("latin-1")
+
+        if kind in ("float", "double"):
+            return float(value)
+
+        if kind in ("record", "error"):
+            return {
+                field["name"]: self.default_value(field["type"], value.get(field["name"], field.get("default")))
+                for field in schema["fields"]
+            }
+
+        if kind == "array":
+            return [self.default_value(schema["items"], item) for item in value]
+
+        if kind == "map":
+            return {key: self.default_value(schema["values"], item) for key, item in value.items()}
+
+        return value
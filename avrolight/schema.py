@@ -1,8 +1,19 @@
+import hashlib
+import struct
+
 from cached_property import cached_property
 from collections import OrderedDict
+from json import JSONEncoder
 
 import avrolight.json
 
+PRIMITIVE_TYPES = {"null", "boolean", "int", "long", "float", "double", "bytes", "string"}
+
+# the rabin fingerprint of an empty input, see the avro specification
+CRC64_EMPTY = 0xc15d213aa4d7a795
+
+FINGERPRINT = struct.Struct("<Q")
+
 class Schema(object):
     def __init__(self, json):
         """Parses a new schema from a json encoded string or from a map."""
@@ -38,9 +49,19 @@ class Schema(object):
                 if "name" in schema:
                     self._register_type(schema["name"], schema)
 
-                if schema["type"] == "record":
+                field_type = schema["type"]
+                if field_type in ("record", "error"):
                     _walk_list([field["type"] for field in schema["fields"]])
 
+                elif field_type == "array":
+                    _walk_schema(schema["items"])
+
+                elif field_type == "map":
+                    _walk_schema(schema["values"])
+
+                elif not isinstance(field_type, str):
+                    _walk_schema(field_type)
+
         _walk_schema(self.json)
 
     def _register_type(self, name, schema):
@@ -56,6 +77,58 @@ class Schema(object):
     def as_bytes(self):
         return str(self).encode()
 
+    @cached_property
+    def md5_hash(self):
+        """The hex encoded md5 hash of this schema as bytes,
+        used as key of the schema in the schema registry."""
+        return hashlib.md5(self.as_bytes).hexdigest().encode()
+
+    @cached_property
+    def canonical_form(self):
+        """The Parsing Canonical Form of this schema as str."""
+        return canonical_form(self.json)
+
+    @cached_property
+    def fingerprint(self):
+        """The CRC-64-AVRO fingerprint of the canonical form of this schema as int."""
+        return fingerprint64(self.canonical_form.encode("utf8"))
+
+    @cached_property
+    def fingerprint_hash(self):
+        """The hex encoded fingerprint of this schema as bytes, used as
+        key of the schema in the schema registry like :attr:`md5_hash`."""
+        return "{:016x}".format(self.fingerprint).encode()
+
+    @cached_property
+    def decoder(self):
+        """The compiled decoder of this schema, see :mod:`avrolight.compiler`.
+        It is compiled once on first access."""
+        from avrolight.compiler import compile_decoder
+        return compile_decoder(self)
+
+    @cached_property
+    def encoder(self):
+        """The compiled encoder of this schema, see :mod:`avrolight.compiler`.
+        It is compiled once on first access."""
+        from avrolight.compiler import compile_encoder
+        return compile_encoder(self)
+
+    @cached_property
+    def viewer(self):
+        """The compiled function returning lazy views of records of this schema,
+        see :mod:`avrolight.views`. It is compiled once on first access."""
+        from avrolight.views import compile_view
+        return compile_view(self)
+
+    @cached_property
+    def record_classes(self):
+        """Maps the names of the record types of this schema to generated classes with
+        `__slots__`, see :mod:`avrolight.records`. They are generated once on first access.
+        Raises `ValueError` if a field name of any record can not be used as attribute."""
+        from avrolight.records import record_class
+        return {name: record_class(schema) for name, schema in self.types.items()
+                if schema["type"] in ("record", "error")}
+
 def ordered(value):
     """Orders all dicts in the given something recursively."""
     if isinstance(value, dict):
@@ -67,3 +140,85 @@ def ordered(value):
         return tuple(ordered(v) for v in value)
 
     return value
+
+
+def _crc64_table():
+    table = []
+    for idx in range(256):
+        value = idx
+        for _ in range(8):
+            value = (value >> 1) ^ (CRC64_EMPTY & -(value & 1))
+
+        table.append(value)
+
+    return table
+
+
+CRC64_TABLE = _crc64_table()
+
+
+def fingerprint64(data):
+    """Computes the CRC-64-AVRO fingerprint of the given bytes."""
+    table = CRC64_TABLE
+    value = CRC64_EMPTY
+    for byte in data:
+        value = (value >> 8) ^ table[(value ^ byte) & 0xff]
+
+    return value
+
+
+_dumps = JSONEncoder(ensure_ascii=False).encode
+
+
+def canonical_form(schema):
+    """Returns the Parsing Canonical Form of the given json schema, see the avro specification.
+    Only the attributes relevant for parsing are kept, names are replaced by full names and
+    each named type is written in full only at its first occurrence."""
+    return _canonical_form(schema, "", set())
+
+
+def _full_name(name, namespace):
+    if "." in name:
+        return name.lstrip(".")
+
+    return namespace + "." + name if namespace else name
+
+
+def _canonical_form(schema, namespace, named):
+    if isinstance(schema, str):
+        return _dumps(schema if schema in PRIMITIVE_TYPES else _full_name(schema, namespace))
+
+    if isinstance(schema, (list, tuple)):
+        return "[" + ",".join(_canonical_form(subschema, namespace, named) for subschema in schema) + "]"
+
+    schema_type = schema["type"]
+    if schema_type in ("record", "error", "enum", "fixed"):
+        name = _full_name(schema["name"], schema.get("namespace", namespace))
+        if name in named:
+            return _dumps(name)
+
+        named.add(name)
+        namespace = name.rpartition(".")[0]
+
+        result = '{"name":' + _dumps(name) + ',"type":' + _dumps(schema_type)
+        if schema_type == "enum":
+            result += ',"symbols":' + _dumps(list(schema["symbols"]))
+
+        elif schema_type == "fixed":
+            result += ',"size":' + str(int(schema["size"]))
+
+        else:
+            fields = ('{"name":' + _dumps(field["name"]) + ',"type":' +
+                      _canonical_form(field["type"], namespace, named) + "}" for field in schema["fields"])
+            result += ',"fields":[' + ",".join(fields) + "]"
+
+        return result + "}"
+
+    if schema_type == "array":
+        return '{"type":"array","items":' + _canonical_form(schema["items"], namespace, named) + "}"
+
+    if schema_type == "map":
+        return '{"type":"map","values":' + _canonical_form(schema["values"], namespace, named) + "}"
+
+    # primitive types written as object or a nested type
+    return _canonical_form(schema_type, namespace, named)
@@ -0,0 +1,128 @@
+"""
+This file contains the counters to instrument readers, writers, container files and
+registry clients.
+
+Instrumentation is enabled by passing a :class:`Stats` instance as `stats` to those
+classes. Without it, nothing is counted or timed. One instance can be shared between
+several objects and threads to sum up their counters.
+"""
+
+import threading
+import time
+
+__all__ = ("Stats",)
+
+
+class Stats(object):
+    def __init__(self, callback=None, clock=time.perf_counter):
+        """Creates a new set of counters.
+
+        `callback` is called for each timed event with the name of the event, the duration
+        in seconds and further information as keyword arguments. The events are 'block' with
+        `count` and `size` for each block read or written, 'flush' for each flush of a
+        container writer and 'fetch' with `key` for each schema fetched from a registry.
+
+        The counters are updated under a lock, as container writers flush their blocks in a
+        background thread. The callback is called without holding the lock. Values encoded
+        and decoded one by one are counted per thread without a lock instead, and added to
+        :attr:`records` and :attr:`bytes` when those are read.
+        """
+        self.callback = callback
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # values and bytes read or written, the counters of values
+            # counted one by one are kept per thread, see count_records()
+            self._records = 0
+            self._bytes = 0
+            self._local = threading.local()
+            self._counters = []
+
+            # blocks of container files and the time spent on them
+            self.blocks = 0
+            self.block_time = 0.0
+
+            # flushes of container writers
+            self.flushes = 0
+            self.flush_time = 0.0
+
+            # schema lookups of caching registry clients and fetches from the backend
+            self.lookups = 0
+            self.misses = 0
+            self.fetch_time = 0.0
+
+    @property
+    def records(self):
+        return self._records + sum(counter[0] for counter in self._counters)
+
+    @property
+    def bytes(self):
+        return self._bytes + sum(counter[1] for counter in self._counters)
+
+    @property
+    def hits(self):
+        return self.lookups - self.misses
+
+    def count_records(self, count, size):
+        """Counts values encoded or decoded one by one. This is called for every value,
+        so each thread only updates its own counters and the lock is taken once per thread."""
+        try:
+            counter = self._local.counter
+        except AttributeError:
+            counter = self._local.counter = [0, 0]
+            with self._lock:
+                self._counters.append(counter)
+
+        counter[0] += count
+        counter[1] += size
+
+    def count_lookup(self):
+        with self._lock:
+            self.lookups += 1
+
+    def count_block(self, count, size, duration):
+        with self._lock:
+            self.blocks += 1
+            self._records += count
+            self._bytes += size
+            self.block_time += duration
+
+        if self.callback is not None:
+            self.callback("block", duration, count=count, size=size)
+
+    def count_flush(self, duration):
+        with self._lock:
+            self.flushes += 1
+            self.flush_time += duration
+
+        if self.callback is not None:
+            self.callback("flush", duration)
+
+    def count_fetch(self, key, duration):
+        with self._lock:
+            self.misses += 1
+            self.fetch_time += duration
+
+        if self.callback is not None:
+            self.callback("fetch", duration, key=key)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "records": self.records,
+                "bytes": self.bytes,
+                "blocks": self.blocks,
+                "block_time": self.block_time,
+                "flushes": self.flushes,
+                "flush_time": self.flush_time,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "misses": self.misses,
+                "fetch_time": self.fetch_time,
+            }
+
+    def __repr__(self):
+        return "Stats({})".format(", ".join("{}={!r}".format(key, value) for key, value in self.as_dict().items()))
@@ -0,0 +1,148 @@
+"""
+This file contains read-only views of encoded records, which decode fields only when they
+are accessed, see :class:`RecordView`.
+
+This is useful if only a few fields of each record are needed, e.g. to route messages
+based on one field and forward them as they are. Fields in front of an accessed field
+are skipped without decoding them, see :func:`avrolight.compiler.compile_skipper`.
+"""
+
+import struct
+from collections.abc import Mapping
+
+from avrolight.compiler import DecoderCompiler
+
+__all__ = ("RecordView", "compile_view")
+
+
+def compile_view(schema, zero_copy=False):
+    """Compiles a :class:`avrolight.schema.Schema` with a record as toplevel type into a
+    function that returns a :class:`RecordView` of a record in a bytes-like object. The
+    function is called with the buffer and the offset of the record.
+
+    Accessed fields are decoded using compiled decoders, nested records are decoded
+    completely. If `zero_copy` is `True`, bytes and fixed values are returned as slices
+    of the buffer.
+
+    You normally do not need to call this directly, use :attr:`avrolight.schema.Schema.viewer`
+    or a :class:`avrolight.io.Reader` with `lazy=True`.
+    """
+    compiler = DecoderCompiler(schema, zero_copy=zero_copy)
+
+    record = schema.toplevel_type
+    while not isinstance(record, dict) or record["type"] not in ("record", "error"):
+        if isinstance(record, dict) and not isinstance(record["type"], (list, tuple)):
+            record = record["type"]
+        elif isinstance(record, str) and record.lstrip(".") in schema.types:
+            record = schema.get_type_schema(record)
+        else:
+            raise ValueError("Lazy decoding requires a record as toplevel type")
+
+    # compile the whole record first, so that references to it are resolved
+    compiler.compile(record)
+    layout = RecordLayout(
+        record["name"],
+        tuple(field["name"] for field in record["fields"]),
+        tuple(compiler.compile(field["type"]) for field in record["fields"]),
+        tuple(compiler.skipper.compile(field["type"]) for field in record["fields"]))
+
+    def view(buf, pos):
+        return RecordView(layout, buf, pos)
+
+    return view
+
+
+class RecordLayout(object):
+    """The names, decoders and skippers of the fields of a record type."""
+
+    __slots__ = ("name", "fields", "index", "decoders", "skippers")
+
+    def __init__(self, name, fields, decoders, skippers):
+        self.name = name
+        self.fields = fields
+        self.index = {field: index for index, field in enumerate(fields)}
+        self.decoders = decoders
+        self.skippers = skippers
+
+
+class RecordView(Mapping):
+    """A read-only mapping of the fields of an encoded record.
+
+    A field is decoded on first access and cached afterwards. The offsets of the fields
+    are found by skipping the fields in front of them and remembered, so accessing fields
+    in order skips each field at most once.
+
+    The encoded record is available as :attr:`raw` to forward it without encoding it again.
+    """
+
+    __slots__ = ("_layout", "_buf", "_offsets", "_values")
+
+    def __init__(self, layout, buf, pos=0):
+        self._layout = layout
+        self._buf = buf
+
+        # the offsets of the fields found so far, followed by the end of the record
+        self._offsets = [pos]
+        self._values = {}
+
+    def __getitem__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            pass
+
+        index = self._layout.index[name]
+        try:
+            value, end = self._layout.decoders[index](self._buf, self._offset(index))
+        except (IndexError, struct.error):
+            raise EOFError()
+
+        if len(self._offsets) == index + 1:
+            self._offsets.append(end)
+
+        self._values[name] = value
+        return value
+
+    def _offset(self, index):
+        offsets = self._offsets
+        if index < len(offsets):
+            return offsets[index]
+
+        buf, skippers = self._buf, self._layout.skippers
+        pos = offsets[-1]
+        for skip in skippers[len(offsets) - 1:index]:
+            pos = skip(buf, pos)
+            offsets.append(pos)
+
+        return pos
+
+    def __contains__(self, name):
+        return name in self._layout.index
+
+    def __iter__(self):
+        return iter(self._layout.fields)
+
+    def __len__(self):
+        return len(self._layout.fields)
+
+    @property
+    def start(self):
+        """The offset of the record in the buffer."""
+        return self._offsets[0]
+
+    @property
+    def end(self):
+        """The offset directly behind the record in the buffer. The fields
+        not skipped or decoded so far are skipped to find it."""
+        try:
+            return self._offset(len(self._layout.fields))
+        except (IndexError, struct.error):
+            raise EOFError()
+
+    @property
+    def raw(self):
+        """The encoded record as a memoryview of the buffer."""
+        return memoryview(self._buf)[self.start:self.end]
+
+    def __repr__(self):
+        return "<RecordView of {} at {}>".format(self._layout.name, self.start)
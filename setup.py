@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name="avrolight",
@@ -9,7 +9,8 @@ setup(
     author="Oliver Bestmann",
     author_email="oliver.bestmann@googlemail.com",
     url="https://github.com/oliverbestmann/avrolight",
-    requires=["cached_property", "logbook", "requests", "first"],
+    install_requires=["cached_property", "logbook", "requests", "first"],
+    extras_require={"async": ["aiohttp"]},
     packages=["avrolight"],
 
     license='MIT',
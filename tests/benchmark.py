@@ -0,0 +1,295 @@
+"""
+Benchmarks for avrolight.
+
+Each benchmark encodes or decodes records of one schema shape using one API and reports
+the throughput in records/s and MB/s of encoded data, and the peak memory allocated while
+running it. Run it like this:
+
+    PYTHONPATH=. python tests/benchmark.py --output results.json
+    PYTHONPATH=. python tests/benchmark.py --baseline results.json
+
+When a baseline is given, benchmarks slower than the baseline by more than the tolerance
+are reported as regressions and the exit code is non-zero.
+"""
+
+import argparse
+import gc
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import avrolight
+from avrolight import registry
+from avrolight.schema import Schema
+
+from helpers import MemoryRegistryClient
+
+SHAPES = {
+    "flat_numeric": ({
+        "type": "record", "name": "Numeric", "fields": [
+            {"name": "id", "type": "long"},
+            {"name": "count", "type": "int"},
+            {"name": "ratio", "type": "float"},
+            {"name": "value", "type": "double"},
+            {"name": "valid", "type": "boolean"},
+        ]
+    }, lambda idx: {"id": idx * 7919, "count": idx % 1000, "ratio": idx / 3, "value": idx * 1.5, "valid": idx % 2 == 0}),
+
+    "strings": ({
+        "type": "record", "name": "Strings", "fields": [
+            {"name": "name", "type": "string"},
+            {"name": "email", "type": "string"},
+            {"name": "description", "type": "string"},
+        ]
+    }, lambda idx: {"name": "user-{}".format(idx), "email": "user-{}@example.com".format(idx),
+                    "description": "Lorem ipsum dolor sit amet, consectetur adipiscing elit " * 2}),
+
+    "nullable": ({
+        "type": "record", "name": "Nullable", "fields": [
+            {"name": "id", "type": ["null", "long"]},
+            {"name": "name", "type": ["null", "string"]},
+            {"name": "score", "type": ["null", "double"]},
+        ]
+    }, lambda idx: {"id": idx if idx % 3 else None, "name": "n{}".format(idx) if idx % 2 else None,
+                    "score": None if idx % 5 else idx / 7}),
+
+    "nested": ({
+        "type": "record", "name": "Nested", "fields": [
+            {"name": "tags", "type": {"type": "map", "values": "long"}},
+            {"name": "points", "type": {"type": "array", "items": {
+                "type": "record", "name": "Point", "fields": [
+                    {"name": "x", "type": "double"},
+                    {"name": "y", "type": "double"},
+                ]}}},
+        ]
+    }, lambda idx: {"tags": {"a": idx, "b": idx + 1, "c": idx + 2},
+                    "points": [{"x": float(idx), "y": float(step)} for step in range(5)]}),
+
+    "large_bytes": ({
+        "type": "record", "name": "Blob", "fields": [
+            {"name": "id", "type": "long"},
+            {"name": "payload", "type": "bytes"},
+        ]
+    }, lambda idx: {"id": idx, "payload": bytes([idx % 256]) * 64 * 1024}),
+
+    "recursive": ({
+        "type": "record", "name": "Lisp", "fields": [{"name": "value", "type": [
+            "null", "string",
+            {"type": "record", "name": "Cons", "fields": [
+                {"name": "car", "type": "Lisp"},
+                {"name": "cdr", "type": "Lisp"},
+            ]}
+        ]}]
+    }, lambda idx: {"value": {"car": {"value": "head"}, "cdr": {"value": {"car": {"value": str(idx)},
+                                                                          "cdr": {"value": None}}}}}),
+}
+
+# fewer records for shapes with large records
+RECORD_SCALE = {"large_bytes": 0.01}
+
+
+def bench_read(schema, records):
+    reader = avrolight.Reader(schema)
+    messages = [avrolight.Writer(schema).encode(record) for record in records]
+
+    def run():
+        return [reader.decode(message)[0] for message in messages]
+
+    return run, sum(len(message) for message in messages)
+
+
+def bench_read_record_classes(schema, records):
+    reader = avrolight.Reader(schema, record_classes=True)
+    messages = [avrolight.Writer(schema).encode(record) for record in records]
+
+    def run():
+        return [reader.decode(message)[0] for message in messages]
+
+    return run, sum(len(message) for message in messages)
+
+
+def bench_read_lazy(schema, records):
+    reader = avrolight.Reader(schema, lazy=True)
+    messages = [avrolight.Writer(schema).encode(record) for record in records]
+    field = schema.json["fields"][0]["name"]
+
+    def run():
+        views = [reader.view(message) for message in messages]
+        for view in views:
+            view[field]
+
+        return views
+
+    return run, sum(len(message) for message in messages)
+
+
+def bench_write(schema, records):
+    writer = avrolight.Writer(schema)
+
+    def run():
+        for record in records:
+            writer.encode(record)
+
+    return run, sum(len(writer.encode(record)) for record in records)
+
+
+def bench_container_read(schema, records):
+    fp = io.BytesIO()
+    with avrolight.ContainerWriter(fp, schema) as writer:
+        for record in records:
+            writer.write(record)
+
+    data = fp.getvalue()
+
+    def run():
+        return list(avrolight.read_container(io.BytesIO(data)))
+
+    return run, len(data)
+
+
+def bench_container_write(schema, records):
+    def run():
+        fp = io.BytesIO()
+        with avrolight.ContainerWriter(fp, schema) as writer:
+            for record in records:
+                writer.write(record)
+
+        return fp
+
+    return run, len(run().getvalue())
+
+
+def bench_serialize(schema, records):
+    client = MemoryRegistryClient().cached
+
+    def run():
+        for record in records:
+            registry.serialize(client, schema, record)
+
+    return run, sum(len(registry.serialize(client, schema, record)) for record in records)
+
+
+def bench_deserialize(schema, records):
+    client = MemoryRegistryClient().cached
+    messages = [registry.serialize(client, schema, record) for record in records]
+
+    def run():
+        return [registry.deserialize(client, message) for message in messages]
+
+    return run, sum(len(message) for message in messages)
+
+
+BENCHMARKS = {
+    "read": bench_read,
+    "read_record_classes": bench_read_record_classes,
+    "read_lazy": bench_read_lazy,
+    "write": bench_write,
+    "container_read": bench_container_read,
+    "container_write": bench_container_write,
+    "serialize": bench_serialize,
+    "deserialize": bench_deserialize,
+}
+
+
+def measure(run, repeat):
+    """Returns the best duration of `repeat` runs and the peak memory
+    allocated during an additional run traced by tracemalloc.
+
+    Read benchmarks return the values they decode, so that those are included
+    in the peak memory. They are freed after each run."""
+    durations = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        durations.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = run()
+        _, peak = tracemalloc.get_traced_memory()
+        del result
+    finally:
+        tracemalloc.stop()
+
+    return min(durations), peak
+
+
+def run_benchmarks(record_count=10000, repeat=5, pattern=""):
+    results = {}
+    for shape, (schema, make_record) in sorted(SHAPES.items()):
+        schema = Schema(schema)
+        count = max(1, int(record_count * RECORD_SCALE.get(shape, 1)))
+        records = [make_record(idx) for idx in range(count)]
+
+        for name, bench in sorted(BENCHMARKS.items()):
+            key = "{}/{}".format(shape, name)
+            if pattern not in key:
+                continue
+
+            run, size = bench(schema, records)
+            duration, peak = measure(run, repeat)
+            results[key] = {
+                "records": count,
+                "records_per_second": count / duration,
+                "mb_per_second": size / duration / 1e6,
+                "peak_memory_bytes": peak,
+            }
+
+            print("{:32} {:12,.0f} records/s {:10.2f} MB/s {:12,d} bytes peak".format(
+                key, results[key]["records_per_second"], results[key]["mb_per_second"], peak))
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of messages for the benchmarks that are slower than the baseline."""
+    regressions = []
+    for key, result in sorted(results.items()):
+        expected = baseline.get(key)
+        if expected is None:
+            continue
+
+        ratio = result["records_per_second"] / expected["records_per_second"]
+        if ratio < 1 - tolerance:
+            regressions.append("{}: {:.0%} of the baseline throughput".format(key, ratio))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=10000, help="number of records per benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed runs, the best one is reported")
+    parser.add_argument("--filter", default="", help="only run benchmarks containing this string")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--baseline", help="compare the results to this json file")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown relative to the baseline")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.records, args.repeat, args.filter)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump({"python": platform.python_version(), "results": results}, fp, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)["results"]
+
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("Regression: " + regression)
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
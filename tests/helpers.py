@@ -0,0 +1,23 @@
+"""
+Helpers shared by the tests and the benchmarks.
+"""
+
+from avrolight import registry
+
+
+class MemoryRegistryClient(registry.RegistryClient):
+    """A schema registry in a dict, which counts the schemas requested from it."""
+
+    def __init__(self):
+        self.schemas = {}
+        self.gets = 0
+
+    def put(self, schema, force=False):
+        for key in registry.schema_keys(schema):
+            self.schemas[key] = schema
+
+        return schema.md5_hash
+
+    def get(self, schema_hash):
+        self.gets += 1
+        return self.schemas[schema_hash]
@@ -1,6 +1,7 @@
+import base64
+import http.server
 import json
 import io
-import gc
 import time
 
 from hamcrest import *
@@ -8,6 +9,10 @@ import nose
 
 import avrolight
 from avrolight.schema import Schema
+from avrolight.container import BlockIndex
+from avrolight import registry
+
+from helpers import MemoryRegistryClient
 
 SCHEMAS_TO_VALIDATE = (
     ('"null"', None),
@@ -51,6 +56,14 @@ SCHEMAS_TO_VALIDATE = (
 )
 
 
+# a record schema and values of it for the container tests
+RECORD_SCHEMA = {"type": "record", "name": "Test", "fields": [{"name": "f", "type": "long"}]}
+
+
+def make_records(count):
+    return [{"f": idx} for idx in range(count)]
+
+
 def avro_write_datum(datum, writer_schema):
     import avro.io
 
@@ -111,77 +124,1151 @@ def test_write_container_file():
         assert_that(values[0], equal_to(value))
 
 
-def test_schema_str():
-    schema = Schema('{"type": "int"}')
-    assert_that(str(schema), '{"type": "int"}')
+def test_compiled_reader_matches_interpreter():
+    for schema, value in SCHEMAS_TO_VALIDATE:
+        reader = avrolight.Reader(json.loads(schema))
 
+        fp = io.BytesIO()
+        avrolight.write(reader.schema, fp, value)
 
-def timeit(name, runs=100000):
-    start = time.time()
-    for _ in range(runs):
-        yield
+        interpreted = reader.read_any(reader.schema.toplevel_type, io.BytesIO(fp.getvalue()))
+        assert_that(reader.read(io.BytesIO(fp.getvalue())), equal_to(interpreted))
 
-    duration = time.time() - start
-    print("Time {}: {:1.2f}/s".format(name, runs / duration))
 
+def test_compiled_reader_recursive_schema():
+    schema = Schema(json.loads(SCHEMAS_TO_VALIDATE[-1][0]))
+    value = {"value": None}
+    for idx in range(50):
+        value = {"value": {"car": {"value": str(idx)}, "cdr": value}}
+
+    fp = io.BytesIO()
+    avrolight.write(schema, fp, value)
+
+    assert_that(avrolight.read(schema, fp.getvalue()), equal_to(value))
+    assert_that(schema.decoder, same_instance(schema.decoder))
 
-def speed_avro_write():
-    import avro.io
-    import avro.schema
-    gc.disable()
 
+def test_decode_from_buffer():
     schema, value = SCHEMAS_TO_VALIDATE[-1]
-    parsed_schema = avro.schema.Parse(schema)
+    reader = avrolight.Reader(json.loads(schema))
+
+    fp = io.BytesIO()
+    fp.write(b"prefix")
+    avrolight.write(reader.schema, fp, value)
+    avrolight.write(reader.schema, fp, value)
+    data = fp.getvalue()
+
+    first, pos = reader.decode(memoryview(data), 6)
+    second, end = reader.decode(data, pos)
+    assert_that([first, second], equal_to([value, value]))
+    assert_that(end, equal_to(len(data)))
+
+    # in-memory files are positioned behind the value after reading
+    fp.seek(6)
+    assert_that(reader.read(fp), equal_to(value))
+    assert_that(fp.tell(), equal_to(pos))
+
+    # other file-like objects are read value by value
+    with io.BufferedReader(io.BytesIO(data[6:])) as stream:
+        assert_that(reader.read(stream), equal_to(value))
 
-    for _ in timeit("avro, writing"):
-        encoder = avro.io.BinaryEncoder(io.BytesIO())
-        datum_writer = avro.io.DatumWriter(parsed_schema)
-        datum_writer.write(value, encoder)
+    assert_that(calling(reader.decode).with_args(data[:-3], pos), raises(EOFError))
 
+    # values are not cut short at the end of the buffer
+    schema = Schema({"type": "record", "name": "R", "fields": [
+        {"name": "s", "type": "string"}, {"name": "h", "type": {"type": "fixed", "name": "H", "size": 4}}]})
+    data = bytes(avrolight.Writer(schema).encode({"s": "hello world", "h": b"abcd"}))
+    for options in ({}, {"zero_copy": True}):
+        reader = avrolight.Reader(schema, **options)
+        assert_that(calling(reader.decode).with_args(data[:10]), raises(EOFError))
+        assert_that(calling(reader.decode).with_args(data[:-1]), raises(EOFError))
 
-def speed_avro_read():
+
+def test_encode_into_buffer():
+    from avrolight.io import encode_long, write_long
+
+    for value in (0, 1, 63, 64, -1, -64, -65, 2 ** 31, -2 ** 63, 2 ** 63 - 1):
+        buf = bytearray()
+        encode_long(buf, value)
+
+        fp = io.BytesIO()
+        write_long(fp, value)
+        assert_that(bytes(buf), equal_to(fp.getvalue()))
+
+    schema, value = SCHEMAS_TO_VALIDATE[-1]
+    writer = avrolight.Writer(json.loads(schema))
+
+    buf = writer.encode(value, bytearray(b"prefix"))
+    assert_that(bytes(buf), equal_to(b"prefix" + writer.encode(value)))
+
+
+def test_compiled_writer_union_dispatch():
+    import avro.schema
+    from collections import OrderedDict
+
+    schema = """
+    {"type": "record", "name": "Nullable", "fields": [
+        {"name": "flag", "type": ["null", "boolean"]},
+        {"name": "count", "type": ["null", "long"]},
+        {"name": "label", "type": ["null", "string", "bytes"]},
+        {"name": "payload", "type": ["null", "Nullable", {"type": "map", "values": "long"}]},
+        {"name": "symbol", "type": {"type": "enum", "name": "Many", "symbols": %s}}
+    ]}
+    """ % json.dumps(["S%d" % idx for idx in range(100)])
+
+    empty = {"flag": None, "count": None, "label": None, "payload": None, "symbol": "S0"}
+    values = [
+        dict(empty, flag=True, count=12, label="abc", symbol="S99"),
+        dict(empty, flag=False, label=b"abc", payload=OrderedDict(empty)),
+        dict(empty, payload=dict(empty, count=-1)),
+    ]
+
+    for value in values:
+        fp = io.BytesIO()
+        avrolight.write(json.loads(schema), fp, value)
+        assert_that(fp.getvalue(), equal_to(avro_write_datum(value, avro.schema.Parse(schema))))
+
+
+def test_compiled_writer_union_of_records():
+    import avro.schema
+
+    schema = """
+    {"type": "record", "name": "Event", "fields": [
+        {"name": "payload", "type": [
+            {"type": "record", "name": "Click", "fields": [{"name": "x", "type": "long"}, {"name": "y", "type": "long"}]},
+            {"type": "record", "name": "Key", "fields": [{"name": "code", "type": "string"}]},
+            {"type": "record", "name": "Scroll", "fields": [{"name": "x", "type": "long"}]}
+        ]}
+    ]}
+    """
+
+    # each dict is encoded with the record whose fields match its keys
+    values = [{"payload": {"code": "a"}}, {"payload": {"x": 1, "y": 2}}, {"payload": {"x": 3}}]
+    writer = avrolight.Writer(json.loads(schema))
+    for branch, value in zip((1, 0, 2), values):
+        encoded = bytes(writer.encode(value))
+        assert_that(encoded[0], equal_to(branch * 2))
+        assert_that(avrolight.read(writer.schema, encoded), equal_to(value))
+
+    assert_that(bytes(writer.encode(values[0])), equal_to(avro_write_datum(values[0], avro.schema.Parse(schema))))
+
+
+def test_read_compressed_container_file():
     import avro.io
     import avro.schema
-    gc.disable()
+    import avro.datafile
 
     schema, value = SCHEMAS_TO_VALIDATE[-1]
-    parsed_schema = avro.schema.Parse(schema)
-    bytes = avro_write_datum(value, parsed_schema)
+    writer = io.BytesIO()
+    datum_writer = avro.io.DatumWriter(avro.schema.Parse(schema))
+    container = avro.datafile.DataFileWriter(writer, datum_writer, avro.schema.Parse(schema), codec="deflate")
+    for _ in range(10):
+        container.append(value)
 
-    for _ in timeit("avro, reading"):
-        decoder = avro.io.BinaryDecoder(io.BytesIO(bytes))
-        datum_reader = avro.io.DatumReader(parsed_schema)
-        datum_reader.read(decoder)
+    container.flush()
 
+    reader = avrolight.read_container(io.BytesIO(writer.getvalue()))
+    assert_that(reader.codec.name, equal_to("deflate"))
+    assert_that(list(reader), equal_to([value] * 10))
 
-def speed_avrolight_write():
-    gc.disable()
 
+def test_write_compressed_container_file():
     schema, value = SCHEMAS_TO_VALIDATE[-1]
-    parsed_schema = json.loads(schema)
+    for codec in ("null", "deflate", "bzip2", "xz"):
+        fp = io.BytesIO()
+        with avrolight.ContainerWriter(fp, json.loads(schema), codec=codec) as writer:
+            for _ in range(100):
+                writer.write(value)
 
-    for _ in timeit("avrolight, writing"):
-        avrolight.write(parsed_schema, io.BytesIO(), value)
+        # append a few more records using the codec from the header
+        fp.seek(0)
+        with avrolight.append_to_container(fp) as writer:
+            writer.write(value)
 
+        values = list(avrolight.read_container(io.BytesIO(fp.getvalue())))
+        assert_that(values, equal_to([value] * 101))
 
-def speed_avrolight_read():
-    gc.disable()
+    assert_that(calling(avrolight.ContainerWriter).with_args(io.BytesIO(), '"int"', codec="lz4"), raises(ValueError))
 
-    schema, value = SCHEMAS_TO_VALIDATE[-1]
-    parsed_schema = avrolight.Schema(json.loads(schema))
 
-    buffer = io.BytesIO()
-    avrolight.write(parsed_schema, buffer, value)
+def write_container_blocks(fp, schema, values, block_size, **kwargs):
+    """Writes the values to a container, flushing a block every `block_size` records."""
+    with avrolight.ContainerWriter(fp, schema, **kwargs) as writer:
+        for idx, value in enumerate(values):
+            writer.write(value)
+            if idx % block_size == block_size - 1:
+                writer.flush()
+
+
+def test_read_container_parallel():
+    import tempfile
+
+    values = make_records(1000)
+    schema = RECORD_SCHEMA
+
+    with tempfile.NamedTemporaryFile(suffix=".avro") as fp:
+        write_container_blocks(fp, schema, values, 30, codec="deflate")
+        fp.flush()
+
+        ranges = avrolight.parallel.split_offsets(fp, 64)
+        assert_that(len(ranges), greater_than(5))
+        assert_that([start for start, _ in ranges[1:]], equal_to([end for _, end in ranges[:-1]]))
+
+        records = avrolight.read_container_parallel(fp.name, processes=2, chunk_size=64)
+        assert_that(list(records), equal_to(values))
+
+        records = avrolight.read_container_parallel(fp.name, processes=2, chunk_size=64, ordered=False)
+        assert_that(sorted(records, key=lambda record: record["f"]), equal_to(values))
+
+        fp.seek(0)
+        records = avrolight.read_container_parallel(fp, processes=2, chunk_size=64)
+        assert_that(list(records), equal_to(values))
+
+
+def test_open_container_zero_copy():
+    import tempfile
+
+    values = [{"b": bytes([idx]) * idx, "h": bytes([idx]) * 4} for idx in range(100)]
+    schema = {"type": "record", "name": "Test", "fields": [
+        {"name": "b", "type": "bytes"},
+        {"name": "h", "type": {"type": "fixed", "name": "Hash", "size": 4}}]}
+
+    for codec in ("null", "deflate"):
+        with tempfile.NamedTemporaryFile(suffix=".avro") as fp:
+            write_container_blocks(fp, schema, values, 30, codec=codec)
+            fp.flush()
+
+            with avrolight.open_container(fp.name, zero_copy=True) as reader:
+                records = list(reader)
+                assert_that(records[10]["b"], instance_of(memoryview))
+                assert_that(records[10]["h"], instance_of(memoryview))
+                assert_that([{"b": bytes(record["b"]), "h": bytes(record["h"])} for record in records],
+                            equal_to(values))
+                assert_that(reader[42]["b"], equal_to(values[42]["b"]))
+
+            # the mapping is closed by the reader, files opened by the caller are not
+            with avrolight.open_container(fp.name) as reader:
+                assert_that(list(reader), equal_to(values))
+
+            assert_that(reader.fp.closed, equal_to(True))
+            with open(fp.name, "rb") as source:
+                with avrolight.read_container(source) as reader:
+                    assert_that(list(reader), equal_to(values))
+
+                assert_that(source.closed, equal_to(False))
+
+    # slices of an in-memory file would keep it from being written to
+    reader = avrolight.Reader(schema, zero_copy=True)
+    data = bytes(avrolight.Writer(schema).encode(values[3]))
+    assert_that(bytes(reader.read(data)["b"]), equal_to(values[3]["b"]))
+    assert_that(calling(reader.read).with_args(io.BytesIO(data)), raises(ValueError))
+
+
+def test_write_container_parallel():
+    from avrolight.parallel import ParallelContainerWriter
+
+    values = make_records(1000)
+    schema = RECORD_SCHEMA
+
+    fp = io.BytesIO()
+    with ParallelContainerWriter(fp, schema, codec="deflate", batch_size=64, processes=2, index=True) as writer:
+        for value in values:
+            writer.write(value)
+
+    reader = avrolight.read_container(io.BytesIO(fp.getvalue()))
+    assert_that(list(reader), equal_to(values))
+    assert_that(writer.writer.index.counts, equal_to([64] * 15 + [40]))
+
+    # the blocks encoded before a failing batch are written and the file is completed
+    fp = io.BytesIO()
+    with io.BufferedWriter(fp, buffer_size=1024 ** 2) as target:
+        writer = ParallelContainerWriter(target, schema, batch_size=64, processes=2)
+        for value in values[:64] + [{"f": "invalid"}]:
+            writer.write(value)
+
+        assert_that(calling(writer.close), raises(Exception))
+        assert_that(list(avrolight.read_container(io.BytesIO(fp.getvalue()))), equal_to(values[:64]))
+
+
+def test_container_random_access():
+    values = make_records(100)
+    schema = RECORD_SCHEMA
+
+    fp = io.BytesIO()
+    write_container_blocks(fp, schema, values[:70], 7, codec="deflate", index=True)
+
+    fp.seek(0)
+    with avrolight.append_to_container(fp, index=True) as writer:
+        for value in values[70:]:
+            writer.write(value)
+
+    index_fp = io.BytesIO()
+    writer.index.save(index_fp)
+    written_index = BlockIndex.load(io.BytesIO(index_fp.getvalue()))
+
+    for index in (None, written_index):
+        reader = avrolight.read_container(io.BytesIO(fp.getvalue()), index=index)
+        assert_that(len(reader), equal_to(100))
+        assert_that(reader.index.offsets, equal_to(written_index.offsets))
+
+        assert_that(reader[0], equal_to(values[0]))
+        assert_that(reader[42], equal_to(values[42]))
+        assert_that(reader[-1], equal_to(values[-1]))
+        assert_that(reader[13:29:3], equal_to(values[13:29:3]))
+        assert_that(reader[60:50:-2], equal_to(values[60:50:-2]))
+        assert_that(reader.tail(5), equal_to(values[-5:]))
+        assert_that(calling(reader.__getitem__).with_args(100), raises(IndexError))
+
+        # random access does not change the iteration
+        assert_that(next(reader), equal_to(values[0]))
+
+        reader.seek_to_record(64)
+        assert_that(list(reader), equal_to(values[64:]))
+
+
+def test_write_container_in_background():
+    values = make_records(1000)
+    schema = RECORD_SCHEMA
+
+    fp = io.BytesIO()
+    with avrolight.ContainerWriter(fp, schema, codec="deflate", block_records=100, background=True,
+                                   index=True) as writer:
+        for value in values:
+            writer.write(value)
+
+    reader = avrolight.read_container(io.BytesIO(fp.getvalue()))
+    assert_that(list(reader), equal_to(values))
+    assert_that(reader.index.offsets, equal_to(writer.index.offsets))
+    assert_that(writer.index.counts, equal_to([100] * 10))
+
+    # errors of the background thread are raised in the producer
+    class FailingFile(io.BytesIO):
+        def write(self, data):
+            if self.tell() > 100:
+                raise OSError("disk full")
+            return super().write(data)
+
+    writer = avrolight.ContainerWriter(FailingFile(), schema, block_size=64, background=True)
+    assert_that(calling(lambda: [writer.write(value) for value in values]), raises(IOError))
+    assert_that(calling(writer.close), raises(IOError))
+
+
+def test_container_stats():
+    import threading
+
+    values = make_records(100)
+    schema = RECORD_SCHEMA
+
+    events = []
+    stats = avrolight.Stats(callback=lambda event, duration, **info: events.append((event, info)))
+
+    fp = io.BytesIO()
+    with avrolight.ContainerWriter(fp, schema, codec="deflate", block_records=30, stats=stats) as writer:
+        for value in values:
+            writer.write(value)
+
+    assert_that(stats.as_dict(), has_entries(records=100, blocks=4, flushes=1))
+    assert_that([event for event, _ in events], equal_to(["block"] * 4 + ["flush"]))
+    assert_that(sum(info["size"] for _, info in events[:4]), equal_to(stats.bytes))
+
+    # copied blocks are counted with their compressed size too
+    copied = avrolight.Stats()
+    with avrolight.ContainerWriter(io.BytesIO(), schema, codec="deflate", stats=copied) as writer:
+        for block in avrolight.read_container(io.BytesIO(fp.getvalue())).iter_blocks():
+            writer.write_block(block)
+
+    assert_that((copied.records, copied.blocks, copied.bytes), equal_to((100, 4, stats.bytes)))
+
+    stats = avrolight.Stats()
+    reader = avrolight.read_container(io.BytesIO(fp.getvalue()), stats=stats)
+    assert_that(next(reader), equal_to(values[0]))
+    assert_that(stats.blocks, equal_to(0))
+    assert_that(list(reader), equal_to(values[1:]))
+    assert_that(stats.as_dict(), has_entries(records=100, blocks=4, flushes=0))
+
+    # random access only counts the records returned
+    stats = avrolight.Stats()
+    reader = avrolight.read_container(io.BytesIO(fp.getvalue()), stats=stats)
+    assert_that(reader[45:50], equal_to(values[45:50]))
+    assert_that(reader[75], equal_to(values[75]))
+    assert_that((stats.records, stats.blocks), equal_to((6, 2)))
+
+    # blocks are counted by the background thread while the caller encodes records
+    stats = avrolight.Stats()
+    with avrolight.ContainerWriter(io.BytesIO(), schema, block_records=10, background=True, stats=stats) as writer:
+        for value in values:
+            writer.write(value)
+
+    assert_that(stats.as_dict(), has_entries(records=100, blocks=10))
+
+    stats = avrolight.Stats()
+    writer = avrolight.Writer(Schema(schema), stats=stats)
+    message = writer.encode(values[-1])
+    avrolight.Reader(Schema(schema), stats=stats).decode(message)
+    assert_that((stats.records, stats.bytes), equal_to((2, 2 * len(message))))
+
+    # lazy views are counted without their size
+    view = avrolight.Reader(Schema(schema), lazy=True, stats=stats).read(bytes(message))
+    assert_that(view["f"], equal_to(values[-1]["f"]))
+    assert_that((stats.records, stats.bytes), equal_to((3, 2 * len(message))))
+
+    # values counted by several threads are summed up
+    threads = [threading.Thread(target=lambda: [stats.count_records(1, 2) for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert_that((stats.records, stats.bytes), equal_to((4003, 8000 + 2 * len(message))))
+    stats.reset()
+    assert_that(stats.as_dict(), has_entries(records=0, bytes=0))
+
+    stats = avrolight.Stats()
+    backend = MemoryRegistryClient()
+    client = registry.CachingRegistryClient(backend, stats=stats)
+    message = registry.serialize(backend, Schema(schema), values[0])
+    for _ in range(3):
+        registry.deserialize(client, message)
+    assert_that((stats.lookups, stats.hits, stats.misses), equal_to((3, 2, 1)))
+
+
+def test_copy_container_blocks():
+    values = make_records(100)
+    schema = RECORD_SCHEMA
+
+    fp = io.BytesIO()
+    write_container_blocks(fp, schema, values, 10, codec="deflate")
+
+    reader = avrolight.read_container(io.BytesIO(fp.getvalue()))
+    blocks = list(reader.iter_blocks())
+    assert_that([block.count for block in blocks], equal_to([10] * 10))
+    assert_that([block.offset for block in blocks], equal_to(reader.index.offsets))
+
+    for codec in ("deflate", "null"):
+        target = io.BytesIO()
+        with avrolight.ContainerWriter(target, schema, codec=codec) as writer:
+            writer.write({"f": -1})
+            for block in blocks:
+                writer.write_block(block)
+
+        copied = avrolight.read_container(io.BytesIO(target.getvalue()))
+        assert_that(list(copied), equal_to([{"f": -1}] + values))
+
+        # blocks with the same codec are copied as they are
+        copied = avrolight.read_container(io.BytesIO(target.getvalue()))
+        copied_blocks = list(copied.iter_blocks())[1:]
+        assert_that([block.decompress() for block in copied_blocks],
+                    equal_to([block.decompress() for block in blocks]))
+        if codec == "deflate":
+            assert_that([block.data for block in copied_blocks], equal_to([block.data for block in blocks]))
+
+
+def test_merge_and_split_containers():
+    import os
+    import tempfile
+
+    values = make_records(100)
+    schema = RECORD_SCHEMA
+    v2 = {"type": "record", "name": "Test", "fields": [{"name": "f", "type": "long"},
+                                                       {"name": "g", "type": "string", "default": "x"}]}
+
+    sources = []
+    for idx in range(0, 100, 10):
+        fp = io.BytesIO()
+        write_container_blocks(fp, schema, values[idx:idx + 10], 5, codec="deflate")
+        sources.append(io.BytesIO(fp.getvalue()))
+
+    fp = io.BytesIO()
+    assert_that(avrolight.merge_containers(sources, fp), equal_to(100))
+    reader = avrolight.read_container(io.BytesIO(fp.getvalue()))
+    assert_that(reader.codec.name, equal_to("deflate"))
+    assert_that(list(reader), equal_to(values))
+    assert_that(len(reader.index), equal_to(20))
+
+    # small blocks are combined, records of other schemas are resolved
+    for source in sources:
+        source.seek(0)
+
+    fp = io.BytesIO()
+    avrolight.merge_containers(sources, fp, schema=v2, codec="null", block_size=1000)
+    reader = avrolight.read_container(io.BytesIO(fp.getvalue()))
+    assert_that(list(reader), equal_to([dict(value, g="x") for value in values]))
+    assert_that(len(reader.index), equal_to(1))
+
+    # the blocks merged before a broken source are flushed to the file
+    for source in sources[:2]:
+        source.seek(0)
+
+    partial = io.BytesIO()
+    broken = io.BytesIO(b"Obj\x01 truncated")
+    with io.BufferedWriter(partial, buffer_size=1024 ** 2) as target:
+        assert_that(calling(avrolight.merge_containers).with_args(sources[:2] + [broken], target), raises(Exception))
+        assert_that(list(avrolight.read_container(io.BytesIO(partial.getvalue()))), equal_to(values[:20]))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "merged.avro")
+        with open(path, "wb") as merged:
+            merged.write(fp.getvalue())
+
+        def open_target(idx):
+            return open(os.path.join(directory, "part-{}.avro".format(idx)), "wb")
+
+        parts = avrolight.split_container(path, open_target, max_records=30)
+        assert_that(parts, equal_to(4))
+
+        paths = [os.path.join(directory, "part-{}.avro".format(idx)) for idx in range(parts)]
+        for idx, part in enumerate(paths):
+            with open(part, "rb") as part:
+                assert_that(list(avrolight.read_container(part)),
+                            equal_to([dict(value, g="x") for value in values[idx * 30:idx * 30 + 30]]))
+
+        merged = io.BytesIO()
+        avrolight.merge_containers(paths, merged)
+        assert_that(list(avrolight.read_container(io.BytesIO(merged.getvalue()))), has_length(100))
+
+
+def test_read_projection():
+    schema = Schema({"type": "record", "name": "Event", "fields": [
+        {"name": "id", "type": "long"},
+        {"name": "tags", "type": {"type": "array", "items": "string"}},
+        {"name": "attributes", "type": {"type": "map", "values": ["null", "double"]}},
+        {"name": "user", "type": ["null", {"type": "record", "name": "User", "fields": [
+            {"name": "name", "type": "string"},
+            {"name": "avatar", "type": "bytes"},
+            {"name": "checksum", "type": {"type": "fixed", "name": "Checksum", "size": 4}},
+        ]}]},
+        {"name": "friends", "type": {"type": "array", "items": "User"}},
+        {"name": "kind", "type": {"type": "enum", "name": "Kind", "symbols": ["A", "B"]}},
+        {"name": "score", "type": "float"},
+    ]})
+
+    user = {"name": "alice", "avatar": b"\x00" * 100, "checksum": b"abcd"}
+    value = {
+        "id": 42, "tags": ["a", "b"], "attributes": {"x": 1.5, "y": None},
+        "user": user, "friends": [user, dict(user, name="bob")], "kind": "B", "score": 0.5,
+    }
+
+    data = b"".join([avrolight.Writer(schema).encode(value)] * 2)
+
+    reader = avrolight.Reader(schema, fields=["kind", "user.name", "friends.name", "friends"])
+    first, pos = reader.decode(data)
+    second, end = reader.decode(data, pos)
+    assert_that(first, equal_to({"kind": "B", "user": {"name": "alice"}, "friends": value["friends"]}))
+    assert_that(second, equal_to(first))
+    assert_that(end, equal_to(len(data)))
+
+    reader = avrolight.Reader(schema, fields=["score", "friends.checksum"])
+    assert_that(reader.decode(data)[0], equal_to({"score": 0.5, "friends": [{"checksum": b"abcd"}] * 2}))
+
+
+def test_read_record_classes():
+    schema = Schema({"type": "record", "name": "example.Event", "fields": [
+        {"name": "id", "type": "long"},
+        {"name": "user", "type": ["null", {"type": "record", "name": "User", "fields": [
+            {"name": "name", "type": "string"},
+        ]}, {"type": "record", "name": "Group", "fields": [
+            {"name": "name", "type": "string"},
+        ]}]},
+    ]})
+
+    value = {"id": 1, "user": {"name": "admins"}}
+    data = avrolight.Writer(schema).encode(value)
+
+    reader = avrolight.Reader(schema, record_classes=True)
+    event = reader.read(data)
+    assert_that(type(event), same_instance(schema.record_classes["example.Event"]))
+    assert_that(type(event).__name__, equal_to("Event"))
+    assert_that(event.id, equal_to(1))
+    assert_that(event.user.name, equal_to("admins"))
+    assert_that(hasattr(event, "__dict__"), equal_to(False))
+
+    # file-like objects are read value by value and produce the same objects
+    with io.BufferedReader(io.BytesIO(data)) as stream:
+        assert_that(reader.read(stream), equal_to(event))
+
+    # the writer accepts instances and chooses union branches by their record type
+    Group = schema.record_classes["Group"]
+    event.user = Group(name="admins")
+    encoded = avrolight.Writer(schema).encode(event)
+    assert_that(bytes(encoded), is_not(equal_to(bytes(data))))
+    assert_that(reader.read(encoded).user, equal_to(Group("admins")))
+
+    fp = io.BytesIO()
+    avrolight.Writer(schema).write_any(schema.toplevel_type, fp, event)
+    assert_that(fp.getvalue(), equal_to(bytes(encoded)))
+
+    assert_that(calling(avrolight.Reader).with_args(schema, fields=["id"], record_classes=True),
+                raises(ValueError))
 
-    for _ in timeit("avrolight, reading"):
-        avrolight.read(parsed_schema, buffer.getvalue())
+    # container readers can not resolve records into classes either
+    fp = io.BytesIO()
+    write_container_blocks(fp, schema, [value], 1)
+    assert_that(calling(avrolight.read_container).with_args(
+        io.BytesIO(fp.getvalue()), reader_schema=schema, record_classes=True), raises(ValueError))
+    record = next(avrolight.read_container(io.BytesIO(fp.getvalue()), record_classes=True))
+    assert_that((record.__avro_name__, record.user.name), equal_to(("example.Event", "admins")))
 
+    # field names starting with one underscore are fine, unless they shadow members of Record
+    schema = Schema({"type": "record", "name": "Meta", "fields": [
+        {"name": "_name", "type": "string"},
+        {"name": "inner", "type": {"type": "record", "name": "Inner", "fields": [{"name": "_fields", "type": "long"}]}},
+    ]})
 
-def speed():
-    speed_avrolight_read()
-    speed_avrolight_write()
-    speed_avro_read()
-    speed_avro_write()
+    value = {"_name": "n", "inner": {"_fields": 1}}
+    meta = avrolight.Reader(schema, record_classes=True).read(avrolight.Writer(schema).encode(value))
+    assert_that((meta._name, meta.inner._fields), equal_to(("n", 1)))
+    assert_that(bytes(avrolight.Writer(schema).encode(meta)), equal_to(bytes(avrolight.Writer(schema).encode(value))))
+
+    for field in ("__private", "_asdict"):
+        schema = Schema({"type": "record", "name": "Meta", "fields": [
+            {"name": "inner", "type": {"type": "record", "name": "Inner", "fields": [{"name": field, "type": "long"}]}},
+        ]})
+
+        assert_that(calling(avrolight.Reader).with_args(schema, record_classes=True),
+                    raises(ValueError, "{!r} of record Inner".format(field)))
+        assert_that(avrolight.Reader(schema).read(avrolight.Writer(schema).encode({"inner": {field: 1}})),
+                    equal_to({"inner": {field: 1}}))
+
+
+def test_read_lazy_record_views():
+    schema = Schema({"type": "record", "name": "Message", "fields": [
+        {"name": "id", "type": "long"},
+        {"name": "payload", "type": "bytes"},
+        {"name": "tags", "type": {"type": "map", "values": "string"}},
+        {"name": "route", "type": ["null", "string"]},
+        {"name": "reply", "type": ["null", "Message"]},
+    ]})
+
+    value = {"id": 7, "payload": b"x" * 100, "tags": {"a": "b"}, "route": "eu", "reply": None}
+    data = b"prefix" + b"".join([avrolight.Writer(schema).encode(value)] * 2)
+
+    reader = avrolight.Reader(schema, lazy=True)
+    first, pos = reader.decode(data, 6)
+    second, end = reader.decode(data, pos)
+    assert_that(end, equal_to(len(data)))
+
+    view = reader.view(data, 6)
+    assert_that(view["route"], equal_to("eu"))
+    assert_that(view._offsets, has_length(5))
+    assert_that(view["route"], same_instance(view["route"]))
+    assert_that("payload" in view and "missing" not in view, equal_to(True))
+    assert_that(calling(view.__getitem__).with_args("missing"), raises(KeyError))
+
+    assert_that(bytes(view.raw), equal_to(data[6:pos]))
+    assert_that(dict(view), equal_to(value))
+    assert_that(second, equal_to(value))
+    assert_that(list(first), equal_to(["id", "payload", "tags", "route", "reply"]))
+
+    reader = avrolight.Reader(schema, lazy=True, zero_copy=True)
+    assert_that(reader.view(memoryview(data), pos)["payload"], instance_of(memoryview))
+
+    client = MemoryRegistryClient()
+    messages = registry.serialize_many(client, schema, [value, dict(value, route="us")])
+    views = registry.deserialize_many(client, messages, lazy=True)
+    assert_that([view["route"] for view in views], equal_to(["eu", "us"]))
+    assert_that(registry.deserialize(client, messages[1], lazy=True), equal_to(dict(value, route="us")))
+
+    assert_that(calling(avrolight.Reader(Schema({"type": "array", "items": "long"}), lazy=True).view)
+                .with_args(b"\x00"), raises(ValueError))
+
+
+def test_skip_array_blocks_with_size():
+    from avrolight.io import encode_long
+
+    # writers may emit array blocks with a negative count followed by the byte size
+    schema = '{"type": "record", "name": "R", "fields": [{"name": "a", "type": {"type": "array", "items": "long"}}, ' \
+             '{"name": "b", "type": "long"}]}'
+
+    data = bytearray()
+    encode_long(data, -3)
+    encode_long(data, 3)
+    data += bytes([2, 4, 6, 0])
+    encode_long(data, 7)
+
+    assert_that(avrolight.read(json.loads(schema), bytes(data)), equal_to({"a": [1, 2, 3], "b": 7}))
+    assert_that(avrolight.read(json.loads(schema), bytes(data), fields=["b"]), equal_to({"b": 7}))
+
+
+def test_schema_resolution():
+    from avrolight.resolution import ResolvingReader
+
+    writer_schema = Schema({"type": "record", "name": "ns.v1.Event", "fields": [
+        {"name": "id", "type": "int"},
+        {"name": "removed", "type": {"type": "array", "items": {"type": "map", "values": "string"}}},
+        {"name": "score", "type": "float"},
+        {"name": "label", "type": ["null", "string"]},
+        {"name": "kind", "type": {"type": "enum", "name": "Kind", "symbols": ["A", "B", "C"]}},
+        {"name": "old_name", "type": "bytes"},
+        {"name": "next", "type": ["null", "ns.v1.Event"]},
+    ]})
+
+    reader_schema = Schema({"type": "record", "name": "ns.v2.Event", "fields": [
+        {"name": "kind", "type": {"type": "enum", "name": "Kind", "symbols": ["B", "A", "X"], "default": "X"}},
+        {"name": "id", "type": "long"},
+        {"name": "score", "type": "double"},
+        {"name": "label", "type": ["string", "null"]},
+        {"name": "new_name", "type": "string", "aliases": ["old_name"]},
+        {"name": "added", "type": {"type": "array", "items": "long"}, "default": [1, 2]},
+        {"name": "checksum", "type": "bytes", "default": "\u00ff"},
+        {"name": "next", "type": ["null", "ns.v2.Event"]},
+    ]})
+
+    value = {"id": 1, "removed": [{"a": "b"}], "score": 0.5, "label": None, "kind": "C", "old_name": b"abc",
+             "next": {"id": 2, "removed": [], "score": 1.5, "label": "l", "kind": "A", "old_name": b"", "next": None}}
+
+    data = avrolight.Writer(writer_schema).encode(value)
+
+    expected = {"id": 1, "score": 0.5, "label": None, "kind": "X", "new_name": "abc", "added": [1, 2],
+                "checksum": b"\xff", "next": {"id": 2, "score": 1.5, "label": "l", "kind": "A", "new_name": "",
+                                              "added": [1, 2], "checksum": b"\xff", "next": None}}
+
+    reader = avrolight.Reader(reader_schema, writer_schema=writer_schema)
+    assert_that(reader.read(bytes(data)), equal_to(expected))
+
+    resolving_reader = ResolvingReader(reader_schema)
+    first, _ = resolving_reader.decode(writer_schema, data)
+    first["added"].append(3)
+    assert_that(resolving_reader.decode(writer_schema, data)[0], equal_to(expected))
+    assert_that(resolving_reader.plans, has_length(1))
+
+    incompatible = Schema({"type": "record", "name": "Event", "fields": [{"name": "missing", "type": "long"}]})
+    assert_that(calling(resolving_reader.plan).with_args(incompatible), raises(ValueError))
+
+
+def test_registry_deserialize_with_reader_schema():
+    from avrolight.resolution import ResolvingReader
+
+    client = MemoryRegistryClient()
+    v1 = Schema({"type": "record", "name": "R", "fields": [{"name": "a", "type": "int"}]})
+    v2 = Schema({"type": "record", "name": "R", "fields": [{"name": "a", "type": "long"},
+                                                         {"name": "b", "type": "string", "default": ""}]})
+
+    messages = [registry.serialize(client, v1, {"a": 1}), registry.serialize(client, v2, {"a": 2, "b": "x"})]
+    assert_that([registry.deserialize(client, message) for message in messages],
+                equal_to([{"a": 1}, {"a": 2, "b": "x"}]))
+
+    reader = ResolvingReader(v2)
+    for _ in range(3):
+        values = [registry.deserialize(client, message, reader) for message in messages]
+        assert_that(values, equal_to([{"a": 1, "b": ""}, {"a": 2, "b": "x"}]))
+
+    assert_that(reader.plans, has_length(2))
+
+
+def test_registry_serialize_many():
+    client = MemoryRegistryClient()
+    v1 = Schema({"type": "record", "name": "R", "fields": [{"name": "a", "type": "int"}]})
+    v2 = Schema({"type": "record", "name": "R", "fields": [{"name": "a", "type": "string"}]})
+
+    messages = registry.serialize_many(client, v1, [{"a": idx} for idx in range(3)])
+    messages += registry.serialize_many(client, v2, [{"a": "x"}])
+    messages.insert(1, messages.pop())
+    assert_that(messages[0], equal_to(registry.serialize(client, v1, {"a": 0})))
+
+    values = registry.deserialize_many(client, messages)
+    assert_that(values, equal_to([{"a": 0}, {"a": "x"}, {"a": 1}, {"a": 2}]))
+    assert_that(client.gets, equal_to(2))
+
+
+def test_registry_single_object_encoding():
+    # fingerprints from the avro specification test suite
+    assert_that(Schema({"type": "null"}).fingerprint, equal_to(7195948357588979594))
+    assert_that(Schema({"type": "boolean"}).fingerprint, equal_to(2 ** 64 - 6970731678124411036))
+
+    schema = Schema({"type": "record", "name": "R", "namespace": "ns", "doc": "docs", "fields": [
+        {"name": "a", "type": {"type": "int"}, "default": 1},
+        {"name": "next", "type": ["null", "R"]}]})
+    assert_that(schema.canonical_form, equal_to(
+        '{"name":"ns.R","type":"record","fields":[{"name":"a","type":"int"},'
+        '{"name":"next","type":["null","ns.R"]}]}'))
+
+    client = MemoryRegistryClient()
+    value = {"a": 1, "next": None}
+    message = registry.serialize(client, schema, value, single_object=True)
+    assert_that(message[:10], equal_to(b"\xc3\x01" + schema.fingerprint.to_bytes(8, "little")))
+    assert_that(message[10:], equal_to(avrolight.Writer(schema).encode(value)))
+
+    # both framings can be read side by side
+    messages = [message, registry.serialize(client, schema, value)]
+    assert_that(registry.deserialize_many(client, messages), equal_to([value, value]))
+    assert_that(registry.deserialize(client.cached, message), equal_to(value))
+
+
+def test_registry_schema_cache():
+    import threading
+
+    backend = MemoryRegistryClient()
+    schemas = [Schema({"type": "fixed", "name": "F", "size": size}) for size in range(1, 5)]
+    hashes = [backend.put(schema) for schema in schemas]
+
+    get = backend.get
+    backend.get = lambda schema_hash: time.sleep(0.05) or get(schema_hash)
+
+    # concurrent misses on the same hash call the backend only once
+    client = registry.CachingRegistryClient(backend)
+    threads = [threading.Thread(target=client.get, args=(hashes[0],)) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert_that(backend.gets, equal_to(1))
+    assert_that(client.get(hashes[0]), equal_to(schemas[0]))
+
+    # unknown hashes are remembered until the negative ttl expires
+    now = [0.0]
+    cache = registry.SchemaCache(max_size=2, ttl=60, negative_ttl=5, clock=lambda: now[0])
+    client = registry.CachingRegistryClient(backend, cache)
+    for _ in range(2):
+        assert_that(calling(client.get).with_args(b"0" * 32), raises(KeyError))
+    assert_that(backend.gets, equal_to(2))
+
+    now[0] = 10
+    assert_that(calling(client.get).with_args(b"0" * 32), raises(KeyError))
+    assert_that(backend.gets, equal_to(3))
+
+    # least recently used schemas are evicted, schemas expire after the ttl
+    for schema_hash in hashes:
+        client.get(schema_hash)
+    assert_that(cache.evictions, equal_to(3))
+    assert_that(hashes[3] in cache and hashes[0] not in cache, equal_to(True))
+
+    now[0] = 100
+    assert_that(hashes[3] in cache, equal_to(False))
+    assert_that(cache.stats, has_entries(hits=1, misses=6))
+
+
+def test_registry_file_cache():
+    import os
+    import tempfile
+
+    backend = MemoryRegistryClient()
+    schema = Schema({"type": "record", "name": "R", "fields": [{"name": "a", "type": "int"}]})
+    schema_hash = backend.put(schema)
+
+    with tempfile.TemporaryDirectory() as directory:
+        client = registry.FileCachingRegistryClient(backend, directory)
+        assert_that(str(client.get(schema_hash)), equal_to(str(schema)))
+        assert_that(os.listdir(directory), equal_to([schema_hash.decode() + ".avsc"]))
+
+        # a new process reads the schema from the directory
+        client = registry.FileCachingRegistryClient(backend, directory)
+        assert_that(str(client.get(schema_hash)), equal_to(str(schema)))
+        assert_that(backend.gets, equal_to(1))
+
+        # corrupt files are ignored
+        with open(os.path.join(directory, schema_hash.decode() + ".avsc"), "wb") as fp:
+            fp.write(b'"int"')
+
+        assert_that(str(client.get(schema_hash)), equal_to(str(schema)))
+        assert_that(backend.gets, equal_to(2))
+
+        # empty, truncated and unparsable files are ignored and removed as well
+        path = os.path.join(directory, schema_hash.decode() + ".avsc")
+        for content in (b"", b'{"type": "rec', b"\xff\xfe garbage"):
+            with open(path, "wb") as fp:
+                fp.write(content)
+
+            gets = backend.gets
+            client = registry.FileCachingRegistryClient(backend, directory)
+            assert_that(str(client.get(schema_hash)), equal_to(str(schema)))
+            assert_that(backend.gets, equal_to(gets + 1))
+
+            with open(path, "rb") as fp:
+                assert_that(fp.read(), equal_to(schema.as_bytes))
+
+
+def test_async_registry_serialize():
+    import asyncio
+    from avrolight import asyncregistry
+
+    class AsyncMemoryRegistryClient(asyncregistry.AsyncRegistryClient):
+        def __init__(self):
+            self.registry = MemoryRegistryClient()
+
+        async def put(self, schema, force=False):
+            return self.registry.put(schema, force)
+
+        async def get(self, schema_hash):
+            return self.registry.get(schema_hash)
+
+    async def roundtrip(client, schema, values):
+        messages = [await asyncregistry.serialize(client, schema, value) for value in values]
+        return messages, [await asyncregistry.deserialize(client, message) for message in messages]
+
+    client = AsyncMemoryRegistryClient()
+    schema = Schema({"type": "record", "name": "R", "fields": [{"name": "a", "type": "int"}]})
+    values = [{"a": idx} for idx in range(5)]
+
+    messages, decoded = asyncio.run(roundtrip(client.cached, schema, values))
+    assert_that(decoded, equal_to(values))
+    assert_that(messages[0], equal_to(registry.serialize(client.registry, schema, values[0])))
+    assert_that(client.registry.gets, equal_to(0))
+
+    messages = asyncio.run(asyncregistry.serialize_many(client, schema, values))
+    assert_that(asyncio.run(asyncregistry.deserialize_many(client, messages)), equal_to(values))
+
+
+class FakeConsulHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the key value store of consul from a dict."""
+
+    protocol_version = "HTTP/1.1"
+    store = {}
+    ports = set()
+
+    def do_GET(self):
+        self.ports.add(self.client_address[1])
+
+        key = self.path.rpartition("/")[2]
+        if key == "broken":
+            return self.respond(500, b"")
+
+        if key not in self.store:
+            return self.respond(404, b"")
+
+        self.respond(200, json.dumps([{"Key": key, "Value": base64.b64encode(self.store[key]).decode()}]).encode())
+
+    def do_PUT(self):
+        self.ports.add(self.client_address[1])
+
+        self.store[self.path.rpartition("/")[2]] = self.rfile.read(int(self.headers["Content-Length"]))
+        self.respond(200, b"true")
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_consul_registry_client():
+    import threading
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeConsulHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    endpoint = "http://127.0.0.1:{}".format(server.server_port)
+    schema = Schema({"type": "record", "name": "R", "fields": [{"name": "a", "type": "int"}]})
+
+    try:
+        client = registry.ConsulRegistryClient(endpoint, pool_size=4)
+        assert_that(client.session.get_adapter(endpoint)._pool_maxsize, equal_to(4))
+
+        schema_hash = client.put(schema)
+        assert_that(set(FakeConsulHandler.store), equal_to({key.decode() for key in registry.schema_keys(schema)}))
+
+        for key in registry.schema_keys(schema):
+            assert_that(str(client.get(key)), equal_to(str(schema)))
+
+        assert_that(schema_hash, equal_to(schema.md5_hash))
+        assert_that(calling(client.get).with_args(b"0" * 16), raises(KeyError))
+
+        # server errors are not reported as missing schemas, so they are not cached
+        cached = client.cached
+        assert_that(calling(cached.get).with_args(b"broken"), raises(registry.RegistryUnavailableError))
+        assert_that(b"broken", is_not(is_in(cached.cache._entries)))
+
+        # all requests were sent over one pooled connection
+        assert_that(FakeConsulHandler.ports, has_length(1))
+        client.close()
+
+    finally:
+        server.shutdown()
+        server.server_close()
+        FakeConsulHandler.store.clear()
+        FakeConsulHandler.ports.clear()
+
+
+def test_async_consul_registry_client():
+    import asyncio
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    from avrolight import asyncregistry
+
+    store = {}
+
+    async def get_key(request):
+        key = request.match_info["key"]
+        if key == "slow":
+            await asyncio.sleep(0.5)
+
+        if key not in store:
+            raise web.HTTPNotFound()
+
+        return web.json_response([{"Key": key, "Value": base64.b64encode(store[key]).decode()}])
+
+    async def put_key(request):
+        store[request.match_info["key"]] = await request.read()
+        return web.json_response(True)
+
+    app = web.Application()
+    app.router.add_get("/v1/kv/avro-schemas/{key}", get_key)
+    app.router.add_put("/v1/kv/avro-schemas/{key}", put_key)
+
+    schema = Schema({"type": "record", "name": "R", "fields": [{"name": "a", "type": "int"}]})
+
+    async def run():
+        async with TestServer(app) as server:
+            endpoint = str(server.make_url("")).rstrip("/")
+            async with asyncregistry.AsyncConsulRegistryClient(endpoint, timeout=0.1) as client:
+                assert_that(await client.put(schema), equal_to(schema.md5_hash))
+                assert_that(set(store), equal_to({key.decode() for key in registry.schema_keys(schema)}))
+
+                for key in registry.schema_keys(schema):
+                    assert_that(str(await client.get(key)), equal_to(str(schema)))
+
+                # missing keys are reported as missing schemas, timeouts are not cached
+                try:
+                    await client.get(b"0" * 16)
+                    raise AssertionError("KeyError not raised")
+                except KeyError as error:
+                    assert_that(error.args, equal_to((b"0" * 16,)))
+
+                cached = client.cached
+                try:
+                    await cached.get(b"slow")
+                    raise AssertionError("RegistryUnavailableError not raised")
+                except registry.RegistryUnavailableError:
+                    assert_that(b"slow", is_not(is_in(cached.cache._entries)))
+
+                # puts of known schemas only look them up
+                store.clear()
+                store[schema.fingerprint_hash.decode()] = schema.as_bytes
+                await client.put(schema)
+                assert_that(store, has_length(1))
+
+    asyncio.run(run())
+
+
+def test_read_container_columns():
+    import numpy
+
+    schema = {"type": "record", "name": "Row", "fields": [
+        {"name": "id", "type": "long"},
+        {"name": "value", "type": ["null", "double"]},
+        {"name": "name", "type": "string"},
+        {"name": "kind", "type": ["null", {"type": "enum", "name": "Kind", "symbols": ["A", "B"]}]},
+        {"name": "flag", "type": "boolean"},
+        {"name": "payload", "type": {"type": "array", "items": "bytes"}},
+    ]}
+
+    values = [
+        {"id": idx, "value": idx / 2 if idx % 3 else None, "name": "n%d" % idx,
+         "kind": None if idx % 4 == 0 else "AB"[idx % 2], "flag": idx % 2 == 0, "payload": [b"x"]}
+        for idx in range(20)
+    ]
+
+    fp = io.BytesIO()
+    write_container_blocks(fp, schema, values, 8, codec="deflate")
+
+    fields = ["id", "value", "name", "kind", "flag"]
+    blocks = list(avrolight.read_container(io.BytesIO(fp.getvalue())).iter_columns(fields))
+    assert_that([len(block["id"]) for block in blocks], equal_to([8, 8, 4]))
+
+    columns = {name: numpy.ma.concatenate([block[name] for block in blocks]) for name in fields}
+    assert_that(columns["id"].tolist(), equal_to([value["id"] for value in values]))
+    assert_that(columns["value"].tolist(), equal_to([value["value"] for value in values]))
+    assert_that(columns["name"].tolist(), equal_to([value["name"] for value in values]))
+    assert_that(columns["kind"].tolist(), equal_to([value["kind"] for value in values]))
+    assert_that(columns["flag"].dtype, equal_to(numpy.dtype(bool)))
+
+    # the payload field is not a column
+    reader = avrolight.read_container(io.BytesIO(fp.getvalue()))
+    assert_that(calling(list).with_args(reader.iter_columns()), raises(ValueError))
+
+    frames = avrolight.read_container(io.BytesIO(fp.getvalue())).iter_dataframes(fields)
+    frame = next(frames)
+    assert_that(list(frame["kind"].cat.categories), equal_to(["A", "B"]))
+    assert_that(frame["value"].isna().tolist(), equal_to([idx % 3 == 0 for idx in range(8)]))
+
+
+def test_read_container_fixed_size_columns():
+    schema = {"type": "record", "name": "Point", "fields": [
+        {"name": "x", "type": "double"}, {"name": "y", "type": "float"}, {"name": "valid", "type": "boolean"}]}
+
+    values = [{"x": idx * 1.5, "y": idx * 0.5, "valid": idx % 2 == 1} for idx in range(10)]
+
+    fp = io.BytesIO()
+    write_container_blocks(fp, schema, values, 10)
+
+    block, = avrolight.read_container(io.BytesIO(fp.getvalue())).iter_columns()
+    assert_that(block["x"].tolist(), equal_to([value["x"] for value in values]))
+    assert_that(block["y"].tolist(), equal_to([value["y"] for value in values]))
+    assert_that(block["valid"].tolist(), equal_to([value["valid"] for value in values]))
+
+
+def test_write_container_columns():
+    import numpy
+
+    schema = {"type": "record", "name": "Row", "fields": [
+        {"name": "id", "type": "long"},
+        {"name": "count", "type": ["int", "null"]},
+        {"name": "value", "type": ["null", "double"]},
+        {"name": "ratio", "type": "float"},
+        {"name": "name", "type": ["null", "string"]},
+        {"name": "blob", "type": "bytes"},
+        {"name": "kind", "type": {"type": "enum", "name": "Kind", "symbols": ["A", "B", "C"]}},
+        {"name": "hash", "type": {"type": "fixed", "name": "Hash", "size": 2}},
+        {"name": "flag", "type": "boolean"},
+    ]}
+
+    count = 50
+    ids = numpy.array([0, 1, -1, 63, 64, -65, 2 ** 40, -2 ** 63, 2 ** 63 - 1] + list(range(count - 9)))
+    columns = {
+        "id": ids,
+        "count": numpy.ma.masked_array(numpy.arange(count) * 1000, mask=numpy.arange(count) % 3 == 0),
+        "value": numpy.arange(count) / 4,
+        "ratio": numpy.arange(count, dtype=numpy.float32) / 2,
+        "name": [None if idx % 5 == 0 else "name %d \u00e4" % idx for idx in range(count)],
+        "blob": [b"x" * (idx * 7) for idx in range(count)],
+        "kind": ["ABC"[idx % 3] for idx in range(count)],
+        "hash": numpy.arange(2 * count, dtype=numpy.uint8).reshape(count, 2),
+        "flag": numpy.arange(count) % 2 == 0,
+    }
+    masks = {"value": numpy.arange(count) % 4 == 1}
+
+    fp = io.BytesIO()
+    with avrolight.ContainerWriter(fp, schema, codec="deflate") as writer:
+        writer.write({"id": 1, "count": None, "value": None, "ratio": 0.0, "name": None, "blob": b"",
+                      "kind": "A", "hash": b"ab", "flag": False})
+
+        writer.write_columns(columns, masks)
+
+    records = list(avrolight.read_container(io.BytesIO(fp.getvalue())))
+    assert_that(records, has_length(count + 1))
+
+    for idx, record in enumerate(records[1:]):
+        assert_that(record, equal_to({
+            "id": int(ids[idx]),
+            "count": None if idx % 3 == 0 else idx * 1000,
+            "value": None if idx % 4 == 1 else idx / 4,
+            "ratio": idx / 2,
+            "name": None if idx % 5 == 0 else "name %d \u00e4" % idx,
+            "blob": b"x" * (idx * 7),
+            "kind": "ABC"[idx % 3],
+            "hash": bytes([2 * idx, 2 * idx + 1]),
+            "flag": idx % 2 == 0,
+        }))
+
+    # unions wrapped into a dict are read back as columns too
+    schema = {"type": "record", "name": "Wrapped", "fields": [{"name": "a", "type": {"type": ["null", "long"]}}]}
+    values = numpy.ma.masked_array(numpy.arange(10), mask=numpy.arange(10) % 2 == 0)
+
+    fp = io.BytesIO()
+    with avrolight.ContainerWriter(fp, schema) as writer:
+        writer.write_columns({"a": values})
+
+    columns, = avrolight.read_container(io.BytesIO(fp.getvalue())).iter_columns()
+    assert_that(columns["a"].tolist(), equal_to(values.tolist()))
+
+
+def test_schema_str():
+    schema = Schema('{"type": "int"}')
+    assert_that(str(schema), '{"type": "int"}')
 
 
 if __name__ == '__main__':